@@ -1,33 +1,7 @@
+# Needs pico_boot/nmea.py copied to the board next to this script.
 from machine import I2C, Pin
 import utime
-
-def parse_gngga(sentence):
-    """
-    Parse the latitude and longitude from a $GNGGA sentence.
-    """
-    parts = sentence.split(',')
-    if len(parts) > 5 and parts[2] and parts[4]:  # Check if lat and lon are present
-        latitude = parts[2]
-        latitude_direction = parts[3]
-        longitude = parts[4]
-        longitude_direction = parts[5]
-
-        # Convert to decimal format
-        lat_deg = float(latitude[:2])
-        lat_min = float(latitude[2:])
-        lon_deg = float(longitude[:3])
-        lon_min = float(longitude[3:])
-
-        lat_decimal = lat_deg + lat_min / 60.0
-        lon_decimal = lon_deg + lon_min / 60.0
-
-        if latitude_direction == 'S':
-            lat_decimal = -lat_decimal
-        if longitude_direction == 'W':
-            lon_decimal = -lon_decimal
-
-        return lat_decimal, lon_decimal
-    return None, None
+from nmea import NMEAParser, GGA
 
 # Initialize I2C
 i2c = I2C(0, sda=Pin(0), scl=Pin(1))
@@ -39,22 +13,16 @@ gps_addr = 0x10  # GPS I2C address
 # location
 i2c.writeto(gps_addr, b'$PMTK314,0,1,0,1,1,0,0,0,0,0,0,0,0,0,0,0,0,1*34\r\n')
 
-buffer = ""  # Buffer to hold incoming data
+gps = NMEAParser()
+chunk = bytearray(32)  # Reused for every read
 
 while True:
-    data = i2c.readfrom(gps_addr, 32)
-    if data:
-        buffer += data.decode('utf-8')  # Append data to buffer
-        
-        # Check if buffer contains end of NMEA sentence
-        while '\r\n' in buffer:
-            # Split buffer at first occurrence of newline, process line, and keep remainder
-            line, buffer = buffer.split('\r\n', 1)
-            
-            # Process the line if it's a GNGGA sentence
-            if line.startswith('$GNGGA'):
-                lat, lon = parse_gngga(line)
-                if lat is not None and lon is not None:
-                    print("Latitude:", lat, "Longitude:", lon)
+    # Read until the receiver has nothing queued; an empty read comes back as '\n' padding.
+    for _ in range(32):
+        i2c.readfrom_into(gps_addr, chunk)
+        if gps.feed(chunk) & GGA and gps.fix_quality and gps.has_position:
+            print("Latitude:", gps.latitude(), "Longitude:", gps.longitude())
+        if chunk[0] == 10 and chunk[-1] == 10:
+            break
 
     utime.sleep_ms(1000)
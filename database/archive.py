@@ -0,0 +1,323 @@
+"""
+Columnar archive for history older than the API's live window.
+
+The archival job moves sensor_data rows older than --keep-days into one
+archive per UTC day and then deletes them, so the row store and its indexes
+only hold recent history. An archive day has one entry per column, with the
+rows sorted by device and then time:
+
+    devices   device ids, sorted
+    offsets   devices[i] owns rows offsets[i]:offsets[i + 1]
+    base      first (epoch, latitude, longitude, elevation) of each device, int64
+    epoch     seconds since the previous fix of the same device
+    latitude, longitude    change in degrees * 1e7 since the previous fix
+    elevation              change in centimetres since the previous fix
+
+Consecutive fixes are close in time and space, so the deltas are small and
+each column is stored in the narrowest integer type that holds it. The
+default 'npy' format writes a directory of .npy files per day, which
+ArchiveReader memory-maps so a long-range query only pages in the rows of the
+device it asks for. 'npz' packs a day into one deflate-compressed file for
+colder storage; those are read whole.
+
+    python3 archive.py                           # archive days older than 7 days
+    python3 archive.py --keep-days 30 --format npz
+    python3 archive.py --read 1 --start 2024-01-01 --end 2024-02-01
+"""
+import argparse
+import os
+import shutil
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+from storage import DB_ERRORS, get_backend
+from telemetry_codec import COORD_SCALE, ELEVATION_SCALE
+
+DEFAULT_ARCHIVE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'archive')
+# The API serves up to 5 days from sensor_data; keep a margin on top of that.
+DEFAULT_KEEP_DAYS = 7
+COLUMNS = ('epoch', 'latitude', 'longitude', 'elevation')
+FETCH_SIZE = 10000
+# Ids per DELETE; older SQLite builds allow at most 999 parameters.
+DELETE_BATCH = 500
+
+
+def narrowest(deltas):
+    """deltas in the smallest signed integer type that holds all of them."""
+    for dtype in (np.int8, np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if not len(deltas) or (deltas.min() >= info.min and deltas.max() <= info.max):
+            return deltas.astype(dtype)
+    return deltas
+
+
+def encode_day(device_ids, epochs, latitudes, longitudes, elevations):
+    """Column arrays of one archive day from per-row arrays (in any order)."""
+    values = np.column_stack([
+        np.asarray(epochs, dtype=np.int64),
+        np.round(np.asarray(latitudes, dtype=np.float64) * COORD_SCALE).astype(np.int64),
+        np.round(np.asarray(longitudes, dtype=np.float64) * COORD_SCALE).astype(np.int64),
+        np.round(np.asarray(elevations, dtype=np.float64) * ELEVATION_SCALE).astype(np.int64),
+    ]) if len(epochs) else np.zeros((0, 4), dtype=np.int64)
+    device_ids = np.asarray(device_ids, dtype=str)
+    order = np.lexsort((values[:, 0], device_ids))
+    device_ids, values = device_ids[order], values[order]
+    # Identical fixes (a row archived twice by an interrupted run, or a resent fix) are kept once.
+    duplicate = np.zeros(len(values), dtype=bool)
+    duplicate[1:] = (device_ids[1:] == device_ids[:-1]) & (values[1:] == values[:-1]).all(axis=1)
+    device_ids, values = device_ids[~duplicate], values[~duplicate]
+    devices, starts = np.unique(device_ids, return_index=True)
+    offsets = np.append(starts, len(device_ids)).astype(np.int64)
+    deltas = np.diff(values, axis=0, prepend=values[:1])
+    # Each device starts from its base row, not from the previous device's last row.
+    deltas[starts] = 0
+    arrays = {'devices': devices, 'offsets': offsets, 'base': values[starts]}
+    for i, column in enumerate(COLUMNS):
+        arrays[column] = narrowest(deltas[:, i])
+    return arrays
+
+
+def decode_device(arrays, index):
+    """(epochs, latitudes, longitudes, elevations) of the index-th device of a day."""
+    start, end = int(arrays['offsets'][index]), int(arrays['offsets'][index + 1])
+    base = arrays['base'][index]
+    columns = [base[i] + np.cumsum(arrays[column][start:end], dtype=np.int64) for i, column in enumerate(COLUMNS)]
+    return (columns[0], columns[1] / COORD_SCALE, columns[2] / COORD_SCALE, columns[3] / ELEVATION_SCALE)
+
+
+def remove_day(path):
+    """Delete a day in either format; an npy day's directory goes along with the link to it."""
+    if os.path.islink(path):
+        target = os.path.join(os.path.dirname(path), os.readlink(path))
+        os.remove(path)
+        shutil.rmtree(target, ignore_errors=True)
+    elif os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def write_day(directory, day, arrays, fmt='npy'):
+    """
+    Write a day atomically: into a temporary name first, then os.replace'd over
+    any previous version, so readers see the old day or the new one, never
+    neither. An npy day is a directory, which can't be replaced that way, so
+    each version goes into a directory of its own ('<day>.<ns>.v') and the
+    day's name is a symlink to it that is replaced instead.
+    """
+    final = os.path.join(directory, day + ('.npz' if fmt == 'npz' else ''))
+    temporary = final + '.tmp'
+    if fmt == 'npz':
+        with open(temporary, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, final)
+    else:
+        version = f'{day}.{time.time_ns()}.v'
+        os.makedirs(os.path.join(directory, version))
+        for name, array in arrays.items():
+            with open(os.path.join(directory, version, name + '.npy'), 'wb') as f:
+                np.save(f, array)
+                f.flush()
+                os.fsync(f.fileno())
+        if os.path.isdir(final) and not os.path.islink(final):
+            # Written before days were links: the one rewrite that can't be atomic.
+            shutil.rmtree(final)
+        if os.path.lexists(temporary):
+            os.remove(temporary)
+        os.symlink(version, temporary)
+        os.replace(temporary, final)
+        # The version just replaced, and any a crash left behind.
+        for name in os.listdir(directory):
+            if name.startswith(day + '.') and name.endswith('.v') and name != version:
+                shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+    # A day written in the other format is now superseded.
+    remove_day(os.path.join(directory, day) if fmt == 'npz' else final + '.npz')
+
+
+class ArchiveReader:
+    def __init__(self, directory=DEFAULT_ARCHIVE_DIR, max_open_days=64):
+        self.directory = directory
+        self.max_open_days = max_open_days
+        self.open_days = {}  # day -> (modification time, arrays), oldest opened first
+
+    def days(self):
+        """Archived days ('YYYY-MM-DD'), oldest first."""
+        if not os.path.isdir(self.directory):
+            return []
+        names = {name[:-4] if name.endswith('.npz') else name for name in os.listdir(self.directory)
+                 if not name.endswith(('.tmp', '.old', '.v'))}
+        return sorted(names)
+
+    def load_day(self, day):
+        path = os.path.join(self.directory, day)
+        if not os.path.isdir(path):
+            path += '.npz'
+        # A day rewritten by the archival job (merged late rows) is opened again.
+        modified = os.stat(path).st_mtime_ns
+        cached = self.open_days.get(day)
+        if cached is not None and cached[0] == modified:
+            return cached[1]
+        if os.path.isdir(path):
+            # Memory-mapped: only the pages a query touches are read from disk.
+            arrays = {name[:-4]: np.load(os.path.join(path, name), mmap_mode='r') for name in os.listdir(path)}
+        else:
+            with np.load(path) as npz:
+                arrays = {name: npz[name] for name in npz.files}
+        self.open_days.pop(day, None)
+        if len(self.open_days) >= self.max_open_days:
+            del self.open_days[next(iter(self.open_days))]
+        self.open_days[day] = (modified, arrays)
+        return arrays
+
+    def forget(self, day):
+        self.open_days.pop(day, None)
+
+    def read(self, device_id, start=None, end=None, limit=None):
+        """
+        A device's archived fixes with start <= epoch <= end (seconds, either may be
+        None), oldest first, as (epochs, latitudes, longitudes, elevations) arrays.
+        Stops after the day in which limit rows have been collected.
+        """
+        first_day = day_of(start) if start is not None else None
+        last_day = day_of(end) if end is not None else None
+        parts, count = [], 0
+        for day in self.days():
+            if (first_day and day < first_day) or (last_day and day > last_day):
+                continue
+            arrays = self.load_day(day)
+            index = int(np.searchsorted(arrays['devices'], str(device_id)))
+            if index >= len(arrays['devices']) or arrays['devices'][index] != str(device_id):
+                continue
+            columns = decode_device(arrays, index)
+            keep = np.ones(len(columns[0]), dtype=bool)
+            if start is not None:
+                keep &= columns[0] >= start
+            if end is not None:
+                keep &= columns[0] <= end
+            parts.append([column[keep] for column in columns])
+            count += int(keep.sum())
+            if limit is not None and count >= limit:
+                break
+        if not parts:
+            return (np.zeros(0, dtype=np.int64),) + tuple(np.zeros(0) for _ in range(3))
+        return tuple(np.concatenate([part[i] for part in parts]) for i in range(4))
+
+    def rows(self, device_id, start=None, end=None, limit=None):
+        """Like read(), as (device_id, longitude, latitude, elevation, datetime) rows."""
+        epochs, latitudes, longitudes, elevations = self.read(device_id, start, end, limit)
+        times = epochs.astype('datetime64[s]').tolist()
+        return list(zip([str(device_id)] * len(times), longitudes.tolist(), latitudes.tolist(), elevations.tolist(), times))
+
+
+def day_of(epoch):
+    return datetime.fromtimestamp(int(epoch), timezone.utc).strftime('%Y-%m-%d')
+
+
+def to_epochs(timestamps):
+    """datetime (or 'YYYY-mm-dd HH:MM:SS') values, taken as UTC, to epoch seconds."""
+    return np.array([np.datetime64(str(t)[:19].replace(' ', 'T'), 's') for t in timestamps]).astype(np.int64)
+
+
+def archive_old_days(conn, directory=DEFAULT_ARCHIVE_DIR, keep_days=DEFAULT_KEEP_DAYS, fmt='npy', dry_run=False):
+    """
+    Move every whole UTC day older than keep_days from sensor_data into the archive.
+    A day is written, synced and renamed into place before its rows are deleted,
+    and only the rows that were read are deleted. Rows that arrive later for an
+    archived day (a device draining an old backlog) are merged in on the next run.
+    """
+    os.makedirs(directory, exist_ok=True)
+    reader = ArchiveReader(directory)
+    cutoff = datetime.now(timezone.utc).date() - timedelta(days=keep_days)
+    cursor = conn.cursor()
+    cursor.execute("SELECT MIN(timestamp) FROM sensor_data")
+    oldest = cursor.fetchone()[0]
+    if oldest is None:
+        print("sensor_data is empty.")
+        return
+    day = datetime.fromisoformat(str(oldest)[:19]).date()
+    archived_rows = 0
+    while day < cutoff:
+        start, end = f"{day} 00:00:00", f"{day + timedelta(days=1)} 00:00:00"
+        cursor.execute("""
+            SELECT id, device_id, longitude, latitude, elevation, timestamp FROM sensor_data
+            WHERE timestamp >= ? AND timestamp < ?
+        """, (start, end))
+        ids, device_ids, longitudes, latitudes, elevations, timestamps = [], [], [], [], [], []
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                ids.append(row[0])
+                device_ids.append(str(row[1]))
+                longitudes.append(row[2])
+                latitudes.append(row[3])
+                elevations.append(row[4])
+                timestamps.append(row[5])
+        if ids:
+            epochs = to_epochs(timestamps)
+            if str(day) in reader.days():
+                # Merge with what an earlier run archived for this day.
+                previous = reader.load_day(str(day))
+                for index, device_id in enumerate(previous['devices']):
+                    columns = decode_device(previous, index)
+                    device_ids.extend([str(device_id)] * len(columns[0]))
+                    epochs = np.concatenate([epochs, columns[0]])
+                    latitudes.extend(columns[1].tolist())
+                    longitudes.extend(columns[2].tolist())
+                    elevations.extend(columns[3].tolist())
+                reader.forget(str(day))
+            print(f"{day}: archiving {len(ids)} rows{' (dry run)' if dry_run else ''}")
+            if not dry_run:
+                write_day(directory, str(day), encode_day(device_ids, epochs, latitudes, longitudes, elevations), fmt)
+                for i in range(0, len(ids), DELETE_BATCH):
+                    batch = ids[i:i + DELETE_BATCH]
+                    cursor.execute(f"DELETE FROM sensor_data WHERE id IN ({', '.join('?' * len(batch))})", batch)
+                conn.commit()
+            archived_rows += len(ids)
+        day += timedelta(days=1)
+    print(f"Archived {archived_rows} rows older than {cutoff} into {directory}.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move old sensor_data rows into the columnar archive.")
+    parser.add_argument('--dir', default=DEFAULT_ARCHIVE_DIR, help="Archive directory")
+    parser.add_argument('--keep-days', type=int, default=DEFAULT_KEEP_DAYS,
+                        help="Whole days of history to keep in sensor_data")
+    parser.add_argument('--format', choices=['npy', 'npz'], default='npy',
+                        help="npy: memory-mappable column files, npz: one compressed file per day")
+    parser.add_argument('--dry-run', action='store_true', help="Only report what would be archived")
+    parser.add_argument('--read', metavar='DEVICE_ID', help="Print a device's archived fixes instead")
+    parser.add_argument('--start', help="With --read: first day (YYYY-MM-DD)")
+    parser.add_argument('--end', help="With --read: last day (YYYY-MM-DD)")
+    args = parser.parse_args()
+
+    if args.read:
+        start = int(datetime.fromisoformat(args.start).replace(tzinfo=timezone.utc).timestamp()) if args.start else None
+        end = int((datetime.fromisoformat(args.end) + timedelta(days=1)).replace(tzinfo=timezone.utc).timestamp()) - 1 if args.end else None
+        for row in ArchiveReader(args.dir).rows(args.read, start, end):
+            print(*row, sep='\t')
+        return
+
+    if args.keep_days < 6:
+        print("Warning: the API reads up to 5 days of history from sensor_data; archiving newer rows hides them.")
+    backend = get_backend()
+    try:
+        conn = backend.connect()
+    except DB_ERRORS as e:
+        print(f"Error connecting to the database: {e}")
+        return
+    try:
+        archive_old_days(conn, args.dir, args.keep_days, args.format, args.dry_run)
+    except DB_ERRORS as e:
+        print(f"Archiving failed: {e}")
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
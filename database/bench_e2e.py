@@ -0,0 +1,355 @@
+"""
+End-to-end benchmark of the ingest and read paths.
+
+Runs the whole pipeline in one process: the TCP ingest server
+(pico_to_db_tcp_v2.Server or AsyncServer) with its DatabaseManager, the
+fan-out channel, and flask_api's Socket.IO handlers through the Socket.IO test
+client. Everything writes to a fresh SQLite file in a temporary directory, so
+no database server is needed and runs are comparable between machines.
+
+While a synthetic fleet (fleet_sim.Fleet) sends fixes over TCP, the benchmark
+measures:
+
+    ingest       messages and fixes sent, rows committed, rows/s, flush stats
+    end_to_end   a probe device sends a fix with a unique elevation and a
+                 client polls get_latest_data until it shows up
+    push         the same fixes, until they arrive as 'live_data' on a
+                 client subscribed to the probe device
+    queries      round trips of get_latest_data (every device) and
+                 get_history_data (one device-day), run alongside the load
+    memory       resident set size before, after and at peak
+
+The results are written as one JSON document, to stdout or --output. With
+--compare, the run is checked against an earlier result and the exit status
+is 1 if throughput dropped or a latency grew by more than --tolerance.
+
+    python3 bench_e2e.py --devices 200 --interval 1 --duration 30
+    python3 bench_e2e.py --server async --format binary --output e2e.json
+    python3 bench_e2e.py --output new.json --compare e2e.json --tolerance 0.2
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+from fleet_sim import Fleet, connect_fleet, encode_fix, send_fleet
+from load_test import raise_fd_limit, start_server
+
+WEBSERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'webserver')
+PROBE_DEVICE = 'bench-probe'
+
+# (path in the result, True if bigger is better) for --compare.
+COMPARED = (
+    (('ingest', 'rows_per_sec'), True),
+    (('end_to_end_ms', 'p50'), False),
+    (('end_to_end_ms', 'p99'), False),
+    (('push_ms', 'p99'), False),
+    (('queries_ms', 'get_latest_data', 'p99'), False),
+    (('queries_ms', 'get_history_data', 'p99'), False),
+    (('memory_mib', 'peak_rss'), False),
+)
+
+
+def summarize(latencies, lost=0):
+    """Percentiles of latencies given in seconds, in milliseconds."""
+    if not latencies:
+        return {'count': 0, 'lost': lost}
+    ordered = sorted(latencies)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * q))] * 1000, 3)
+
+    return {'count': len(ordered), 'lost': lost, 'p50': pick(0.5), 'p90': pick(0.9), 'p99': pick(0.99),
+            'max': round(ordered[-1] * 1000, 3), 'mean': round(sum(ordered) / len(ordered) * 1000, 3)}
+
+
+def rss_mib():
+    """Current resident set size; Linux only."""
+    try:
+        with open('/proc/self/statm') as f:
+            return round(int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20, 1)
+    except OSError:
+        return None
+
+
+def peak_rss_mib():
+    # ru_maxrss is in KiB on Linux and bytes on macOS.
+    scale = 2**20 if sys.platform == 'darwin' else 2**10
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def connect(port, retries=50):
+    for _ in range(retries):
+        try:
+            return socket.create_connection(('127.0.0.1', port))
+        except OSError:
+            time.sleep(0.1)
+    raise SystemExit(f"The ingest server never came up on port {port}.")
+
+
+async def drive_fleet(args, stop, counts):
+    """fleet_sim's replay, without the readout and stopping when stop is set."""
+    fleet = Fleet(args.devices, args.interval, args.seed, first_id=args.first_id)
+    writers, fmt = await connect_fleet(fleet, '127.0.0.1', args.port, args.format)
+    counts['connected'] = len(writers)
+    counts['format'] = fmt
+    counts['started'] = time.monotonic()
+    await send_fleet(fleet, writers, fmt, args.interval, args.batch_every, counts, lambda: not stop.is_set())
+    counts['stopped'] = time.monotonic()
+
+
+def query_load(flask_api, args, stop, latencies):
+    """get_latest_data for every device and get_history_data for one device-day, in turns, at query_rate/s."""
+    client = flask_api.socketio.test_client(flask_api.app)
+    rng = random.Random(args.seed)
+    interval = 1.0 / args.query_rate
+    turn = 0
+    while not stop.is_set():
+        tick = time.monotonic()
+        if turn % 2 == 0:
+            event, payload = 'get_latest_data', {'all': True}
+        else:
+            event, payload = 'get_history_data', {'days': 1, 'device_id': str(args.first_id + rng.randrange(args.devices))}
+        start = time.perf_counter()
+        # The test client runs the handler inline, so this is the full round trip.
+        client.emit(event, payload)
+        latencies[event].append(time.perf_counter() - start)
+        client.get_received()
+        turn += 1
+        stop.wait(max(0.0, tick + interval - time.monotonic()))
+    client.disconnect()
+
+
+def probe(flask_api, port, args, stop):
+    """
+    Send the probe device a fix every probe_interval seconds and time how long
+    it takes to be visible in get_latest_data and to be pushed as live_data.
+    The elevation carries a sequence number that identifies the fix.
+    """
+    sock = connect(port)
+    poller = flask_api.socketio.test_client(flask_api.app)
+    listener = flask_api.socketio.test_client(flask_api.app)
+    listener.emit('subscribe', {'device_id': PROBE_DEVICE})
+    listener.get_received()
+    visible, pushed = [], []
+    lost_visible = lost_pushed = 0
+    sequence = 0
+    while not stop.is_set():
+        sequence += 1
+        marker = float(sequence)
+        start = time.perf_counter()
+        sock.sendall(encode_fix('json', PROBE_DEVICE, 40.955, -76.885, marker, time.time()))
+        seen_at = pushed_at = None
+        deadline = time.monotonic() + args.probe_timeout
+        while (seen_at is None or pushed_at is None) and time.monotonic() < deadline:
+            if seen_at is None:
+                poller.emit('get_latest_data', {'device_id': PROBE_DEVICE})
+                for message in poller.get_received():
+                    if message['name'] == 'latest_data_response' and isinstance(message['args'][0], list) \
+                            and any(row['elevation'] == marker for row in message['args'][0]):
+                        seen_at = time.perf_counter()
+            if pushed_at is None:
+                for message in listener.get_received():
+                    if message['name'] == 'live_data' and any(item['elevation'] == marker for item in message['args'][0]):
+                        pushed_at = time.perf_counter()
+            time.sleep(args.poll_interval / 1000)
+        if seen_at is None:
+            lost_visible += 1
+        else:
+            visible.append(seen_at - start)
+        if pushed_at is None:
+            lost_pushed += 1
+        else:
+            pushed.append(pushed_at - start)
+        stop.wait(max(0.0, start + args.probe_interval - time.perf_counter()))
+    sock.close()
+    poller.disconnect()
+    listener.disconnect()
+    return summarize(visible, lost_visible), summarize(pushed, lost_pushed)
+
+
+def run(args, directory):
+    db_path = os.path.join(directory, 'bench.db')
+    os.environ['STORAGE_BACKEND'] = 'sqlite'
+    os.environ['SQLITE_PATH'] = db_path
+    # flask_api builds its pool from the environment at import time.
+    sys.path.insert(0, WEBSERVER_DIR)
+    import flask_api
+    from fanout import FanoutPublisher
+    from pico_to_db_tcp_v2 import DatabaseManager
+    from storage import SQLiteBackend
+
+    fanout_path = os.path.join(directory, 'fanout.sock')
+    flask_api.FANOUT_PATH = fanout_path
+    flask_api.start_fanout_listener()
+    rss_start = rss_mib()
+
+    db_manager = DatabaseManager(batch_size=args.batch_size, flush_interval_ms=args.flush_interval_ms,
+                                 publisher=FanoutPublisher(fanout_path), backend=SQLiteBackend(db_path))
+    args.port = args.port or free_port()
+    start_server(args.server, args.port, args.devices + 10, db_manager)
+    connect(args.port).close()
+
+    stop = threading.Event()
+    counts = {'messages': 0, 'fixes': 0, 'dropped': 0, 'connected': 0, 'format': args.format}
+    fleet_thread = threading.Thread(target=lambda: asyncio.run(drive_fleet(args, stop, counts)), daemon=True)
+    query_latencies = {'get_latest_data': [], 'get_history_data': []}
+    query_thread = threading.Thread(target=query_load, args=(flask_api, args, stop, query_latencies), daemon=True)
+    fleet_thread.start()
+    if args.query_rate > 0:
+        query_thread.start()
+    threading.Timer(args.duration, stop.set).start()
+    end_to_end, push = probe(flask_api, args.port, args, stop)
+    fleet_thread.join()
+    if query_thread.is_alive():
+        query_thread.join()
+
+    # Rows still buffered or in flight count against throughput, so wait for them.
+    probes = end_to_end['count'] + end_to_end['lost']
+    drain_start = time.monotonic()
+    while time.monotonic() - drain_start < args.drain_timeout:
+        stats = db_manager.flush_stats()
+        if stats['rows_inserted'] + stats['rows_failed'] >= counts['fixes'] + probes:
+            break
+        time.sleep(0.05)
+    drained = time.monotonic()
+    stats = db_manager.flush_stats()
+    publisher = db_manager.publisher
+    fanout = {'published': publisher.published, 'dropped': publisher.dropped}
+    db_manager.close()
+
+    elapsed = drained - counts.get('started', drain_start)
+    sent_for = counts.get('stopped', drained) - counts.get('started', drain_start)
+    return {
+        'benchmark': 'e2e',
+        'started': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'git': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'compare', 'tolerance')},
+        'ingest': {
+            'format': counts['format'],
+            'connected': counts['connected'],
+            'connections_dropped': counts['dropped'],
+            'messages_sent': counts['messages'],
+            'fixes_sent': counts['fixes'],
+            'rows_inserted': stats['rows_inserted'],
+            'rows_failed': stats['rows_failed'],
+            'rows_pending': stats['pending'],
+            'messages_per_sec': round(counts['messages'] / sent_for, 1) if sent_for > 0 else 0.0,
+            'rows_per_sec': round(stats['rows_inserted'] / elapsed, 1) if elapsed > 0 else 0.0,
+            'drain_s': round(drained - drain_start, 3),
+            'flushes': stats['flushes'],
+            'avg_batch': round(stats['avg_batch'], 1),
+            'avg_flush_ms': round(stats['avg_flush_ms'], 3),
+            'largest_batch': stats['largest_batch'],
+        },
+        'end_to_end_ms': end_to_end,
+        'push_ms': push,
+        'queries_ms': {event: summarize(latencies) for event, latencies in query_latencies.items()},
+        'fanout': fanout,
+        'caches': {cache.name: cache.stats() for cache in flask_api.CACHES},
+        'memory_mib': {'rss_start': rss_start, 'rss_end': rss_mib(), 'peak_rss': peak_rss_mib(),
+                       'database_files': round(sum(os.path.getsize(path) for path in (db_path, db_path + '-wal')
+                                                   if os.path.exists(path)) / 2**20, 1)},
+    }
+
+
+def lookup(result, path):
+    for key in path:
+        if not isinstance(result, dict) or key not in result:
+            return None
+        result = result[key]
+    return result
+
+
+def compare(result, baseline, tolerance):
+    """Lines describing every compared metric that got worse by more than tolerance."""
+    regressions = []
+    for path, higher_is_better in COMPARED:
+        new, old = lookup(result, path), lookup(baseline, path)
+        if not new or not old:
+            continue
+        change = (new - old) / old
+        if (-change if higher_is_better else change) > tolerance:
+            regressions.append(f"{'.'.join(path)}: {old} -> {new} ({change:+.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ingest through to the Socket.IO API.")
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--interval', type=float, default=1.0, help="Seconds between a device's fixes")
+    parser.add_argument('--duration', type=float, default=20.0, help="Seconds of load")
+    parser.add_argument('--format', choices=['json', 'binary', 'batch'], default='json')
+    parser.add_argument('--batch-every', type=int, default=10, help="Fixes per message in batch format")
+    parser.add_argument('--server', choices=['thread', 'async'], default='thread')
+    parser.add_argument('--port', type=int, default=0, help="Ingest port (default: any free port)")
+    parser.add_argument('--batch-size', type=int, default=100, help="DatabaseManager batch size")
+    parser.add_argument('--flush-interval-ms', type=int, default=500, help="DatabaseManager flush interval")
+    parser.add_argument('--probe-interval', type=float, default=0.25, help="Seconds between probe fixes")
+    parser.add_argument('--probe-timeout', type=float, default=5.0, help="Seconds before a probe fix counts as lost")
+    parser.add_argument('--poll-interval', type=float, default=2.0, help="Milliseconds between get_latest_data polls")
+    parser.add_argument('--query-rate', type=float, default=20.0, help="API queries per second alongside the load; 0 for none")
+    parser.add_argument('--drain-timeout', type=float, default=30.0, help="Seconds to wait for buffered rows after the load")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--first-id', type=int, default=1, help="Id of the first fleet device")
+    parser.add_argument('--output', help="Write the JSON result here instead of stdout")
+    parser.add_argument('--compare', help="Earlier JSON result to check this run against")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="Allowed relative change for --compare")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    with tempfile.TemporaryDirectory() as directory:
+        # The servers log every message; keep that out of the result.
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            result = run(args, directory)
+
+    document = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(document + '\n')
+    else:
+        print(document)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        differing = [key for key, value in result['config'].items()
+                     if key != 'port' and baseline.get('config', {}).get(key) != value]
+        if differing:
+            print(f"Note: the baseline ran with different {', '.join(differing)}.", file=sys.stderr)
+        regressions = compare(result, baseline, args.tolerance)
+        for line in regressions:
+            print(f"Regression: {line}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
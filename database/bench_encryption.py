@@ -0,0 +1,164 @@
+"""
+Benchmark encrypted against plaintext telemetry ingest.
+
+Builds the byte stream a fleet of Picos would send, as JSON batches or binary
+records of --batch fixes per message, in plaintext and wrapped in encrypted
+frames (see telemetry_codec), and measures fixes per second through:
+
+    decode   StreamDecoder and decode_frame in-process, fed recv()-sized
+             chunks: the CPU-bound part of ingest, without the network
+    server   the same bytes over TCP into Server or AsyncServer, with a
+             database stand-in that only counts rows
+
+For comparison, the decode benchmark also runs encrypted streams the way
+AESCryptor used to decrypt them: a new cipher object per message and a copy
+to strip the padding.
+
+    python3 bench_encryption.py
+    python3 bench_encryption.py --batch 50 --fixes 200000
+    python3 bench_encryption.py --server async --connections 50
+"""
+import argparse
+import random
+import socket
+import threading
+import time
+
+from Crypto.Cipher import AES
+
+from fleet_sim import encode_batch
+from load_test import CountingDatabaseManager
+from pico_to_db_tcp_v2 import AsyncServer, Keyring, Server, decode_frame, decode_plaintext
+from stream_decoder import StreamDecoder
+from telemetry_codec import ENCRYPTED_HEADER, ENCRYPTED_V1, encode_record, encrypted_frame, pad
+
+KEY = b"Your Mom123"
+
+
+def build_messages(fixes, devices, batch, fmt):
+    """fixes spread over devices, batch fixes per message."""
+    rng = random.Random(1)
+    epoch = int(time.time()) - fixes
+    messages = []
+    for first in range(0, fixes, batch):
+        device_id = 1 + (first // batch) % devices
+        points = [(40.955 + rng.uniform(-0.05, 0.05), -76.885 + rng.uniform(-0.05, 0.05), 132.6, epoch + first + k)
+                  for k in range(min(batch, fixes - first))]
+        if fmt == 'binary':
+            messages.append(b''.join(encode_record(device_id, *point) for point in points))
+        else:
+            messages.append(encode_batch(device_id, points))
+    return messages
+
+
+def encrypt(messages, key=KEY):
+    cipher = AES.new(pad(key), AES.MODE_ECB)
+    return [encrypted_frame(cipher.encrypt(pad(message))) for message in messages]
+
+
+def legacy_decode(frame, session):
+    """The old path: AES.new for every message and bytes slicing to unpad."""
+    if frame[0] != ENCRYPTED_V1:
+        return decode_frame(frame, session)
+    rows = []
+    pos = 0
+    while pos < len(frame):
+        _, length = ENCRYPTED_HEADER.unpack_from(frame, pos)
+        ciphertext = frame[pos + ENCRYPTED_HEADER.size:pos + ENCRYPTED_HEADER.size + length]
+        pos += ENCRYPTED_HEADER.size + length
+        plaintext = AES.new(pad(KEY), AES.MODE_ECB).decrypt(ciphertext)
+        rows.extend(decode_plaintext(plaintext[:-plaintext[-1]]))
+    return rows, None
+
+
+def decode_throughput(stream, decode, chunk, repeat):
+    """Best of repeat runs, in fixes per second."""
+    best = 0.0
+    for _ in range(repeat):
+        session = Keyring(KEY).new_session()
+        decoder = StreamDecoder()
+        rows = 0
+        start = time.perf_counter()
+        for i in range(0, len(stream), chunk):
+            for frame in decoder.feed(stream[i:i + chunk]):
+                rows += len(decode(frame, session)[0])
+        best = max(best, rows / (time.perf_counter() - start))
+    return best
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def server_throughput(mode, messages, connections, expected, timeout=120.0):
+    """Fixes per second from the first byte sent until the server has queued them all."""
+    db_manager = CountingDatabaseManager()
+    port = free_port()
+    if mode == 'async':
+        server = AsyncServer('127.0.0.1', port, db_manager=db_manager, keyring=Keyring(KEY))
+    else:
+        server = Server('127.0.0.1', port, db_manager=db_manager, keyring=Keyring(KEY))
+    threading.Thread(target=server.start, daemon=True).start()
+    socks = []
+    for _ in range(connections):
+        for _ in range(50):
+            try:
+                socks.append(socket.create_connection(('127.0.0.1', port)))
+                break
+            except OSError:
+                time.sleep(0.1)
+    streams = [b''.join(messages[i::connections]) for i in range(connections)]
+    start = time.perf_counter()
+    senders = [threading.Thread(target=sock.sendall, args=(stream,)) for sock, stream in zip(socks, streams)]
+    for sender in senders:
+        sender.start()
+    deadline = time.monotonic() + timeout
+    while db_manager.inserted < expected and time.monotonic() < deadline:
+        time.sleep(0.005)
+    elapsed = time.perf_counter() - start
+    for sender in senders:
+        sender.join()
+    for sock in socks:
+        sock.close()
+    if db_manager.inserted < expected:
+        print(f"  (only {db_manager.inserted} of {expected} fixes arrived)")
+    return db_manager.inserted / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark encrypted vs. plaintext telemetry ingest.")
+    parser.add_argument('--fixes', type=int, default=50000)
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--batch', type=int, default=1, help="Fixes per message; 1 is live reporting, 50 a drained backlog")
+    parser.add_argument('--chunk', type=int, default=1024, help="Bytes per recv() in the decode benchmark")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--server', choices=['none', 'thread', 'async'], default='thread',
+                        help="Also push the streams through this server over TCP")
+    parser.add_argument('--connections', type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{args.fixes} fixes, {args.batch} per message, {args.chunk}-byte reads")
+    header = f"  {'stream':<38}{'bytes':>10}{'decode fixes/s':>16}"
+    if args.server != 'none':
+        header += f"{args.server + ' server fixes/s':>22}"
+    print(header)
+    for fmt in ('json', 'binary'):
+        plain = build_messages(args.fixes, args.devices, args.batch, fmt)
+        encrypted = encrypt(plain)
+        cases = (
+            (f"{fmt}", plain, decode_frame),
+            (f"{fmt}, encrypted", encrypted, decode_frame),
+            (f"{fmt}, encrypted, cipher per message", encrypted, legacy_decode),
+        )
+        for name, messages, decode in cases:
+            stream = b''.join(messages)
+            line = f"  {name:<38}{len(stream):>10}{decode_throughput(stream, decode, args.chunk, args.repeat):>16.0f}"
+            if args.server != 'none' and decode is decode_frame:
+                line += f"{server_throughput(args.server, messages, args.connections, args.fixes):>22.0f}"
+            print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""
+Benchmark the geofence check against a large set of fences.
+
+Scatters --fences circles and polygons over the fleet_sim home area, most of
+them for a single device and --shared of them for every device, then runs
+fleet_sim tracks through GeofenceEngine.evaluate and reports fixes per second,
+the time to check a single fix, and how many enter/exit events came out.
+A sample of fixes is also checked against every fence by brute force, to
+confirm the grid index finds exactly the fences a full scan does.
+
+    python3 bench_geofence.py
+    python3 bench_geofence.py --fences 50000 --devices 5000 --cell-deg 0.005
+    python3 bench_geofence.py --fences 10000 --write-fences /tmp/fences.json
+"""
+import argparse
+import json
+import math
+import random
+import time
+
+from fleet_sim import HOME, METRES_PER_DEGREE_LAT, METRES_PER_DEGREE_LON, Fleet
+from geofence import DEFAULT_CELL_DEG, GeofenceEngine, GridIndex, parse_fence
+
+
+def random_fences(count, devices, shared, radius_m=5000.0, seed=1):
+    """Fence specs in the file format, scattered within radius_m of HOME."""
+    rng = random.Random(seed)
+    home_lat, home_lon = HOME
+    lon_scale = METRES_PER_DEGREE_LON * math.cos(math.radians(home_lat))
+    specs = []
+    for i in range(count):
+        angle = rng.uniform(0, 2 * math.pi)
+        distance = radius_m * math.sqrt(rng.random())
+        lat = home_lat + distance * math.sin(angle) / METRES_PER_DEGREE_LAT
+        lon = home_lon + distance * math.cos(angle) / lon_scale
+        spec = {"id": f"fence-{i}"}
+        if rng.random() >= shared:
+            spec["devices"] = [str(rng.randint(1, devices))]
+        if rng.random() < 0.5:
+            spec["circle"] = {"longitude": lon, "latitude": lat, "radius_m": rng.uniform(30, 400)}
+        else:
+            # A star-shaped polygon: vertices at increasing angles and random radii.
+            size = rng.uniform(50, 500)
+            sides = rng.randint(5, 12)
+            vertices = []
+            for k in range(sides):
+                theta = 2 * math.pi * k / sides
+                r = size * rng.uniform(0.5, 1.0)
+                vertices.append([lon + r * math.cos(theta) / lon_scale, lat + r * math.sin(theta) / METRES_PER_DEGREE_LAT])
+            spec["polygon"] = vertices
+        specs.append(spec)
+    return specs
+
+
+def fleet_rows(fleet, steps, start_epoch):
+    """(device_id, lon, lat, elev, timestamp) rows, one list per step."""
+    ids = [str(device_id) for device_id in fleet.ids]
+    batches = []
+    for step in range(steps):
+        lats, lons, elevs = fleet.step()
+        timestamp = time.strftime('%Y-%m-%d %H:%M:%S.000000',
+                                  time.gmtime(start_epoch + step * fleet.interval))
+        batches.append([(device_id, float(lon), float(lat), float(elev), timestamp)
+                        for device_id, lon, lat, elev in zip(ids, lons, lats, elevs)])
+    return batches
+
+
+def brute_force(fences, device_id, longitude, latitude):
+    return frozenset(fence.id for fence in fences
+                     if (fence.devices is None or device_id in fence.devices) and fence.contains(longitude, latitude))
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark geofence enter/exit detection.")
+    parser.add_argument('--fences', type=int, default=10000)
+    parser.add_argument('--devices', type=int, default=1000)
+    parser.add_argument('--shared', type=float, default=0.1, help="Share of fences that apply to every device")
+    parser.add_argument('--steps', type=int, default=100, help="Fleet steps to evaluate; each is one fix per device")
+    parser.add_argument('--interval', type=float, default=30.0, help="Seconds between a device's fixes")
+    parser.add_argument('--cell-deg', type=float, default=DEFAULT_CELL_DEG)
+    parser.add_argument('--check', type=int, default=2000, help="Fixes to compare against a brute-force scan")
+    parser.add_argument('--write-fences', help="Also save the generated fences to this file")
+    args = parser.parse_args()
+
+    specs = random_fences(args.fences, args.devices, args.shared)
+    if args.write_fences:
+        with open(args.write_fences, 'w') as f:
+            json.dump(specs, f)
+    fences = [parse_fence(spec) for spec in specs]
+    start = time.perf_counter()
+    engine = GeofenceEngine(fences, cell_deg=args.cell_deg)
+    build_ms = (time.perf_counter() - start) * 1000
+    cells = sum(len(grid) for grid in engine.index.grids.values())
+    print(f"{args.fences} fences ({args.shared:.0%} shared), {args.devices} devices, "
+          f"index of {cells} cells built in {build_ms:.0f} ms")
+
+    fleet = Fleet(args.devices, interval=args.interval)
+    batches = fleet_rows(fleet, args.steps + 1, int(time.time()) - 86400)
+    # The first step only records where every device starts.
+    engine.evaluate(batches[0])
+
+    fixes = 0
+    events = []
+    start = time.perf_counter()
+    for batch in batches[1:]:
+        events.extend(engine.evaluate(batch))
+        fixes += len(batch)
+    elapsed = time.perf_counter() - start
+    enters = sum(1 for event in events if event['event'] == 'enter')
+    print(f"  batched    {fixes / elapsed:>12.0f} fixes/s   {elapsed / fixes * 1e6:.1f} us/fix   "
+          f"{enters} enter, {len(events) - enters} exit events")
+
+    # One fix per call, as a single live report arrives.
+    engine.state.clear()
+    engine.evaluate(batches[0])
+    timings = []
+    for batch in batches[1:]:
+        for row in batch:
+            t0 = time.perf_counter()
+            engine.evaluate((row,))
+            timings.append(time.perf_counter() - t0)
+    timings.sort()
+    print(f"  per fix    {len(timings) / sum(timings):>12.0f} fixes/s   p50 {percentile(timings, 0.5) * 1e6:.1f} us   "
+          f"p99 {percentile(timings, 0.99) * 1e6:.1f} us   max {timings[-1] * 1e6:.1f} us")
+
+    rows = [row for batch in batches[1:] for row in batch]
+    sample = random.Random(2).sample(rows, min(args.check, len(rows)))
+    index = GridIndex(fences, args.cell_deg)
+    start = time.perf_counter()
+    for device_id, lon, lat, _, _ in sample:
+        expected = brute_force(fences, device_id, lon, lat)
+        found = index.containing(device_id, lon, lat)
+        assert found == expected, f"{device_id} at {lon}, {lat}: index {sorted(found)}, scan {sorted(expected)}"
+    scan_per_fix = (time.perf_counter() - start) / len(sample)
+    print(f"  full scan  {1 / scan_per_fix:>12.0f} fixes/s   (index matched it on {len(sample)} fixes)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""
+Benchmark ingest and query throughput of the storage backends.
+
+Writes a synthetic fleet through the same calls DatabaseManager.flush makes
+(insert_fixes plus the device_latest upsert, one commit per batch), then times
+the API's read queries: a latest-position lookup, every device's latest
+position, and one day of a device's history.
+
+SQLite runs against a fresh file in a temporary directory. MariaDB uses the
+database configured in secret.py, which has to be migrated already; the
+benchmark's rows use 'bench-' device ids and are deleted afterwards.
+
+    python3 bench_storage.py --backends sqlite
+    python3 bench_storage.py --backends sqlite mariadb --rows 200000 --batch-size 500
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from migrate_db import LATEST_TABLE_VERSION, check_schema_version, migrate
+from storage import DB_ERRORS, SQLiteBackend, get_backend
+from telemetry_codec import format_epoch
+
+DEVICE_PREFIX = 'bench-'
+
+
+def synthetic_rows(count, devices, start_epoch):
+    """count fixes spread over devices, one every 10 s per device, oldest first."""
+    rows = []
+    for i in range(count):
+        device = i % devices
+        epoch = start_epoch + (i // devices) * 10
+        rows.append((f"{DEVICE_PREFIX}{device}", -76.885 + random.uniform(-0.05, 0.05),
+                     40.955 + random.uniform(-0.05, 0.05), 132.6, format_epoch(epoch)))
+    return rows
+
+
+def ingest(backend, conn, rows, batch_size):
+    """Rows per second with one commit per batch_size rows."""
+    cursor = conn.cursor()
+    start = time.perf_counter()
+    for i in range(0, len(rows), batch_size):
+        batch = rows[i:i + batch_size]
+        backend.insert_fixes(cursor, batch)
+        backend.upsert_latest(cursor, batch)
+        conn.commit()
+    return len(rows) / (time.perf_counter() - start)
+
+
+def time_queries(conn, query, params_list):
+    """Per-query latencies in milliseconds, and the rows the last one returned."""
+    cursor = conn.cursor()
+    latencies = []
+    rows = []
+    for params in params_list:
+        start = time.perf_counter()
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies, rows
+
+
+def report(name, latencies, rows):
+    latencies = sorted(latencies)
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(f"  {name:<36}{statistics.median(latencies):>10.3f}{p99:>10.3f}{len(latencies) / (sum(latencies) / 1000):>12.0f}{len(rows):>8}")
+
+
+def run(backend, conn, args):
+    random.seed(1)
+    start_epoch = int(time.time()) - args.rows // args.devices * 10
+    rows = synthetic_rows(args.rows, args.devices, start_epoch)
+    single = rows[:args.single_rows]
+    batched = rows[args.single_rows:]
+
+    print(f"\n{backend.name}")
+    for label, part, batch_size in (("1 row", single, 1), (f"{args.batch_size} rows", batched, args.batch_size)):
+        print(f"  {'ingest, ' + label + ' per commit':<36}{ingest(backend, conn, part, batch_size):>12.0f} rows/s")
+
+    devices = [f"{DEVICE_PREFIX}{random.randrange(args.devices)}" for _ in range(args.queries)]
+    print(f"  {'query':<36}{'p50 ms':>10}{'p99 ms':>10}{'queries/s':>12}{'rows':>8}")
+    report('latest, one device', *time_queries(conn, """
+        SELECT device_id, longitude, latitude, elevation, timestamp FROM device_latest WHERE device_id = ?
+    """, [(device,) for device in devices]))
+    report('latest, every device', *time_queries(conn, """
+        SELECT device_id, longitude, latitude, elevation, timestamp FROM device_latest WHERE device_id LIKE ?
+    """, [(DEVICE_PREFIX + '%',)] * max(args.queries // 20, 1)))
+    day_start = format_epoch(start_epoch + (args.rows // args.devices * 10) - 86400)[:19]
+    report('history, one device-day', *time_queries(conn, """
+        SELECT id, device_id, longitude, latitude, elevation, timestamp FROM sensor_data
+        WHERE device_id = ? AND timestamp >= ? ORDER BY timestamp
+    """, [(device, day_start) for device in devices[:max(args.queries // 10, 1)]]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the storage backends.")
+    parser.add_argument('--backends', nargs='+', choices=['sqlite', 'mariadb'], default=['sqlite'])
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--batch-size', type=int, default=100, help="Rows per commit, like --batch-size on the ingest server")
+    parser.add_argument('--single-rows', type=int, default=1000, help="Rows first written one commit each, for comparison")
+    parser.add_argument('--queries', type=int, default=1000)
+    args = parser.parse_args()
+
+    for name in args.backends:
+        if name == 'sqlite':
+            with tempfile.TemporaryDirectory() as directory:
+                backend = SQLiteBackend(os.path.join(directory, 'bench.db'))
+                conn = backend.connect()
+                migrate(conn, backend, quiet=True)
+                run(backend, conn, args)
+                conn.close()
+            continue
+        backend = get_backend(name)
+        try:
+            conn = backend.connect()
+        except DB_ERRORS as e:
+            print(f"\nSkipping {name}: {e}")
+            continue
+        if check_schema_version(conn) < LATEST_TABLE_VERSION:
+            print(f"Skipping {name}: run migrate_db.py first.")
+            conn.close()
+            continue
+        try:
+            run(backend, conn, args)
+        finally:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM sensor_data WHERE device_id LIKE ?", (DEVICE_PREFIX + '%',))
+            cursor.execute("DELETE FROM device_latest WHERE device_id LIKE ?", (DEVICE_PREFIX + '%',))
+            conn.commit()
+            conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Self-check for StreamDecoder.
+
+Feeds a stream that mixes every framing with long runs of garbage (lines that
+open an object and never close it, bytes that start no frame, an oversized
+object) and checks that exactly the good frames come out, in order, whether
+the stream arrives in one piece or in reads of any size. A few thousand bad
+lines in a row used to exhaust the recursion limit.
+
+    python3 check_stream_decoder.py
+"""
+from stream_decoder import LENGTH_HEADER, LENGTH_PREFIX, StreamDecoder
+from telemetry_codec import BINARY_V1, encode_record
+
+
+def build_stream(garbage_lines):
+    good = [
+        b'{"device_id": "1", "longitude": "-76.88", "latitude": "40.95"}',
+        b'{"device_id": "2", "nested": {"a": "}{"}}',
+        LENGTH_HEADER.pack(LENGTH_PREFIX, 9) + b'{"x": 1}\n',
+        encode_record(3, 40.95, -76.88, 132.6, 1700000000) + encode_record(4, 40.96, -76.87, 130.0, 1700000001),
+    ]
+    expected = [good[0], good[1], b'{"x": 1}\n', good[3]]
+    garbage = b'{\n' * garbage_lines + b'junk\n' * garbage_lines + b'\x7f' * garbage_lines
+    # Resyncing after garbage looks for the next '{', so the binary framings follow a JSON frame.
+    stream = (good[0] + b'\n' + garbage + good[1] + b'\n' + good[2] + good[3] + garbage + good[0] + b'\n'
+              + b'{' * 10 + b'"' + b'y' * 70000 + b'\n' + good[0] + b'\n')
+    return stream, expected + [good[0], good[0]]
+
+
+def decode(stream, size):
+    decoder = StreamDecoder()
+    frames = []
+    for i in range(0, len(stream), size):
+        for frame in decoder.feed(stream[i:i + size]):
+            # A run of binary records split across reads comes out as several runs.
+            if frames and frame[0] == BINARY_V1 and frames[-1][0] == BINARY_V1:
+                frames[-1] += frame
+            else:
+                frames.append(frame)
+    return frames, decoder
+
+
+def main():
+    stream, expected = build_stream(5000)
+    for size in (len(stream), 65536, 4096, 1000, 37):
+        frames, decoder = decode(stream, size)
+        assert frames == expected, (size, frames[:5])
+        assert decoder.pending() == 0, size
+        assert decoder.errors >= 2 * 5000, decoder.errors
+    # Every read size on a short stream, so frames are split at every offset.
+    stream, expected = build_stream(3)
+    stream = stream.replace(b'y' * 70000, b'y' * 10)
+    for size in range(1, 200):
+        assert decode(stream, size)[0] == expected, size
+    print("StreamDecoder: good frames recovered around 15,000 bad lines and bytes, at every read size")
+
+
+if __name__ == '__main__':
+    main()
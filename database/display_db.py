@@ -1,59 +1,49 @@
-import mariadb
 import json
-import secret
-from tabulate import tabulate
+import sys
+from contextlib import closing
+from datetime import datetime, timezone
+from export_db import export
+from migrate_db import LATEST_TABLE_VERSION, current_version
+from storage import CREATE_SENSOR_DATA, DB_ERRORS, get_backend
 import threading
 
+backend = get_backend()
+
 def initialize_database():
     """
-    Initialize the MariaDB database and the sensor_data table if it doesn't exist.
-    This function connects to the MariaDB server using credentials stored in a separate 'secret' module,
-    ensuring sensitive information is not hardcoded in the script.
+    Initialize the database and the sensor_data table if it doesn't exist.
+    The storage backend (see storage.py) reads its settings from the separate
+    'secret' module, ensuring sensitive information is not hardcoded in the script.
     """
     try:
-        # Connect to MariaDB
-        with mariadb.connect(
-            host=secret.dbhost,
-            database=secret.db,
-            user=secret.user,
-            password=secret.password) as conn:
+        with closing(backend.connect()) as conn:
             cursor = conn.cursor()
             # SQL statement to create the table if it does not exist
-            create_table_sql = """
-            CREATE TABLE IF NOT EXISTS sensor_data (
-                id INT AUTO_INCREMENT PRIMARY KEY,
-                device_id VARCHAR(255) NOT NULL,
-                longitude DOUBLE NOT NULL,
-                latitude DOUBLE NOT NULL,
-                elevation DOUBLE NOT NULL,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-            """
-            cursor.execute(create_table_sql)
-            conn.close()
-    except mariadb.Error as e:
-        print(f"Error connecting to MariaDB: {e}")
+            cursor.execute(backend.sql(CREATE_SENSOR_DATA))
+            conn.commit()
+    except DB_ERRORS as e:
+        print(f"Error connecting to the database: {e}")
 
 def insert_data_into_database(data_batch):
     """
-    Inserts a batch of sensor data into the MariaDB database.
+    Inserts a batch of sensor data into the database.
     This function is designed to run in a separate thread to avoid blocking the MQTT client.
     """
     try:
-        # Connect to MariaDB
-        with mariadb.connect(
-            host=secret.dbhost,
-            database=secret.db,
-            user=secret.user,
-            password=secret.password) as conn:
+        with closing(backend.connect()) as conn:
             cursor = conn.cursor()
-            # Insert each data point in the batch into the database
-            for data in data_batch:
-                cursor.execute("INSERT INTO sensor_data (device_id, longitude, latitude, elevation) VALUES (?, ?, ?, ?)",
-                               (data['device_id'], data['longitude'], data['latitude'], data['elevation']))
-            conn.close()
-    except mariadb.Error as e:
-        print(f"Error inserting data into MariaDB: {e}")
+            # Every row gets an explicit timestamp, as ingest gives it: the data's
+            # own if it has one, otherwise now, in naive UTC like the rest of the table.
+            now = datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)
+            rows = [(data['device_id'], data['longitude'], data['latitude'], data['elevation'],
+                     datetime.fromisoformat(data['timestamp']) if data.get('timestamp') else now)
+                    for data in data_batch]
+            backend.insert_fixes(cursor, rows)
+            if current_version(conn) >= LATEST_TABLE_VERSION:
+                backend.upsert_latest(cursor, rows)
+            conn.commit()
+    except DB_ERRORS as e:
+        print(f"Error inserting data into the database: {e}")
 
 def read_json():
     """
@@ -66,34 +56,25 @@ def read_json():
 
 def read_db():
     """
-    Reads data from the sensor_data table and prints it out.
+    Prints the sensor_data table. Rows are streamed in batches, so this starts
+    printing right away and doesn't hold the table in memory; export_db.py has
+    the filters and the CSV/NDJSON formats.
     """
     try:
-        with mariadb.connect(
-            host=secret.dbhost,
-            database=secret.db,
-            user=secret.user,
-            password=secret.password) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT id, device_id, longitude, latitude, elevation, timestamp FROM sensor_data")
-            data = cursor.fetchall()
-            print(tabulate(data, headers=['ID', 'Device ID', 'Longitude', 'Latitude', 'Elevation', 'Timestamp'], tablefmt='pretty'))
-    except mariadb.Error as e:
-        print(f"Error reading from MariaDB: {e}")
+        with closing(backend.connect()) as conn:
+            export(conn, sys.stdout, 'table')
+    except DB_ERRORS as e:
+        print(f"Error reading from the database: {e}")
 
 def change_table():
     try:
-        with mariadb.connect(
-            host=secret.dbhost,
-            database=secret.db,
-            user=secret.user,
-            password=secret.password) as conn:
+        with closing(backend.connect()) as conn:
             cursor = conn.cursor()
             cursor.execute("ALTER TABLE sensor_data RENAME TO sensor_data_old")
             #data = cursor.fetchall()
             #print(tabulate(data, headers=['ID', 'Accessory ID', 'Longitude', 'Latitude', 'Elevation', 'Timestamp'], tablefmt='pretty'))
-    except mariadb.Error as e:
-        print(f"Error reading from MariaDB: {e}")
+    except DB_ERRORS as e:
+        print(f"Error reading from the database: {e}")
 
 
 def main():
@@ -0,0 +1,186 @@
+"""
+Stream sensor_data out as CSV, NDJSON or a plain-text table.
+
+Rows are read through an unbuffered (server-side) cursor and written batch by
+batch, so memory stays flat and the first rows appear right away however big
+the table is. A progress line with the row count and throughput goes to
+stderr, so it never ends up in the exported file.
+
+    python3 export_db.py                                   # table to the terminal
+    python3 export_db.py --format csv --output fixes.csv
+    python3 export_db.py --format ndjson --device 1 --device 2 --start 2024-03-01 --end 2024-03-08
+"""
+import argparse
+import csv
+import json
+import sys
+import time
+
+from storage import DB_ERRORS, get_backend
+
+COLUMNS = ('id', 'device_id', 'longitude', 'latitude', 'elevation', 'timestamp')
+HEADERS = ('ID', 'Device ID', 'Longitude', 'Latitude', 'Elevation', 'Timestamp')
+# Fixed widths, since a streamed table can't look ahead at the widest value.
+TABLE_WIDTHS = (10, 12, 14, 14, 10, 19)
+
+
+def format_timestamp(value, sep='T'):
+    """
+    A row's timestamp as ISO 8601 text. A NULL stays None (an empty CSV field,
+    null in JSON), and text, which SQLite hands back for a column it couldn't
+    convert, is passed through with sep between date and time.
+    """
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return value.replace(' ', sep, 1) if len(value) > 10 and value[10] in ' T' else value
+    return value.isoformat(sep)
+
+
+class CsvWriter:
+    def __init__(self, out):
+        self.writer = csv.writer(out)
+        self.writer.writerow(COLUMNS)
+
+    def write(self, rows):
+        self.writer.writerows(row[:5] + (format_timestamp(row[5], ' '),) for row in rows)
+
+    def close(self):
+        pass
+
+
+class NdjsonWriter:
+    def __init__(self, out):
+        self.out = out
+
+    def write(self, rows):
+        self.out.write(''.join(json.dumps(dict(zip(COLUMNS, row[:5] + (format_timestamp(row[5]),)))) + '\n' for row in rows))
+
+    def close(self):
+        pass
+
+
+class TableWriter:
+    """Same look as tabulate's 'pretty' format, with fixed column widths."""
+    def __init__(self, out):
+        self.out = out
+        self.rule = '+' + '+'.join('-' * (width + 2) for width in TABLE_WIDTHS) + '+\n'
+        self.out.write(self.rule + self.line(HEADERS) + self.rule)
+
+    def line(self, values):
+        return '|' + '|'.join(f" {str(value):^{width}} " for value, width in zip(values, TABLE_WIDTHS)) + '|\n'
+
+    def write(self, rows):
+        self.out.write(''.join(self.line(row) for row in rows))
+
+    def close(self):
+        self.out.write(self.rule)
+
+
+WRITERS = {'csv': CsvWriter, 'ndjson': NdjsonWriter, 'table': TableWriter}
+
+
+class Progress:
+    """Rewrites one stderr line at most every interval seconds."""
+    def __init__(self, enabled, interval=1.0):
+        self.enabled = enabled
+        self.interval = interval
+        self.start = time.monotonic()
+        self.last = self.start
+        self.rows = 0
+
+    def update(self, count):
+        self.rows += count
+        now = time.monotonic()
+        if self.enabled and now - self.last >= self.interval:
+            self.last = now
+            sys.stderr.write(f"\r{self.rows} rows, {self.rows / (now - self.start):.0f} rows/s")
+            sys.stderr.flush()
+
+    def finish(self):
+        elapsed = time.monotonic() - self.start
+        if self.enabled:
+            sys.stderr.write(f"\r{self.rows} rows in {elapsed:.1f} s ({self.rows / elapsed if elapsed else 0:.0f} rows/s)\n")
+
+
+def build_query(devices=None, start=None, end=None, limit=None):
+    """The SELECT and its parameters. Per-device exports walk the (device_id, timestamp) index."""
+    conditions, params = [], []
+    if devices:
+        conditions.append(f"device_id IN ({', '.join('?' * len(devices))})")
+        params.extend(devices)
+    if start:
+        conditions.append("timestamp >= ?")
+        params.append(start)
+    if end:
+        conditions.append("timestamp <= ?")
+        params.append(end)
+    query = f"SELECT {', '.join(COLUMNS)} FROM sensor_data"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY device_id, timestamp" if devices else " ORDER BY id"
+    if limit:
+        query += " LIMIT ?"
+        params.append(limit)
+    return query, params
+
+
+def export(conn, out, fmt='table', devices=None, start=None, end=None, limit=None, batch_size=1000, progress=False):
+    """Write the matching rows to out. Returns the number of rows written."""
+    query, params = build_query(devices, start, end, limit)
+    cursor = conn.cursor(buffered=False)
+    writer = WRITERS[fmt](out)
+    meter = Progress(progress)
+    try:
+        cursor.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            writer.write(rows)
+            meter.update(len(rows))
+        writer.close()
+        out.flush()
+    finally:
+        cursor.close()
+        meter.finish()
+    return meter.rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export sensor_data without loading it into memory.")
+    parser.add_argument('--format', choices=list(WRITERS), help="Default: table on a terminal, csv otherwise")
+    parser.add_argument('--output', help="File to write (default: stdout)")
+    parser.add_argument('--device', action='append', help="Only this device id; repeat for several")
+    parser.add_argument('--start', help="First timestamp, UTC (YYYY-MM-DD[ HH:MM:SS])")
+    parser.add_argument('--end', help="Last timestamp or day, UTC (YYYY-MM-DD[ HH:MM:SS])")
+    parser.add_argument('--limit', type=int, help="Stop after this many rows")
+    parser.add_argument('--batch-size', type=int, default=1000, help="Rows fetched per round trip")
+    parser.add_argument('--quiet', action='store_true', help="No progress readout")
+    args = parser.parse_args()
+
+    if args.end and len(args.end) == 10:
+        # A bare date means up to the end of that day.
+        args.end += ' 23:59:59'
+    out = open(args.output, 'w', newline='') if args.output else sys.stdout
+    fmt = args.format or ('table' if out.isatty() else 'csv')
+    # A table on the terminal is its own progress readout.
+    progress = not args.quiet and sys.stderr.isatty() and not (out is sys.stdout and sys.stdout.isatty())
+    conn = None
+    try:
+        conn = get_backend().connect()
+        export(conn, out, fmt, args.device, args.start, args.end, args.limit, args.batch_size, progress)
+    except DB_ERRORS as e:
+        print(f"Error reading from the database: {e}", file=sys.stderr)
+    except BrokenPipeError:
+        # Piped into head or similar.
+        pass
+    finally:
+        if conn:
+            conn.close()
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
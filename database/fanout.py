@@ -0,0 +1,87 @@
+"""
+Local fan-out channel from the ingest server to the API.
+
+The ingest server publishes every committed batch of fixes as JSON datagrams
+on a Unix socket, and flask_api binds that socket and pushes the fixes to its
+Socket.IO subscribers. Sending is non-blocking and fire-and-forget: with no
+listener, or a listener that has fallen behind, fixes are dropped from the
+live feed rather than slowing ingest down. They are in the database either way.
+"""
+import json
+import logging
+import os
+import socket
+
+log = logging.getLogger('fanout')
+
+DEFAULT_PATH = '/tmp/gps_tracker_fanout.sock'
+
+# Well under the default Unix datagram limits, so a burst is split, not refused.
+MAX_DATAGRAM = 32 * 1024
+
+
+class FanoutPublisher:
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.published = 0
+        self.dropped = 0
+
+    def publish(self, event, items):
+        """Send items (JSON-serialisable dicts) as one or more datagrams of {"event", "data"}."""
+        chunk, size = [], 0
+        for item in items:
+            encoded = json.dumps(item)
+            if chunk and size + len(encoded) > MAX_DATAGRAM:
+                self.send(event, chunk)
+                chunk, size = [], 0
+            chunk.append(encoded)
+            size += len(encoded) + 1
+        if chunk:
+            self.send(event, chunk)
+
+    def send(self, event, encoded_items):
+        payload = '{"event": %s, "data": [%s]}' % (json.dumps(event), ','.join(encoded_items))
+        try:
+            self.sock.sendto(payload.encode('utf-8'), self.path)
+            self.published += len(encoded_items)
+        except OSError:
+            # No listener bound, or its queue is full.
+            self.dropped += len(encoded_items)
+
+    def close(self):
+        self.sock.close()
+
+
+class FanoutSubscriber:
+    """Binds the channel and calls handler(event, data) for every datagram."""
+    def __init__(self, handler, path=DEFAULT_PATH):
+        self.handler = handler
+        self.path = path
+        self.sock = None
+
+    def bind(self):
+        # A socket file left behind by a previous run would make bind() fail.
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+
+    def serve_forever(self):
+        if self.sock is None:
+            self.bind()
+        while True:
+            payload = self.sock.recv(MAX_DATAGRAM * 2)
+            try:
+                message = json.loads(payload)
+                self.handler(message['event'], message['data'])
+            except Exception as e:
+                log.warning("Error handling fan-out message: %s", e)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            if os.path.exists(self.path):
+                os.unlink(self.path)
@@ -0,0 +1,289 @@
+"""
+Synthetic fleet generator for load tests.
+
+Every device parks and drives in turns around a home area: a random walk
+whose heading drifts slowly, at a per-device speed, with GPS jitter on every
+reported fix. The whole fleet advances one report interval per step with
+NumPy, so generating millions of fixes takes seconds.
+
+Two ways to use the tracks:
+
+    bulk    write days of history straight into the database with
+            executemany (any backend) or LOAD DATA LOCAL INFILE (MariaDB)
+    replay  connect every device to a running ingest server and send fixes
+            in real time, as JSON, binary records or JSON batches
+
+    python3 fleet_sim.py bulk --devices 200 --days 5 --interval 30
+    python3 fleet_sim.py bulk --devices 1000 --days 30 --load-data
+    python3 fleet_sim.py replay --devices 2000 --interval 1 --duration 60 --format binary
+"""
+import argparse
+import asyncio
+import csv
+import math
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from load_test import negotiate_binary, open_connection, raise_fd_limit
+from migrate_db import LATEST_TABLE_VERSION, check_schema_version, migrate, rebuild_latest
+from storage import DB_ERRORS, get_backend
+from telemetry_codec import encode_record
+
+METRES_PER_DEGREE_LAT = 110540.0
+METRES_PER_DEGREE_LON = 111320.0
+# Bucknell University, where the trackers live.
+HOME = (40.95499, -76.88504)
+
+
+class Fleet:
+    """
+    Tracks for devices numbered first_id and up. Mean parked and driving spells
+    are in seconds; speeds are drawn per device between walking and driving.
+    """
+    def __init__(self, devices, interval=30.0, seed=1, home=HOME, radius_m=5000.0, jitter_m=3.0,
+                 mean_parked=1800.0, mean_moving=600.0, first_id=1):
+        self.devices = devices
+        self.interval = interval
+        self.rng = np.random.default_rng(seed)
+        self.home = home
+        self.radius_m = radius_m
+        self.jitter_m = jitter_m
+        self.mean_parked = mean_parked
+        self.mean_moving = mean_moving
+        self.ids = np.arange(first_id, first_id + devices)
+        # Positions in metres from home, so the walk is plain vector arithmetic.
+        angle = self.rng.uniform(0, 2 * np.pi, devices)
+        distance = radius_m * np.sqrt(self.rng.uniform(0, 1, devices))
+        self.x = distance * np.cos(angle)
+        self.y = distance * np.sin(angle)
+        self.heading = self.rng.uniform(0, 2 * np.pi, devices)
+        self.speed = self.rng.uniform(1.4, 15.0, devices)
+        self.moving = self.rng.uniform(0, 1, devices) < mean_moving / (mean_moving + mean_parked)
+        self.elevation = self.rng.normal(140.0, 15.0, devices)
+        # Devices don't all report in the same second.
+        self.phase = self.rng.integers(0, max(int(interval), 1), devices)
+
+    def step(self):
+        """Advance one interval. Returns (latitudes, longitudes, elevations) of the reported fixes."""
+        dt = self.interval
+        switch = self.rng.uniform(0, 1, self.devices) < dt / np.where(self.moving, self.mean_moving, self.mean_parked)
+        self.moving ^= switch
+        self.heading += self.rng.normal(0, 0.3 * math.sqrt(dt / 30.0), self.devices)
+        # Devices that wander past the edge of the area turn back towards home.
+        outside = np.hypot(self.x, self.y) > self.radius_m
+        self.heading[outside] = np.arctan2(-self.y[outside], -self.x[outside])
+        step = np.where(self.moving, self.speed * dt, 0.0)
+        self.x += step * np.sin(self.heading)
+        self.y += step * np.cos(self.heading)
+        x = self.x + self.rng.normal(0, self.jitter_m, self.devices)
+        y = self.y + self.rng.normal(0, self.jitter_m, self.devices)
+        latitudes = self.home[0] + y / METRES_PER_DEGREE_LAT
+        longitudes = self.home[1] + x / (METRES_PER_DEGREE_LON * math.cos(math.radians(self.home[0])))
+        elevations = self.elevation + self.rng.normal(0, 2.0, self.devices)
+        return latitudes, longitudes, elevations
+
+    def history(self, start_epoch, end_epoch):
+        """Yield one list of (device_id, longitude, latitude, elevation, timestamp) rows per step."""
+        steps = int((end_epoch - start_epoch) // self.interval)
+        device_ids = [str(device_id) for device_id in self.ids]
+        for k in range(steps):
+            latitudes, longitudes, elevations = self.step()
+            epochs = (start_epoch + k * self.interval + self.phase).astype('datetime64[s]')
+            timestamps = np.char.replace(np.datetime_as_string(epochs, unit='s'), 'T', ' ').tolist()
+            yield list(zip(device_ids, np.round(longitudes, 7).tolist(), np.round(latitudes, 7).tolist(),
+                           np.round(elevations, 2).tolist(), timestamps))
+
+
+def bulk_load(args):
+    backend = get_backend()
+    fleet = Fleet(args.devices, args.interval, args.seed, first_id=args.first_id)
+    end_epoch = int(time.time())
+    start_epoch = end_epoch - int(args.days * 86400)
+    if args.load_data and backend.name != 'mariadb':
+        print(f"LOAD DATA needs MariaDB; using executemany on {backend.name}.")
+        args.load_data = False
+    try:
+        # LOAD DATA LOCAL INFILE has to be allowed on the client side too.
+        conn = backend.connect(local_infile=True) if args.load_data else backend.connect()
+    except DB_ERRORS as e:
+        print(f"Error connecting to the database: {e}")
+        return
+    try:
+        if backend.embedded:
+            migrate(conn, backend, quiet=True)
+        maintain_latest = check_schema_version(conn) >= LATEST_TABLE_VERSION
+        cursor = conn.cursor()
+        start = time.perf_counter()
+        total = 0
+        if args.load_data:
+            with tempfile.NamedTemporaryFile('w', suffix='.csv', newline='', delete=False) as f:
+                writer = csv.writer(f)
+                for rows in fleet.history(start_epoch, end_epoch):
+                    writer.writerows(rows)
+                    total += len(rows)
+            generated = time.perf_counter() - start
+            try:
+                cursor.execute(f"""
+                    LOAD DATA LOCAL INFILE '{f.name}' INTO TABLE sensor_data
+                    FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '"' LINES TERMINATED BY '\\r\\n'
+                    (device_id, longitude, latitude, elevation, timestamp)
+                """)
+                conn.commit()
+            finally:
+                os.remove(f.name)
+            if maintain_latest:
+                rebuild_latest(conn)
+            print(f"Generated {total} rows in {generated:.1f} s")
+        else:
+            batch = []
+            for rows in fleet.history(start_epoch, end_epoch):
+                batch.extend(rows)
+                if len(batch) >= args.batch_size:
+                    write_batch(backend, conn, cursor, batch, maintain_latest)
+                    total += len(batch)
+                    batch = []
+            if batch:
+                write_batch(backend, conn, cursor, batch, maintain_latest)
+                total += len(batch)
+        elapsed = time.perf_counter() - start
+        print(f"Loaded {total} rows for {args.devices} devices in {elapsed:.1f} s ({total / elapsed:.0f} rows/s)")
+    except DB_ERRORS as e:
+        print(f"Bulk load failed: {e}")
+    finally:
+        conn.close()
+
+
+def write_batch(backend, conn, cursor, rows, maintain_latest):
+    backend.insert_fixes(cursor, rows)
+    if maintain_latest:
+        backend.upsert_latest(cursor, rows)
+    conn.commit()
+
+
+def encode_fix(fmt, device_id, latitude, longitude, elevation, epoch):
+    if fmt == 'binary':
+        return encode_record(device_id, latitude, longitude, elevation, epoch)
+    return (f'{{"device_id": "{device_id}", "longitude": "{longitude:.7f}", "latitude": "{latitude:.7f}", '
+            f'"elevation": "{elevation:.2f}", "timestamp": "{time.strftime("%H:%M:%S", time.gmtime(epoch))}"}}\n').encode('utf-8')
+
+
+def encode_batch(device_id, fixes):
+    body = ','.join(f'[{longitude:.7f},{latitude:.7f},{elevation:.2f},{epoch}]' for latitude, longitude, elevation, epoch in fixes)
+    return f'{{"device_id": "{device_id}", "batch": [{body}]}}\n'.encode('utf-8')
+
+
+async def connect_fleet(fleet, host, port, fmt):
+    """
+    One connection per device, negotiated for fmt. Returns (writers, fmt) with
+    writers keyed by the device's index in the fleet; fmt falls back to 'json'
+    if the server doesn't answer hello.
+    """
+    conns = await asyncio.gather(*(open_connection(port, host=host) for _ in range(fleet.devices)))
+    writers = {}
+    for i, conn in enumerate(conns):
+        if conn is None:
+            continue
+        reader, writer = conn
+        # Batches need a server that answers hello, same as binary records.
+        if fmt in ('binary', 'batch') and not await negotiate_binary(reader, writer):
+            print("The server did not negotiate; falling back to JSON fixes.")
+            fmt = 'json'
+        writers[i] = writer
+    return writers, fmt
+
+
+async def send_fleet(fleet, writers, fmt, interval, batch_every, counts, running, on_interval=None):
+    """
+    Send every connected device one fix per interval in real time, for as long
+    as running() is true, then close the connections. counts['messages'],
+    ['fixes'] and ['dropped'] (connections lost) are kept up to date, and
+    on_interval is called after each interval's sends.
+    """
+    pending = {i: [] for i in writers}
+    groups = 10
+    while running() and writers:
+        tick = time.monotonic()
+        latitudes, longitudes, elevations = fleet.step()
+        epoch = int(time.time())
+        # Spread each interval's sends over the interval instead of one burst.
+        for group in range(groups):
+            for i in list(writers)[group::groups]:
+                fix = (latitudes[i], longitudes[i], elevations[i], epoch)
+                try:
+                    if fmt == 'batch':
+                        pending[i].append(fix)
+                        if len(pending[i]) < batch_every:
+                            continue
+                        writers[i].write(encode_batch(fleet.ids[i], pending[i]))
+                        counts['fixes'] += len(pending[i])
+                        pending[i] = []
+                    else:
+                        writers[i].write(encode_fix(fmt, fleet.ids[i], *fix))
+                        counts['fixes'] += 1
+                    counts['messages'] += 1
+                    await writers[i].drain()
+                except ConnectionError:
+                    counts['dropped'] += 1
+                    del writers[i]
+            await asyncio.sleep(max(0.0, tick + interval * (group + 1) / groups - time.monotonic()))
+        if on_interval:
+            on_interval(len(writers))
+    for writer in writers.values():
+        writer.close()
+
+
+async def replay(args):
+    """Every device on its own connection, sending one fix per interval in real time."""
+    raise_fd_limit()
+    fleet = Fleet(args.devices, args.interval, args.seed, first_id=args.first_id)
+    writers, fmt = await connect_fleet(fleet, args.host, args.port, args.format)
+    print(f"{len(writers)} of {args.devices} devices connected")
+
+    counts = {'messages': 0, 'fixes': 0, 'dropped': 0}
+    start = time.monotonic()
+    deadline = start + args.duration
+
+    def readout(connected):
+        sent = counts['fixes']
+        print(f"\r{sent} fixes sent, {sent / (time.monotonic() - start):.0f}/s, {connected} connected, "
+              f"{counts['dropped']} dropped", end='', flush=True)
+
+    await send_fleet(fleet, writers, fmt, args.interval, args.batch_every, counts,
+                     lambda: time.monotonic() < deadline, readout)
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic fleet telemetry.")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--first-id', type=int, default=1, help="Id of the first device")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    bulk = commands.add_parser('bulk', help="Write history straight into the database")
+    bulk.add_argument('--devices', type=int, default=100)
+    bulk.add_argument('--days', type=float, default=5.0, help="Days of history, ending now")
+    bulk.add_argument('--interval', type=float, default=30.0, help="Seconds between a device's fixes")
+    bulk.add_argument('--batch-size', type=int, default=5000, help="Rows per executemany and commit")
+    bulk.add_argument('--load-data', action='store_true', help="MariaDB only: LOAD DATA LOCAL INFILE from a CSV")
+
+    live = commands.add_parser('replay', help="Send live fixes to an ingest server")
+    live.add_argument('--host', default='127.0.0.1')
+    live.add_argument('--port', type=int, default=5889)
+    live.add_argument('--devices', type=int, default=100)
+    live.add_argument('--interval', type=float, default=1.0, help="Seconds between a device's fixes")
+    live.add_argument('--duration', type=float, default=60.0, help="Seconds to run for")
+    live.add_argument('--format', choices=['json', 'binary', 'batch'], default='json')
+    live.add_argument('--batch-every', type=int, default=10, help="Fixes per message in batch format")
+
+    args = parser.parse_args()
+    if args.command == 'bulk':
+        bulk_load(args)
+    else:
+        asyncio.run(replay(args))
+
+
+if __name__ == '__main__':
+    main()
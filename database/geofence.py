@@ -0,0 +1,228 @@
+"""
+Geofences checked against every fix as it is ingested.
+
+Fences are circles and polygons, each for a list of devices or for all of
+them, loaded from a JSON file:
+
+    [
+        {"id": "campus", "name": "Campus",
+         "polygon": [[-76.889, 40.951], [-76.880, 40.951], [-76.880, 40.958], [-76.889, 40.958]]},
+        {"id": "home-7", "devices": ["7"],
+         "circle": {"longitude": -76.885, "latitude": 40.955, "radius_m": 150}}
+    ]
+
+Polygon vertices are [longitude, latitude] pairs, as in GeoJSON. A fence
+without "devices" applies to every device.
+
+The fences are indexed on a uniform grid of cell_deg degrees: each cell lists
+the fences whose bounding box touches it, with device-specific fences kept in
+a grid of their own per device. A fix is only tested against the fences of its
+cell, so the cost per fix depends on how many fences overlap there, not on how
+many there are. Fences bigger than MAX_CELLS cells are tested by bounding box
+on every fix instead.
+
+GeofenceEngine.evaluate compares the fences a device is inside with the ones
+it was inside at its previous fix and returns an enter or exit event for each
+difference. A device's first fix after start-up only records where it is, and
+fixes older than the last one evaluated for the device (a drained backlog)
+are skipped, since they would flip the state backwards.
+"""
+import json
+import math
+import os
+import threading
+import time
+
+EARTH_RADIUS_M = 6371008.8
+METRES_PER_DEGREE_LAT = 110540.0
+DEFAULT_CELL_DEG = 0.01
+# Fences spanning more cells than this are checked on every fix by bounding box.
+MAX_CELLS = 4096
+
+
+def haversine_m(lon1, lat1, lon2, lat2):
+    dlat = math.radians(lat2 - lat1)
+    dlon = math.radians(lon2 - lon1)
+    a = math.sin(dlat / 2) ** 2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+class CircleFence:
+    def __init__(self, fence_id, name, devices, longitude, latitude, radius_m):
+        self.id = fence_id
+        self.name = name
+        self.devices = devices
+        self.longitude = longitude
+        self.latitude = latitude
+        self.radius_m = radius_m
+        dlat = radius_m / METRES_PER_DEGREE_LAT
+        dlon = dlat / max(math.cos(math.radians(latitude)), 1e-6)
+        self.bbox = (longitude - dlon, latitude - dlat, longitude + dlon, latitude + dlat)
+
+    def contains(self, longitude, latitude):
+        return haversine_m(self.longitude, self.latitude, longitude, latitude) <= self.radius_m
+
+
+class PolygonFence:
+    def __init__(self, fence_id, name, devices, vertices):
+        if len(vertices) < 3:
+            raise ValueError(f"Polygon fence {fence_id} needs at least 3 vertices.")
+        self.id = fence_id
+        self.name = name
+        self.devices = devices
+        # Edges as (x1, y1, x2, y2) so the ray casting loop only unpacks tuples.
+        points = [(float(lon), float(lat)) for lon, lat in vertices]
+        self.edges = [(x1, y1, x2, y2) for (x1, y1), (x2, y2) in zip(points, points[1:] + points[:1])]
+        lons = [x for x, _ in points]
+        lats = [y for _, y in points]
+        self.bbox = (min(lons), min(lats), max(lons), max(lats))
+
+    def contains(self, longitude, latitude):
+        """Even-odd ray casting; a point exactly on an edge may fall either way."""
+        inside = False
+        for x1, y1, x2, y2 in self.edges:
+            if (y1 > latitude) != (y2 > latitude) and longitude < x1 + (latitude - y1) * (x2 - x1) / (y2 - y1):
+                inside = not inside
+        return inside
+
+
+def parse_fence(spec):
+    devices = frozenset(str(device_id) for device_id in spec['devices']) if spec.get('devices') else None
+    fence_id = str(spec['id'])
+    name = spec.get('name', fence_id)
+    if 'circle' in spec:
+        circle = spec['circle']
+        return CircleFence(fence_id, name, devices, float(circle['longitude']), float(circle['latitude']),
+                           float(circle['radius_m']))
+    if 'polygon' in spec:
+        return PolygonFence(fence_id, name, devices, spec['polygon'])
+    raise ValueError(f"Fence {fence_id} has neither a circle nor a polygon.")
+
+
+def load_fences(path):
+    with open(path) as f:
+        return [parse_fence(spec) for spec in json.load(f)]
+
+
+class GridIndex:
+    """Fences by grid cell, per device (None for fences that apply to every device)."""
+    def __init__(self, fences, cell_deg=DEFAULT_CELL_DEG):
+        self.cell_deg = cell_deg
+        self.grids = {}
+        self.large = {}
+        for fence in fences:
+            min_lon, min_lat, max_lon, max_lat = fence.bbox
+            x0, y0 = self.cell(min_lon, min_lat)
+            x1, y1 = self.cell(max_lon, max_lat)
+            for device in fence.devices or (None,):
+                if (x1 - x0 + 1) * (y1 - y0 + 1) > MAX_CELLS:
+                    self.large.setdefault(device, []).append(fence)
+                    continue
+                grid = self.grids.setdefault(device, {})
+                for x in range(x0, x1 + 1):
+                    for y in range(y0, y1 + 1):
+                        grid.setdefault((x, y), []).append(fence)
+
+    def cell(self, longitude, latitude):
+        return math.floor(longitude / self.cell_deg), math.floor(latitude / self.cell_deg)
+
+    def candidates(self, device_id, longitude, latitude):
+        key = self.cell(longitude, latitude)
+        for device in (None, device_id):
+            grid = self.grids.get(device)
+            if grid:
+                yield from grid.get(key, ())
+            for fence in self.large.get(device, ()):
+                min_lon, min_lat, max_lon, max_lat = fence.bbox
+                if min_lon <= longitude <= max_lon and min_lat <= latitude <= max_lat:
+                    yield fence
+
+    def containing(self, device_id, longitude, latitude):
+        """Ids of the fences device_id is inside at this point."""
+        return frozenset(fence.id for fence in self.candidates(device_id, longitude, latitude)
+                         if fence.contains(longitude, latitude))
+
+
+class GeofenceEngine:
+    """
+    Enter/exit detection for ingested fixes. Thread-safe; the fence file, if
+    any, is reloaded when it changes, checked at most every reload_interval
+    seconds.
+    """
+    def __init__(self, fences=(), cell_deg=DEFAULT_CELL_DEG, path=None, reload_interval=5.0):
+        self.cell_deg = cell_deg
+        self.path = path
+        self.reload_interval = reload_interval
+        self.mtime = None
+        self.next_check = 0.0
+        self.lock = threading.Lock()
+        # device_id -> (timestamp of the last fix evaluated, ids of the fences it was inside)
+        self.state = {}
+        self.set_fences(fences)
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        engine = cls(path=path, **kwargs)
+        engine.reload()
+        return engine
+
+    def set_fences(self, fences):
+        fences = list(fences)
+        index = GridIndex(fences, self.cell_deg)
+        with self.lock:
+            self.fences = {fence.id: fence for fence in fences}
+            self.index = index
+
+    def reload(self):
+        self.mtime = os.path.getmtime(self.path)
+        self.set_fences(load_fences(self.path))
+
+    def maybe_reload(self):
+        now = time.monotonic()
+        if self.path is None or now < self.next_check:
+            return False
+        self.next_check = now + self.reload_interval
+        try:
+            if os.path.getmtime(self.path) == self.mtime:
+                return False
+            self.reload()
+        except (OSError, ValueError, KeyError) as e:
+            # Keep the fences we have rather than dropping them all over a bad edit.
+            self.mtime = None
+            raise ValueError(f"Could not reload geofences from {self.path}: {e}") from e
+        return True
+
+    def evaluate(self, rows):
+        """
+        Check (device_id, longitude, latitude, elevation, timestamp) rows, oldest
+        first. Returns a list of event dicts, one per fence entered or left.
+        """
+        events = []
+        with self.lock:
+            index = self.index
+            fences = self.fences
+            state = self.state
+            for device_id, longitude, latitude, _, timestamp in rows:
+                # JSON fixes may carry the id as a number, fences always name it as a string.
+                device_id = str(device_id)
+                previous = state.get(device_id)
+                if previous is not None and timestamp < previous[0]:
+                    continue
+                inside = index.containing(device_id, longitude, latitude)
+                state[device_id] = (timestamp, inside)
+                if previous is None or inside == previous[1]:
+                    continue
+                for kind, fence_ids in (('exit', previous[1] - inside), ('enter', inside - previous[1])):
+                    for fence_id in fence_ids:
+                        fence = fences.get(fence_id)
+                        events.append({"device_id": device_id, "fence_id": fence_id,
+                                       "fence_name": fence.name if fence else fence_id, "event": kind,
+                                       "longitude": longitude, "latitude": latitude,
+                                       "timestamp": timestamp[:19].replace(' ', 'T')})
+        return events
+
+    def inside(self, device_id):
+        """Ids of the fences device_id was inside at its last evaluated fix."""
+        with self.lock:
+            entry = self.state.get(str(device_id))
+        return entry[1] if entry else frozenset()
@@ -0,0 +1,151 @@
+"""
+Load test for the TCP ingest server.
+
+Starts the threaded or asyncio server in-process with a database stand-in that
+only counts inserts, opens a fleet of long-lived connections the way Picos do,
+and has some of them send telemetry. Reports how many connections the server
+held and how many messages per second it inserted.
+
+    python3 load_test.py --mode threaded --connections 2000 --senders 200
+    python3 load_test.py --mode async --connections 2000 --senders 200
+"""
+import argparse
+import asyncio
+import json
+import random
+import resource
+import threading
+import time
+
+from pico_to_db_tcp_v2 import AsyncServer, Server
+from telemetry_codec import FORMAT_BINARY_V1, encode_record
+
+
+class CountingDatabaseManager:
+    """Stands in for DatabaseManager so the load test measures the server, not MariaDB."""
+    def __init__(self):
+        self.inserted = 0
+        self.lock = threading.Lock()
+
+    def insert_data(self, data):
+        self.insert_rows([data])
+
+    def insert_rows(self, rows, flush=False):
+        with self.lock:
+            self.inserted += len(rows)
+
+    def close(self):
+        pass
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+def start_server(mode, port, max_connections, db_manager):
+    if mode == 'async':
+        server = AsyncServer('127.0.0.1', port, max_connections=max_connections, db_manager=db_manager)
+    else:
+        server = Server('127.0.0.1', port, db_manager=db_manager)
+    threading.Thread(target=server.start, daemon=True).start()
+    return server
+
+
+def make_message(device_id, fmt):
+    if fmt == 'binary':
+        return encode_record(device_id, 40.955 + random.uniform(-0.01, 0.01),
+                             -76.885 + random.uniform(-0.01, 0.01), 132.6, time.time())
+    return json.dumps({
+        "device_id": str(device_id),
+        "longitude": str(-76.885 + random.uniform(-0.01, 0.01)),
+        "latitude": str(40.955 + random.uniform(-0.01, 0.01)),
+        "elevation": "132.6",
+        "timestamp": time.strftime("%H:%M:%S", time.gmtime()),
+    }).encode("utf-8") + b"\n"
+
+
+async def open_connection(port, retries=50, host='127.0.0.1'):
+    for _ in range(retries):
+        try:
+            return await asyncio.open_connection(host, port)
+        except OSError:
+            await asyncio.sleep(0.1)
+    return None
+
+
+async def negotiate_binary(reader, writer):
+    writer.write(json.dumps({"hello": {"formats": [FORMAT_BINARY_V1]}}).encode("utf-8") + b"\n")
+    await writer.drain()
+    reply = json.loads(await reader.readline())
+    return reply.get('format') == FORMAT_BINARY_V1
+
+
+async def send_loop(reader, writer, device_id, rate, deadline, fmt):
+    if fmt == 'binary' and not await negotiate_binary(reader, writer):
+        fmt = 'json'
+    interval = 1.0 / rate
+    sent = 0
+    while time.monotonic() < deadline:
+        writer.write(make_message(device_id, fmt))
+        await writer.drain()
+        sent += 1
+        await asyncio.sleep(interval)
+    return sent
+
+
+async def run(args):
+    fd_limit = raise_fd_limit()
+    db_manager = CountingDatabaseManager()
+    start_server(args.mode, args.port, args.max_connections, db_manager)
+    threads_before = threading.active_count()
+
+    conns = await asyncio.gather(*(open_connection(args.port) for _ in range(args.connections)))
+    conns = [c for c in conns if c is not None]
+    # Give the server a moment to accept (or refuse) everything in its backlog.
+    await asyncio.sleep(1)
+    held = 0
+    for reader, writer in conns:
+        if not reader.at_eof() and not writer.is_closing():
+            held += 1
+    server_threads = threading.active_count() - threads_before
+
+    deadline = time.monotonic() + args.duration
+    start = time.monotonic()
+    senders = [send_loop(reader, writer, i, args.rate, deadline, args.format)
+               for i, (reader, writer) in enumerate(conns[:args.senders])]
+    try:
+        sent = sum(await asyncio.gather(*senders))
+    except ConnectionError:
+        sent = -1
+    await asyncio.sleep(0.5)
+    elapsed = time.monotonic() - start
+
+    for _, writer in conns:
+        writer.close()
+
+    print(f"mode:               {args.mode}")
+    print(f"format:             {args.format}")
+    print(f"fd limit:           {fd_limit}")
+    print(f"connections opened: {len(conns)} / {args.connections}")
+    print(f"connections held:   {held}")
+    print(f"server threads:     {server_threads}")
+    print(f"messages sent:      {sent}")
+    print(f"messages inserted:  {db_manager.inserted}")
+    print(f"messages/sec:       {db_manager.inserted / elapsed:.1f}")
+    print(f"max RSS:            {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the TCP ingest server.")
+    parser.add_argument('--mode', choices=['threaded', 'async'], default='async')
+    parser.add_argument('--format', choices=['json', 'binary'], default='json', help="Telemetry wire format")
+    parser.add_argument('--port', type=int, default=5890)
+    parser.add_argument('--connections', type=int, default=1000, help="Connections to open and hold")
+    parser.add_argument('--senders', type=int, default=100, help="How many of the connections send telemetry")
+    parser.add_argument('--rate', type=float, default=10.0, help="Messages per second per sender")
+    parser.add_argument('--duration', type=float, default=10.0, help="Seconds to send for")
+    parser.add_argument('--max-connections', type=int, default=10000, help="Connection limit for async mode")
+    asyncio.run(run(parser.parse_args()))
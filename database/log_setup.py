@@ -0,0 +1,59 @@
+"""
+Logging for the long-running services.
+
+Per-message events (a frame received, a device connecting, a bad frame) go
+through logging at DEBUG or WARNING instead of print, so under load they cost
+a level check rather than a write to stdout. RateLimitFilter keeps a flood of
+the same warning, e.g. from a misbehaving device, down to a few lines with a
+count of what was left out.
+"""
+import logging
+import threading
+import time
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+# With several worker processes, say which one logged the line.
+PROCESS_LOG_FORMAT = '%(asctime)s %(levelname)s %(processName)s %(name)s: %(message)s'
+LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Passes at most burst records per message template every interval seconds.
+    The first record of the next window carries the number that were dropped.
+    """
+    def __init__(self, interval=10.0, burst=5):
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        # (logger, level, template) -> [window start, passed, suppressed]
+        self.windows = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        # Keyed on the unformatted message, so "Error from %s" counts as one
+        # message whatever the address.
+        key = (record.name, record.levelno, record.msg)
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window else 0
+                window = self.windows[key] = [now, 0, 0]
+                if suppressed:
+                    record.msg = f"{record.msg} [{suppressed} similar messages suppressed]"
+            if window[1] < self.burst:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+
+def setup_logging(level='INFO', interval=10.0, burst=5, process_name=False):
+    """Log to stderr at level, rate limited per message template."""
+    logging.basicConfig(level=level, format=PROCESS_LOG_FORMAT if process_name else LOG_FORMAT)
+    limiter = RateLimitFilter(interval, burst)
+    # Handler filters see records from every logger, logger filters only their own.
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(limiter)
+    return limiter
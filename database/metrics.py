@@ -0,0 +1,311 @@
+"""
+Prometheus-style metrics, without a client library.
+
+Counters, gauges and histograms register themselves in REGISTRY and are
+rendered in the Prometheus text exposition format. The ingest server serves
+them from a small HTTP listener (start_http_server); the API adds a /metrics
+route to Flask instead.
+
+    PARSED = Counter('gps_messages_parsed_total', "Frames decoded.")
+    PARSED.inc()
+    PARSE_SECONDS = Histogram('gps_parse_seconds', "Time to decode a frame.")
+    with PARSE_SECONDS.time():
+        ...
+
+Metrics with label names are used through .labels(*values), which returns
+the child for those values; look children up once outside hot loops.
+
+Registry.snapshot() captures every value as plain data, so worker processes
+can send their metrics to a supervisor, which serves them all from one
+endpoint through SnapshotCollector.
+"""
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds, from a fraction of a millisecond (parsing a frame) to seconds (a stalled commit).
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            if any(existing.name == metric.name for existing in self.metrics):
+                raise ValueError(f"Metric {metric.name} is already registered.")
+            self.metrics.append(metric)
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics)
+        return ''.join(metric.render() for metric in metrics)
+
+    def snapshot(self):
+        """{name: {kind, documentation, labelnames, bounds, samples}} of every metric, as picklable data."""
+        with self.lock:
+            metrics = [metric for metric in self.metrics if isinstance(metric, Metric)]
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+
+REGISTRY = Registry()
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def header_lines(name, kind, documentation):
+    return [f"# HELP {name} {documentation}\n", f"# TYPE {name} {kind}\n"]
+
+
+def sample_lines(name, kind, bounds, pairs, sample):
+    """Lines for one child: sample is a number, or (bucket counts, sum) for a histogram."""
+    if kind != 'histogram':
+        return [f"{name}{format_labels(pairs)} {format_value(sample)}\n"]
+    counts, total = sample
+    lines = []
+    cumulative = 0
+    for bound, count in zip(tuple(bounds) + (float('inf'),), counts):
+        cumulative += count
+        lines.append(f"{name}_bucket{format_labels(pairs + [('le', format_value(float(bound)))])} {cumulative}\n")
+    lines.append(f"{name}_sum{format_labels(pairs)} {format_value(total)}\n")
+    lines.append(f"{name}_count{format_labels(pairs)} {cumulative}\n")
+    return lines
+
+
+class Timer:
+    """Observes the time spent inside a with block into a histogram child."""
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.child.observe(time.perf_counter() - self.start)
+
+
+class Metric:
+    kind = None
+    bounds = ()
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        self.lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+        # Unlabelled metrics are their own single child.
+        self.default = None if self.labelnames else self.labels()
+
+    def labels(self, *values):
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}.")
+        key = tuple(str(value) for value in values)
+        child = self.children.get(key)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(key, self.new_child())
+        return child
+
+    def samples(self):
+        with self.lock:
+            children = list(self.children.items())
+        return [(key, child.get()) for key, child in children]
+
+    def render(self):
+        lines = header_lines(self.name, self.kind, self.documentation)
+        for key, sample in self.samples():
+            lines.extend(sample_lines(self.name, self.kind, self.bounds, list(zip(self.labelnames, key)), sample))
+        return ''.join(lines)
+
+    def snapshot(self):
+        return {'kind': self.kind, 'documentation': self.documentation, 'labelnames': self.labelnames,
+                'bounds': self.bounds, 'samples': self.samples()}
+
+
+class Value:
+    """A number behind a lock, or a function that is called when rendering."""
+    def __init__(self):
+        self.value = 0
+        self.function = None
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def set_function(self, function):
+        self.function = function
+
+    def get(self):
+        if self.function is not None:
+            return self.function()
+        return self.value
+
+
+class GaugeValue(Value):
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(Metric):
+    """Only goes up. set_function suits counts another object already keeps."""
+    kind = 'counter'
+
+    def new_child(self):
+        return Value()
+
+    def inc(self, amount=1):
+        self.default.inc(amount)
+
+    def set_function(self, function):
+        self.default.set_function(function)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def new_child(self):
+        return GaugeValue()
+
+    def inc(self, amount=1):
+        self.default.inc(amount)
+
+    def dec(self, amount=1):
+        self.default.dec(amount)
+
+    def set(self, value):
+        self.default.set(value)
+
+    def set_function(self, function):
+        self.default.set_function(function)
+
+
+class HistogramValue:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # One count per bucket plus +Inf, not cumulative until rendered.
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        return Timer(self)
+
+    def get(self):
+        with self.lock:
+            return list(self.counts), self.sum
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.bounds = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def new_child(self):
+        return HistogramValue(self.bounds)
+
+    def observe(self, value):
+        self.default.observe(value)
+
+    def time(self):
+        return Timer(self.default)
+
+
+class SnapshotCollector:
+    """
+    Renders Registry.snapshot()s taken in other processes, each with an extra
+    label, e.g. worker="0", in front of its own.
+    """
+    def __init__(self, label, registry=REGISTRY):
+        self.name = f'{label} snapshots'
+        self.label = label
+        self.snapshots = {}
+        self.lock = threading.Lock()
+        registry.register(self)
+
+    def update(self, value, snapshot):
+        with self.lock:
+            self.snapshots[str(value)] = snapshot
+
+    def remove(self, value):
+        with self.lock:
+            self.snapshots.pop(str(value), None)
+
+    def render(self):
+        with self.lock:
+            snapshots = sorted(self.snapshots.items())
+        merged = {}
+        for value, snapshot in snapshots:
+            for name, metric in snapshot.items():
+                entry = merged.setdefault(name, (metric, []))
+                for key, sample in metric['samples']:
+                    entry[1].append(([(self.label, value)] + list(zip(metric['labelnames'], key)), sample))
+        lines = []
+        for name, (metric, samples) in merged.items():
+            lines.extend(header_lines(name, metric['kind'], metric['documentation']))
+            for pairs, sample in samples:
+                lines.extend(sample_lines(name, metric['kind'], metric['bounds'], pairs, sample))
+        return ''.join(lines)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would drown the service's own log.
+        pass
+
+
+def start_http_server(port, host='127.0.0.1', registry=REGISTRY):
+    """Serve registry at http://host:port/metrics from a daemon thread. Returns the server."""
+    handler = type('Handler', (MetricsHandler,), {'registry': registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
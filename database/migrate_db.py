@@ -0,0 +1,233 @@
+"""
+Schema migrations for the sensor_data database.
+
+Each migration is applied once, in order, and recorded in the schema_version
+table so the ingest and API servers can check at startup that the schema
+they expect is in place.
+
+    python3 migrate_db.py                  # apply pending migrations
+    python3 migrate_db.py --status         # show the applied migrations
+    python3 migrate_db.py --partition      # partition sensor_data by day (optional)
+    python3 migrate_db.py --rebuild-latest # recompute device_latest from sensor_data
+
+Migrations run against the configured storage backend (see storage.py).
+Partitioning only exists on MariaDB.
+"""
+import argparse
+from datetime import date, timedelta
+
+from storage import CREATE_SENSOR_DATA, DB_ERRORS, get_backend
+
+# Newest fix per device, recomputed from the full history.
+REBUILD_LATEST_SQL = """
+    REPLACE INTO device_latest (device_id, longitude, latitude, elevation, timestamp)
+    SELECT sd.device_id, sd.longitude, sd.latitude, sd.elevation, sd.timestamp FROM sensor_data sd
+    INNER JOIN (
+        SELECT device_id, MAX(timestamp) AS max_timestamp
+        FROM sensor_data
+        GROUP BY device_id
+    ) AS latest ON sd.device_id = latest.device_id AND sd.timestamp = latest.max_timestamp
+"""
+
+# (version, description, statements). Append new migrations; never edit applied ones.
+# A statement is SQL both backends accept, or a dict of SQL per backend name.
+MIGRATIONS = [
+    (1, "Create sensor_data", [
+        CREATE_SENSOR_DATA,
+    ]),
+    (2, "Composite (device_id, timestamp) index for per-device lookups and range scans", [
+        "CREATE INDEX IF NOT EXISTS idx_device_timestamp ON sensor_data (device_id, timestamp)",
+    ]),
+    (3, "device_latest table holding the newest fix per device, kept current by ingest", [
+        """
+        CREATE TABLE IF NOT EXISTS device_latest (
+            device_id VARCHAR(255) PRIMARY KEY,
+            longitude DOUBLE,
+            latitude DOUBLE,
+            elevation DOUBLE,
+            timestamp DATETIME
+        )
+        """,
+        "DELETE FROM device_latest",
+        REBUILD_LATEST_SQL,
+    ]),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# First version with the device_latest table.
+LATEST_TABLE_VERSION = 3
+
+
+def connect_to_database(backend):
+    """Connect to the database and return the connection."""
+    try:
+        return backend.connect()
+    except DB_ERRORS as e:
+        print(f"Error connecting to the database: {e}")
+        return None
+
+
+def ensure_version_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INT PRIMARY KEY,
+            description VARCHAR(255),
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def current_version(conn):
+    """The highest applied migration, or 0 for a database that was never migrated."""
+    cursor = conn.cursor()
+    ensure_version_table(cursor)
+    cursor.execute("SELECT MAX(version) FROM schema_version")
+    version = cursor.fetchone()[0]
+    cursor.close()
+    return version or 0
+
+
+def check_schema_version(conn, required=SCHEMA_VERSION):
+    """
+    Called by the servers at startup. Warns instead of failing so an old schema
+    keeps working, just without the indexes and tables added since.
+    """
+    try:
+        version = current_version(conn)
+    except DB_ERRORS as e:
+        print(f"Could not read the schema version: {e}")
+        return 0
+    if version < required:
+        print(f"Database schema is at version {version}, expected {required}. Run database/migrate_db.py to upgrade.")
+    return version
+
+
+def migrate(conn, backend, target=SCHEMA_VERSION, quiet=False):
+    """Apply every migration above the current version up to target."""
+    version = current_version(conn)
+    cursor = conn.cursor()
+    for number, description, statements in MIGRATIONS:
+        if number <= version or number > target:
+            continue
+        print(f"Applying migration {number}: {description}")
+        # MariaDB commits DDL implicitly, so every statement has to be safe to re-run.
+        for statement in statements:
+            cursor.execute(backend.sql(statement))
+        cursor.execute("INSERT INTO schema_version (version, description) VALUES (?, ?)", (number, description))
+        conn.commit()
+    if not quiet:
+        print(f"Schema is at version {max(version, min(target, SCHEMA_VERSION))}.")
+
+
+def show_status(conn, backend):
+    cursor = conn.cursor()
+    ensure_version_table(cursor)
+    cursor.execute("SELECT version, description, applied_at FROM schema_version ORDER BY version")
+    applied = {row[0]: row for row in cursor.fetchall()}
+    for number, description, _ in MIGRATIONS:
+        row = applied.get(number)
+        print(f"{number:>3}  {'applied ' + str(row[2]) if row else 'pending':<28}  {description}")
+    if backend.name != 'mariadb':
+        return
+    cursor.execute("""
+        SELECT COUNT(*) FROM information_schema.PARTITIONS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'sensor_data' AND PARTITION_NAME IS NOT NULL
+    """)
+    print(f"sensor_data partitions: {cursor.fetchone()[0]}")
+
+
+def rebuild_latest(conn):
+    """Recompute device_latest from the full history, e.g. after a bulk load that bypassed ingest."""
+    if current_version(conn) < LATEST_TABLE_VERSION:
+        print("device_latest does not exist yet, run the migrations first.")
+        return
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM device_latest")
+    cursor.execute(REBUILD_LATEST_SQL)
+    conn.commit()
+    cursor.execute("SELECT COUNT(*) FROM device_latest")
+    print(f"Rebuilt device_latest for {cursor.fetchone()[0]} devices.")
+
+
+def partition_name(day):
+    return f"p{day.strftime('%Y%m%d')}"
+
+
+def partition_by_day(conn, backend, days_ahead=7):
+    """
+    Range-partition sensor_data by day so old days can be dropped or archived
+    without touching the hot ones. The first run rebuilds the table; later runs
+    split the catch-all partition to add days up to days_ahead from today.
+    """
+    if backend.name != 'mariadb':
+        print(f"Partitioning needs MariaDB; the {backend.name} backend keeps sensor_data in one table.")
+        return
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT PARTITION_NAME FROM information_schema.PARTITIONS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'sensor_data' AND PARTITION_NAME IS NOT NULL
+    """)
+    existing = {row[0] for row in cursor.fetchall()}
+    today = date.today()
+    days = [today + timedelta(days=n) for n in range(days_ahead + 1)]
+
+    if not existing:
+        # Every unique key of a partitioned table has to include the partitioning column.
+        cursor.execute("ALTER TABLE sensor_data MODIFY timestamp DATETIME NOT NULL")
+        cursor.execute("ALTER TABLE sensor_data DROP PRIMARY KEY, ADD PRIMARY KEY (id, timestamp)")
+        cursor.execute("SELECT MIN(timestamp) FROM sensor_data")
+        oldest = cursor.fetchone()[0]
+        first = oldest.date() if oldest else today
+        ranges = [f"PARTITION p_history VALUES LESS THAN (TO_DAYS('{first}'))"]
+        day = first
+        while day <= days[-1]:
+            ranges.append(f"PARTITION {partition_name(day)} VALUES LESS THAN (TO_DAYS('{day + timedelta(days=1)}'))")
+            day += timedelta(days=1)
+        ranges.append("PARTITION p_future VALUES LESS THAN MAXVALUE")
+        print(f"Partitioning sensor_data into {len(ranges)} partitions, this rebuilds the table...")
+        cursor.execute(f"ALTER TABLE sensor_data PARTITION BY RANGE (TO_DAYS(timestamp)) ({', '.join(ranges)})")
+    else:
+        new_days = [day for day in days if partition_name(day) not in existing]
+        if not new_days:
+            print("sensor_data already has partitions for the coming days.")
+            return
+        ranges = [f"PARTITION {partition_name(day)} VALUES LESS THAN (TO_DAYS('{day + timedelta(days=1)}'))"
+                  for day in new_days]
+        ranges.append("PARTITION p_future VALUES LESS THAN MAXVALUE")
+        cursor.execute(f"ALTER TABLE sensor_data REORGANIZE PARTITION p_future INTO ({', '.join(ranges)})")
+        print(f"Added {len(new_days)} daily partitions.")
+    conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate the sensor_data schema.")
+    parser.add_argument('--status', action='store_true', help="Show applied and pending migrations")
+    parser.add_argument('--target', type=int, default=SCHEMA_VERSION, help="Migrate up to this version")
+    parser.add_argument('--partition', action='store_true',
+                        help="Partition sensor_data by day, or add partitions for the coming days")
+    parser.add_argument('--days-ahead', type=int, default=7, help="Days of future partitions to keep ready")
+    parser.add_argument('--rebuild-latest', action='store_true', help="Recompute device_latest from sensor_data")
+    args = parser.parse_args()
+
+    backend = get_backend()
+    conn = connect_to_database(backend)
+    if conn is None:
+        return
+    try:
+        if args.status:
+            show_status(conn, backend)
+        elif args.partition:
+            partition_by_day(conn, backend, args.days_ahead)
+        elif args.rebuild_latest:
+            rebuild_latest(conn)
+        else:
+            migrate(conn, backend, args.target)
+    except DB_ERRORS as e:
+        print(f"Migration failed: {e}")
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,14 @@
+import argparse
 import socket
 import threading
 import json
-import mariadb
-import secret
+import logging
 from Crypto.Cipher import AES
 from datetime import datetime
+from log_setup import LEVELS, setup_logging
+from migrate_db import LATEST_TABLE_VERSION, check_schema_version
+from storage import CREATE_SENSOR_DATA, DB_ERRORS, get_backend
+from stream_decoder import StreamDecoder
 
 # Global constants and AES functions
 #GLOBAL_PASSWORD = b"Your Mom123"
@@ -20,44 +24,32 @@ def decrypt_msg(msg, cipher):
     decrypter = AES.new(cipher, AES.MODE_ECB)
     return unpad(decrypter.decrypt(msg))
 
+log = logging.getLogger('ingest')
+
+backend = get_backend()
+# Whether the schema has device_latest, which the API reads latest positions from; set at startup.
+maintain_latest = False
+
 # Initialize and connect to the database
 def initialize_database():
+    global maintain_latest
+    conn = None
     try:
-        conn = mariadb.connect(
-            host=secret.dbhost,
-            user=secret.user,
-            password=secret.password,
-            database=secret.db
-        )
+        conn = backend.connect()
         cursor = conn.cursor()
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS sensor_data (
-                id INT AUTO_INCREMENT PRIMARY KEY,
-                device_id VARCHAR(255),
-                longitude DOUBLE,
-                latitude DOUBLE,
-                elevation DOUBLE,
-                timestamp DATETIME
-            )
-        """)
+        cursor.execute(backend.sql(CREATE_SENSOR_DATA))
         conn.commit()
-    except mariadb.Error as e:
-        print(f"Error connecting to MariaDB: {e}")
+        maintain_latest = check_schema_version(conn) >= LATEST_TABLE_VERSION
+    except DB_ERRORS as e:
+        log.error("Error connecting to the database: %s", e)
     finally:
         if conn:
             conn.close()
 
-import mariadb
-from datetime import datetime
-
 def insert_data_into_database(data):
+    conn = None
     try:
-        conn = mariadb.connect(
-            host=secret.dbhost,
-            user=secret.user,
-            password=secret.password,
-            database=secret.db
-        )
+        conn = backend.connect()
         cursor = conn.cursor()
 
         # Convert timestamp string to datetime object
@@ -73,34 +65,35 @@ def insert_data_into_database(data):
         # Format the datetime object according to the database requirements
         timestamp_formatted = timestamp.strftime("%Y-%m-%d %H:%M:%S.%f")
 
-        cursor.execute("""
-            INSERT INTO sensor_data (device_id, longitude, latitude, elevation, timestamp)
-            VALUES (%s, %s, %s, %s, %s)
-        """, (data['device_id'], data['longitude'], data['latitude'], data['elevation'], timestamp_formatted))
+        rows = [(data['device_id'], data['longitude'], data['latitude'], data['elevation'], timestamp_formatted)]
+        backend.insert_fixes(cursor, rows)
+        if maintain_latest:
+            backend.upsert_latest(cursor, rows)
         conn.commit()
-    except mariadb.Error as e:
-        print(f"Error inserting data into MariaDB: {e}")
+    except DB_ERRORS as e:
+        log.error("Error inserting data into the database: %s", e)
     finally:
         if conn:
             conn.close()
 
 
 def handle_client(client_socket, address):
-    print(f"Accepted connection from {address}")
+    log.debug("Accepted connection from %s", address)
     #key = pad(GLOBAL_PASSWORD)  # Prepare the AES key
+    decoder = StreamDecoder()
 
     while True:
         data = client_socket.recv(1024)
         if not data:
-            print(f"Client {address} disconnected")
+            log.debug("Client %s disconnected", address)
             break
-        try:
-            message = data
-            print(f"Received message from {address}: {message}")
-            json_data = json.loads(message)
-            insert_data_into_database(json_data)
-        except Exception as e:
-            print(f"Error handling message from {address}: {e}")
+        for message in decoder.feed(data):
+            try:
+                log.debug("Message from %s: %r", address, message)
+                json_data = json.loads(message)
+                insert_data_into_database(json_data)
+            except Exception as e:
+                log.warning("Error handling message from %s: %s", address, e)
 
     client_socket.close()
 
@@ -109,7 +102,7 @@ def start_server(host='0.0.0.0', port=5889):
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.bind((host, port))
     server_socket.listen(100)
-    print(f"TCP Server listening on {host}:{port}")
+    log.info("TCP Server listening on %s:%s", host, port)
 
     while True:
         client_socket, address = server_socket.accept()
@@ -117,4 +110,9 @@ def start_server(host='0.0.0.0', port=5889):
         client_handler.start()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Legacy TCP ingest server: one JSON fix per message.")
+    parser.add_argument('--log-level', choices=LEVELS, default='INFO',
+                        help="DEBUG logs every message received")
+    args = parser.parse_args()
+    setup_logging(args.log_level)
     start_server()
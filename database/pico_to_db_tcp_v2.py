@@ -1,68 +1,337 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import queue
+import signal
 import socket
+import sys
 import threading
+import time
 import json
-import mariadb
-import secret
+import logging
 from Crypto.Cipher import AES
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from fanout import DEFAULT_PATH as FANOUT_PATH, FanoutPublisher
+from geofence import GeofenceEngine
+from log_setup import LEVELS, setup_logging
+from metrics import DEFAULT_BUCKETS, REGISTRY, Counter, Gauge, Histogram, Registry, SnapshotCollector, start_http_server
+from migrate_db import LATEST_TABLE_VERSION, check_schema_version, migrate
+from storage import BACKENDS, CREATE_SENSOR_DATA, DB_ERRORS, get_backend
+from stream_decoder import StreamDecoder
+from telemetry_codec import (BINARY_V1, CRYPTO_BLOCK, ENCRYPTED_HEADER, ENCRYPTED_V1, FORMAT_JSON, decode_batch,
+                             decode_records, hello_reply, negotiate, pad)
+
+try:
+    import secret  # telemetry_key / device_keys for encrypted telemetry, if used
+except ImportError:
+    secret = None
+
+log = logging.getLogger('ingest')
+
+MESSAGES_RECEIVED = Counter('gps_messages_received_total', "Frames received from devices.")
+MESSAGES_PARSED = Counter('gps_messages_parsed_total', "Frames decoded into fixes or a hello.")
+MESSAGES_FAILED = Counter('gps_messages_failed_total', "Frames that could not be decoded or queued.")
+FIXES_PARSED = Counter('gps_fixes_parsed_total', "Fixes decoded; a batch or binary run carries several per frame.")
+FRAMES_DECRYPTED = Counter('gps_frames_decrypted_total', "Encrypted frames decrypted.")
+ROWS_INSERTED = Counter('gps_rows_inserted_total', "Rows committed to sensor_data.")
+ROWS_FAILED = Counter('gps_rows_failed_total', "Rows lost to failed flushes.")
+CONNECTIONS_ACCEPTED = Counter('gps_connections_accepted_total', "Device connections accepted.")
+CONNECTIONS_REJECTED = Counter('gps_connections_rejected_total', "Device connections refused at the connection limit.")
+OPEN_CONNECTIONS = Gauge('gps_open_connections', "Device connections currently open.")
+PENDING_ROWS = Gauge('gps_pending_rows', "Rows buffered and waiting for the next flush.")
+PARSE_SECONDS = Histogram('gps_parse_seconds', "Time to decode one frame.")
+INSERT_SECONDS = Histogram('gps_insert_seconds', "Time to execute a flush's inserts and device_latest upsert.")
+COMMIT_SECONDS = Histogram('gps_commit_seconds', "Time to commit a flush.")
+FLUSH_ROWS = Histogram('gps_flush_rows', "Rows written per flush.", buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000))
+GEOFENCE_SECONDS = Histogram('gps_geofence_seconds', "Time to check one insert's fixes against the geofences.",
+                             buckets=(0.00001, 0.000025, 0.00005) + DEFAULT_BUCKETS)
+GEOFENCE_EVENTS = Counter('gps_geofence_events_total', "Geofence enter and exit events.", ['event'])
 
 class AESCryptor:
+    """
+    Decrypts telemetry from the Pico's EncryptionManager: AES-ECB with the key
+    and every message padded to 32 bytes. Use for_key, which hands out one
+    instance per key; an ECB cipher keeps no state between calls, so one object
+    serves every connection and thread.
+    """
+    cache = {}
+    cache_lock = threading.Lock()
+
     def __init__(self, key):
-        self.key = self.pad(key)
-    
-    @staticmethod
-    def pad(s, block_size=16):
-        n = block_size - (len(s) % block_size)
-        return s + bytes([n] * n)
+        if isinstance(key, str):
+            key = key.encode('utf-8')
+        # Same padding as the firmware, so a short key gives the same AES-256 key on both ends.
+        self.key = pad(key, CRYPTO_BLOCK)
+        if len(self.key) != CRYPTO_BLOCK:
+            raise ValueError(f"Telemetry keys can be at most {CRYPTO_BLOCK - 1} bytes.")
+        self.cipher = AES.new(self.key, AES.MODE_ECB)
+
+    @classmethod
+    def for_key(cls, key):
+        cryptor = cls.cache.get(key)
+        if cryptor is None:
+            with cls.cache_lock:
+                cryptor = cls.cache.setdefault(key, cls(key))
+        return cryptor
 
     @staticmethod
-    def unpad(s):
-        return s[:-s[-1]]
+    def unpad(data):
+        """Strip the padding; slicing a memoryview does not copy."""
+        n = data[-1] if len(data) else 0
+        if not 0 < n <= CRYPTO_BLOCK or n > len(data):
+            raise ValueError("Bad padding on encrypted message; wrong key?")
+        return data[:-n]
 
     def decrypt(self, msg):
-        decrypter = AES.new(self.key, AES.MODE_ECB)
-        return self.unpad(decrypter.decrypt(msg))
+        return bytes(self.unpad(memoryview(self.cipher.decrypt(msg))))
+
+    def decrypt_frames(self, run):
+        """
+        Plaintexts of a run of encrypted frames from the stream decoder. The
+        ciphertexts are gathered into one buffer and decrypted in place with a
+        single AES call (ECB blocks are independent, so this equals decrypting
+        them one by one); the results are memoryviews into that buffer. A frame
+        with bad padding comes back as None, so it doesn't cost the rest of
+        the run.
+        """
+        view = memoryview(run)
+        spans = []
+        pos = 0
+        while pos < len(view):
+            _, length = ENCRYPTED_HEADER.unpack_from(view, pos)
+            if length % 16:
+                raise ValueError(f"Encrypted frame of {length} bytes is not a whole number of AES blocks.")
+            pos += ENCRYPTED_HEADER.size
+            spans.append((pos, length))
+            pos += length
+        buffer = memoryview(bytearray(sum(length for _, length in spans)))
+        offset = 0
+        for start, length in spans:
+            buffer[offset:offset + length] = view[start:start + length]
+            offset += length
+        self.cipher.decrypt(buffer, output=buffer)
+        plaintexts = []
+        offset = 0
+        for _, length in spans:
+            try:
+                plaintexts.append(self.unpad(buffer[offset:offset + length]))
+            except ValueError:
+                plaintexts.append(None)
+            offset += length
+        return plaintexts
+
+class Keyring:
+    """
+    Keys for encrypted telemetry: one shared by every device, and optionally
+    per-device keys, picked by the device_id a device gives in its hello.
+    With required, plaintext telemetry is refused.
+    """
+    def __init__(self, default_key=None, device_keys=None, required=False):
+        self.default = AESCryptor.for_key(default_key) if default_key else None
+        self.devices = {str(device_id): AESCryptor.for_key(key) for device_id, key in (device_keys or {}).items()}
+        self.required = required
+
+    @classmethod
+    def from_config(cls, required=False):
+        """TELEMETRY_KEY or secret.telemetry_key, and secret.device_keys ({device_id: key})."""
+        return cls(os.environ.get('TELEMETRY_KEY') or getattr(secret, 'telemetry_key', None),
+                   getattr(secret, 'device_keys', None), required)
+
+    def cryptor_for(self, device_id):
+        return self.devices.get(str(device_id), self.default)
+
+    def new_session(self):
+        return {'format': FORMAT_JSON, 'keyring': self, 'cryptor': self.default, 'device_id': None}
+
+# Sessions of servers started without a keyring: plaintext only.
+NO_KEYS = Keyring()
 
 class DatabaseManager:
-    def __init__(self):
+    """
+    Write-behind buffer in front of the database. Parsed fixes are queued by
+    insert_data and a background thread writes them with one executemany and one
+    commit once batch_size rows are waiting or the oldest row is flush_interval_ms
+    old. Batching matters even more on SQLite, where every commit is a WAL sync.
+
+    With a GeofenceEngine, fixes are checked against the fences as they are
+    queued and the enter/exit events are published after the flush that
+    commits them.
+    """
+    def __init__(self, batch_size=100, flush_interval_ms=500, max_pending=None, publisher=None, backend=None,
+                 geofences=None):
         self.conn = None
+        self.backend = backend or get_backend()
+        # Committed fixes are handed to the API's live feed through this, if set.
+        self.publisher = publisher
+        self.geofences = geofences
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        # Producers block once this many rows are waiting, so a stalled database
+        # pushes back on the clients instead of growing the buffer without bound.
+        self.max_pending = max_pending or batch_size * 10
+        self.buffer = []
+        self.events = []
+        self.first_buffered_at = None
+        self.buffer_lock = threading.Lock()
+        self.buffer_changed = threading.Condition(self.buffer_lock)
+        # Serialises use of the single connection between the flusher and close().
+        self.db_lock = threading.Lock()
+        self.stats = {
+            'flushes': 0,
+            'rows_inserted': 0,
+            'rows_failed': 0,
+            'largest_batch': 0,
+            'last_flush_ms': 0.0,
+            'total_flush_ms': 0.0,
+        }
+        self.flush_requested = False
+        self.closed = False
+        self.maintain_latest = False
         self.connect()
+        self.flusher = threading.Thread(target=self.flush_loop, daemon=True)
+        self.flusher.start()
+        PENDING_ROWS.set_function(lambda: len(self.buffer))
 
     def connect(self):
         try:
-            self.conn = mariadb.connect(
-                host=secret.dbhost,
-                user=secret.user,
-                password=secret.password,
-                database=secret.db
-            )
+            self.conn = self.backend.connect()
             self.initialize_database()
-        except mariadb.Error as e:
-            print(f"Error connecting to MariaDB: {e}")
+        except DB_ERRORS as e:
+            log.error("Error connecting to the %s database: %s", self.backend.name, e)
 
     def initialize_database(self):
         cursor = self.conn.cursor()
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS sensor_data (
-                id INT AUTO_INCREMENT PRIMARY KEY,
-                device_id VARCHAR(255),
-                longitude DOUBLE,
-                latitude DOUBLE,
-                elevation DOUBLE,
-                timestamp DATETIME
-            )
-        """)
+        cursor.execute(self.backend.sql(CREATE_SENSOR_DATA))
         self.conn.commit()
+        if self.backend.embedded:
+            migrate(self.conn, self.backend, quiet=True)
+        # Older schemas have no device_latest table; keep ingesting into sensor_data only.
+        self.maintain_latest = check_schema_version(self.conn) >= LATEST_TABLE_VERSION
 
     def insert_data(self, data):
-        cursor = self.conn.cursor()
-        timestamp = self.format_timestamp(data['timestamp'])
-        cursor.execute("""
-            INSERT INTO sensor_data (device_id, longitude, latitude, elevation, timestamp)
-            VALUES (%s, %s, %s, %s, %s)
-        """, (data['device_id'], data['longitude'], data['latitude'], data['elevation'], timestamp))
-        self.conn.commit()
-        print(f'Inserted {data} into database successfully!')
+        self.insert_rows([self.parse_fix(data)])
+
+    def insert_rows(self, rows, flush=False):
+        """
+        Queue already parsed (device_id, longitude, latitude, elevation, timestamp)
+        rows. flush=True commits them without waiting for the batch to fill, so a
+        device's backlog goes in as one bulk insert.
+        """
+        events = self.check_geofences(rows) if self.geofences else None
+        with self.buffer_changed:
+            while len(self.buffer) >= self.max_pending and not self.closed:
+                self.buffer_changed.wait()
+            # The flusher sleeps without a timeout while the buffer is empty, so the
+            # first row has to wake it to start the flush_interval clock.
+            started = not self.buffer
+            if started:
+                self.first_buffered_at = time.monotonic()
+            self.buffer.extend(rows)
+            if events:
+                self.events.extend(events)
+            if flush:
+                self.flush_requested = True
+            if started or self.flush_requested or len(self.buffer) >= self.batch_size:
+                self.buffer_changed.notify_all()
+
+    def check_geofences(self, rows):
+        try:
+            self.geofences.maybe_reload()
+        except ValueError as e:
+            log.warning("%s", e)
+        with GEOFENCE_SECONDS.time():
+            events = self.geofences.evaluate(rows)
+        for event in events:
+            GEOFENCE_EVENTS.labels(event['event']).inc()
+            log.debug("Device %s: %s %s", event['device_id'], event['event'], event['fence_id'])
+        return events
+
+    def flush_loop(self):
+        while True:
+            with self.buffer_changed:
+                while not self.closed and not self.flush_requested and len(self.buffer) < self.batch_size:
+                    if self.buffer:
+                        remaining = self.first_buffered_at + self.flush_interval - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self.buffer_changed.wait(remaining)
+                    else:
+                        self.buffer_changed.wait()
+                if self.closed:
+                    return
+            self.flush()
+
+    def flush(self):
+        """Write every buffered row in a single transaction."""
+        with self.buffer_changed:
+            rows, self.buffer = self.buffer, []
+            events, self.events = self.events, []
+            self.first_buffered_at = None
+            self.flush_requested = False
+            self.buffer_changed.notify_all()
+        if not rows:
+            return
+        try:
+            self.write(rows)
+        finally:
+            # Events describe where the devices went, whether or not the rows made it in.
+            if events and self.publisher:
+                self.publisher.publish('geofence', events)
+
+    def write(self, rows):
+        """Insert rows and commit, then hand them to the live feed."""
+        start = time.perf_counter()
+        with self.db_lock:
+            try:
+                cursor = self.conn.cursor()
+                self.backend.insert_fixes(cursor, rows)
+                if self.maintain_latest:
+                    self.backend.upsert_latest(cursor, rows)
+                inserted = time.perf_counter()
+                self.conn.commit()
+                COMMIT_SECONDS.observe(time.perf_counter() - inserted)
+                INSERT_SECONDS.observe(inserted - start)
+            except Exception as e:
+                self.stats['rows_failed'] += len(rows)
+                ROWS_FAILED.inc(len(rows))
+                log.error("Error inserting batch of %d rows: %s", len(rows), e)
+                try:
+                    self.conn.rollback()
+                except Exception:
+                    pass
+                return
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        self.stats['flushes'] += 1
+        self.stats['rows_inserted'] += len(rows)
+        self.stats['largest_batch'] = max(self.stats['largest_batch'], len(rows))
+        self.stats['last_flush_ms'] = elapsed_ms
+        self.stats['total_flush_ms'] += elapsed_ms
+        ROWS_INSERTED.inc(len(rows))
+        FLUSH_ROWS.observe(len(rows))
+        log.debug("Inserted %d rows into database in %.1f ms", len(rows), elapsed_ms)
+        if self.publisher:
+            self.publisher.publish('fixes', [self.fix_to_dict(row) for row in rows])
+
+    @staticmethod
+    def fix_to_dict(row):
+        """A row in the shape get_latest_data answers with."""
+        device_id, longitude, latitude, elevation, timestamp = row
+        return {"device_id": device_id, "longitude": longitude, "latitude": latitude,
+                "elevation": elevation, "timestamp": timestamp[:19].replace(' ', 'T')}
+
+    def flush_stats(self):
+        with self.buffer_lock:
+            stats = dict(self.stats, pending=len(self.buffer))
+        stats['avg_batch'] = stats['rows_inserted'] / stats['flushes'] if stats['flushes'] else 0.0
+        stats['avg_flush_ms'] = stats['total_flush_ms'] / stats['flushes'] if stats['flushes'] else 0.0
+        return stats
+
+    @classmethod
+    def parse_fix(cls, data):
+        timestamp = cls.format_timestamp(data['timestamp'])
+        return (data['device_id'], float(data['longitude']), float(data['latitude']), float(data['elevation']), timestamp)
 
     @staticmethod
     def format_timestamp(timestamp_str):
@@ -79,43 +348,467 @@ class DatabaseManager:
         return timestamp_formatted
 
     def close(self):
-        if self.conn:
-            self.conn.close()
+        """Stop the flusher, write whatever is still buffered and close the connection."""
+        with self.buffer_changed:
+            if self.closed:
+                return
+            self.closed = True
+            self.buffer_changed.notify_all()
+        self.flusher.join()
+        self.flush()
+        log.info("Flush stats: %s", self.flush_stats())
+        with self.db_lock:
+            if self.conn:
+                self.conn.close()
+        if self.publisher:
+            self.publisher.close()
+
+def decode_frame(frame, session):
+    """
+    Turn one frame from the stream decoder into database rows. Returns the rows
+    and the bytes to send back to the device, if any. session holds the
+    per-connection state: the negotiated format, the device's key and the
+    device_id its encrypted hello named, see Keyring.new_session.
+
+    A bad frame in a run of encrypted frames (bad padding, a message that
+    doesn't parse, fixes for a device other than the one the key was picked
+    for) is skipped on its own.
+    """
+    if frame[0] == ENCRYPTED_V1:
+        cryptor = session.get('cryptor')
+        if cryptor is None:
+            raise ValueError("Encrypted telemetry, but no key is configured for this device.")
+        device_id = session.get('device_id')
+        rows = []
+        for plaintext in cryptor.decrypt_frames(frame):
+            try:
+                if plaintext is None:
+                    raise ValueError("Bad padding on encrypted message; wrong key?")
+                decoded = decode_plaintext(plaintext)
+                if device_id is not None and any(str(row[0]) != device_id for row in decoded):
+                    raise ValueError(f"Encrypted fixes for another device than {device_id}, the one in the hello.")
+            except (ValueError, KeyError, TypeError) as e:
+                MESSAGES_FAILED.inc()
+                log.warning("Skipping encrypted frame: %s", e)
+                continue
+            FRAMES_DECRYPTED.inc()
+            rows.extend(decoded)
+        return rows, None
+    if frame[0] == BINARY_V1:
+        if session.get('keyring', NO_KEYS).required:
+            raise ValueError("Plaintext telemetry refused; encryption is required.")
+        return list(decode_records(frame)), None
+    message = json.loads(frame)
+    if 'hello' in message:
+        hello = message['hello']
+        session['format'] = negotiate(hello)
+        if not isinstance(hello, dict) or not hello.get('encrypted'):
+            return [], hello_reply(session['format'])
+        if 'device_id' in hello:
+            # The key vouches for this device only; decode_frame holds its fixes to it.
+            session['device_id'] = str(hello['device_id'])
+            session['cryptor'] = session.get('keyring', NO_KEYS).cryptor_for(hello['device_id'])
+        return [], hello_reply(session['format'], encrypted=session.get('cryptor') is not None)
+    if session.get('keyring', NO_KEYS).required:
+        raise ValueError("Plaintext telemetry refused; encryption is required.")
+    if 'batch' in message:
+        return decode_batch(message), None
+    return [DatabaseManager.parse_fix(message)], None
+
+def decode_plaintext(plaintext):
+    """Rows from a decrypted message: binary records, a JSON fix or a JSON batch."""
+    if plaintext[0] == BINARY_V1:
+        # Straight from the decryption buffer, without copying.
+        return list(decode_records(plaintext))
+    message = json.loads(bytes(plaintext))
+    if 'batch' in message:
+        return decode_batch(message)
+    return [DatabaseManager.parse_fix(message)]
+
+def parse_frame(frame, session, address):
+    """decode_frame with the metrics and logging both servers share. A bad frame gives no rows."""
+    MESSAGES_RECEIVED.inc()
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Message from %s: %r", address, frame)
+    start = time.perf_counter()
+    try:
+        rows, reply = decode_frame(frame, session)
+    except Exception as e:
+        MESSAGES_FAILED.inc()
+        log.warning("Error decoding message from %s: %s", address, e)
+        return [], None
+    PARSE_SECONDS.observe(time.perf_counter() - start)
+    MESSAGES_PARSED.inc()
+    FIXES_PARSED.inc(len(rows))
+    return rows, reply
 
 class Server:
-    def __init__(self, host='0.0.0.0', port=5889):
+    """
+    One thread per connection. With reuse_port, several processes can listen
+    on the same port and the kernel spreads connections between them (see
+    Supervisor). on_listening is called once the socket accepts connections.
+    """
+    def __init__(self, host='0.0.0.0', port=5889, db_manager=None, reuse_port=False, on_listening=None, keyring=None):
         self.host = host
         self.port = port
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.db_manager = DatabaseManager()
+        self.db_manager = db_manager or DatabaseManager()
+        self.keyring = keyring or NO_KEYS
+        self.reuse_port = reuse_port
+        self.on_listening = on_listening
 
     def handle_client(self, client_socket, address):
-        print(f"Accepted connection from {address}")
-        while True:
-            data = client_socket.recv(1024)
-            if not data:
-                print(f"Client {address} disconnected")
-                break
-            try:
-                print("Message Recieved: ", data)
-                json_data = json.loads(data)
-                self.db_manager.insert_data(json_data)
-            except Exception as e:
-                print(f"Error handling message from {address}: {e}")
-        client_socket.close()
+        log.debug("Accepted connection from %s", address)
+        CONNECTIONS_ACCEPTED.inc()
+        OPEN_CONNECTIONS.inc()
+        decoder = StreamDecoder()
+        session = self.keyring.new_session()
+        try:
+            while True:
+                data = client_socket.recv(1024)
+                if not data:
+                    log.debug("Client %s disconnected", address)
+                    break
+                for message in decoder.feed(data):
+                    try:
+                        rows, reply = parse_frame(message, session, address)
+                        if reply:
+                            client_socket.sendall(reply)
+                        if rows:
+                            # Batches and binary runs carry a device's backlog; commit them as one insert.
+                            self.db_manager.insert_rows(rows, flush=len(rows) > 1)
+                    except Exception as e:
+                        MESSAGES_FAILED.inc()
+                        log.warning("Error handling message from %s: %s", address, e)
+        except ConnectionError as e:
+            log.warning("Connection error from %s: %s", address, e)
+        finally:
+            OPEN_CONNECTIONS.dec()
+            client_socket.close()
 
     def start(self):
+        if self.reuse_port:
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server_socket.bind((self.host, self.port))
         self.server_socket.listen(100)
-        print(f"TCP Server listening on {self.host}:{self.port}")
+        log.info("TCP Server listening on %s:%s", self.host, self.port)
+        if self.on_listening:
+            self.on_listening()
         try:
             while True:
                 client_socket, address = self.server_socket.accept()
                 client_handler = threading.Thread(target=self.handle_client, args=(client_socket, address), daemon=True)
                 client_handler.start()
         finally:
+            # Stop taking connections before the final flush, so none are accepted and then dropped.
+            self.server_socket.close()
             self.db_manager.close()
 
+class AsyncServer:
+    """
+    Single-process asyncio ingest server. Speaks the same wire format on the same
+    port as Server, but holds every Pico connection on one event loop instead of
+    one OS thread each.
+    """
+    # Bytes buffered per connection before the transport stops reading from the socket.
+    STREAM_LIMIT = 4096
+
+    def __init__(self, host='0.0.0.0', port=5889, max_connections=10000, db_manager=None, reuse_port=False,
+                 on_listening=None, keyring=None):
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self.reuse_port = reuse_port
+        self.on_listening = on_listening
+        self.keyring = keyring or NO_KEYS
+        self.connections = 0
+        self.db_manager = db_manager or DatabaseManager()
+        # A single worker keeps the shared DB connection serialised and off the event loop.
+        self.db_executor = ThreadPoolExecutor(max_workers=1)
+
+    async def handle_client(self, reader, writer):
+        address = writer.get_extra_info('peername')
+        if self.connections >= self.max_connections:
+            CONNECTIONS_REJECTED.inc()
+            log.warning("Rejecting connection from %s: %d connections open", address, self.max_connections)
+            writer.close()
+            return
+        self.connections += 1
+        CONNECTIONS_ACCEPTED.inc()
+        OPEN_CONNECTIONS.inc()
+        log.debug("Accepted connection from %s", address)
+        loop = asyncio.get_running_loop()
+        decoder = StreamDecoder()
+        session = self.keyring.new_session()
+        try:
+            while True:
+                data = await reader.read(1024)
+                if not data:
+                    log.debug("Client %s disconnected", address)
+                    break
+                for message in decoder.feed(data):
+                    try:
+                        rows, reply = parse_frame(message, session, address)
+                        if reply:
+                            writer.write(reply)
+                            await writer.drain()
+                        if rows:
+                            # Nothing more is read from this device until its insert is done,
+                            # so a slow database pushes back through TCP flow control.
+                            await loop.run_in_executor(self.db_executor, self.db_manager.insert_rows, rows, len(rows) > 1)
+                    except Exception as e:
+                        MESSAGES_FAILED.inc()
+                        log.warning("Error handling message from %s: %s", address, e)
+        except ConnectionError as e:
+            log.warning("Connection error from %s: %s", address, e)
+        finally:
+            self.connections -= 1
+            OPEN_CONNECTIONS.dec()
+            writer.close()
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle_client, self.host, self.port,
+                                            limit=self.STREAM_LIMIT, backlog=1024, reuse_port=self.reuse_port or None)
+        log.info("Async TCP Server listening on %s:%s (max %d connections)", self.host, self.port, self.max_connections)
+        if self.on_listening:
+            self.on_listening()
+        async with server:
+            await server.serve_forever()
+
+    def start(self):
+        try:
+            asyncio.run(self.serve())
+        finally:
+            self.db_executor.shutdown(wait=True)
+            self.db_manager.close()
+
+def build_server(args, reuse_port=False, on_listening=None):
+    """The server described by the command line, with its own DatabaseManager."""
+    publisher = FanoutPublisher(args.fanout) if args.fanout != 'none' else None
+    geofences = GeofenceEngine.from_file(args.geofences) if args.geofences else None
+    db_manager = DatabaseManager(batch_size=args.batch_size, flush_interval_ms=args.flush_ms, publisher=publisher,
+                                 backend=get_backend(args.backend), geofences=geofences)
+    keyring = Keyring.from_config(required=args.require_encryption)
+    if args.mode == 'async':
+        return AsyncServer(args.host, args.port, max_connections=args.max_connections, db_manager=db_manager,
+                           reuse_port=reuse_port, on_listening=on_listening, keyring=keyring)
+    return Server(args.host, args.port, db_manager=db_manager, reuse_port=reuse_port, on_listening=on_listening,
+                  keyring=keyring)
+
+def run_worker(index, args, events):
+    """
+    Body of a supervised worker process: its own listening socket on the
+    shared port, database connection and batch writer. Reports ('ready', ...)
+    once it is listening and ('stats', ...) with a metrics snapshot every
+    stats_interval seconds.
+    """
+    setup_logging(args.log_level, process_name=True)
+    # Ctrl-C reaches the whole process group; the supervisor stops workers with SIGTERM instead.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    pid = os.getpid()
+
+    def report_stats():
+        while True:
+            time.sleep(args.stats_interval)
+            events.put(('stats', index, pid, REGISTRY.snapshot()))
+
+    def listening():
+        events.put(('ready', index, pid, REGISTRY.snapshot()))
+        threading.Thread(target=report_stats, daemon=True).start()
+
+    build_server(args, reuse_port=True, on_listening=listening).start()
+
+class Supervisor:
+    """
+    Runs args.workers copies of the ingest server in separate processes, all
+    listening on one port with SO_REUSEPORT, so parsing scales past one core's
+    worth of GIL. Each worker has its own database connection and write-behind
+    buffer.
+
+    Workers that die are started again. SIGHUP restarts them one at a time,
+    starting the replacement before stopping the old worker, so the port never
+    goes unserved; workers are spawned fresh, so a restart picks up new code.
+    A stopped worker flushes its buffer and closes its connections; those
+    devices reconnect, land on another worker and send what they buffered
+    meanwhile. SIGTERM or SIGINT stops every worker the same way.
+
+    Metrics from every worker are served together on --metrics-port with a
+    worker label, and a per-worker summary is logged every stats_interval.
+    """
+    # Shortest time between restarts of a worker that keeps dying.
+    RESPAWN_BACKOFF = 1.0
+
+    def __init__(self, args):
+        self.args = args
+        # Not fork: a forked worker would run the code the supervisor loaded, not what is on disk.
+        self.context = multiprocessing.get_context('spawn')
+        self.events = self.context.Queue()
+        self.workers = {}
+        self.started_at = {}
+        self.summaries = {}
+        self.stopping = False
+        self.restart_requested = False
+        self.registry = Registry()
+        self.worker_metrics = SnapshotCollector('worker', self.registry)
+        self.restarts = Counter('gps_worker_restarts_total', "Workers started again after exiting.", ['worker'],
+                                registry=self.registry)
+        Gauge('gps_workers', "Worker processes running.", registry=self.registry).set_function(
+            lambda: sum(process.is_alive() for process in self.workers.values()))
+
+    def spawn(self, index):
+        process = self.context.Process(target=run_worker, args=(index, self.args, self.events), name=f'worker-{index}')
+        process.start()
+        self.started_at[index] = time.monotonic()
+        return process
+
+    def handle_event(self, event):
+        kind, index, pid, snapshot = event
+        # During a rolling restart the old worker may still report; keep the current one's figures.
+        if self.workers.get(index) is not None and self.workers[index].pid != pid:
+            return
+        self.worker_metrics.update(index, snapshot)
+        self.summaries[index] = (pid, {name: sum(sample for _, sample in metric['samples'])
+                                       for name, metric in snapshot.items() if metric['kind'] != 'histogram'})
+
+    def wait_ready(self, index, pid, timeout):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                event = self.events.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if event[0] == 'ready' and event[1] == index and event[2] == pid:
+                return True
+            self.handle_event(event)
+        return False
+
+    def drain_events(self, timeout):
+        try:
+            self.handle_event(self.events.get(timeout=timeout))
+            while True:
+                self.handle_event(self.events.get_nowait())
+        except queue.Empty:
+            pass
+
+    def stop_worker(self, process):
+        process.terminate()
+        process.join(self.args.stop_timeout)
+        if process.is_alive():
+            log.warning("%s did not stop within %s s; killing it", process.name, self.args.stop_timeout)
+            process.kill()
+            process.join()
+
+    def rolling_restart(self):
+        log.info("Restarting %d workers", len(self.workers))
+        for index in sorted(self.workers):
+            old = self.workers[index]
+            new = self.spawn(index)
+            self.workers[index] = new
+            if not self.wait_ready(index, new.pid, self.args.stop_timeout):
+                log.error("%s did not come up; keeping the old one and abandoning the restart", new.name)
+                self.workers[index] = old
+                self.stop_worker(new)
+                return
+            self.stop_worker(old)
+            log.info("%s restarted (pid %d -> %d)", new.name, old.pid, new.pid)
+
+    def log_stats(self):
+        for index, (pid, totals) in sorted(self.summaries.items()):
+            log.info("worker-%d (pid %d): %d messages, %d failed, %d rows inserted, %d open connections, %d pending rows",
+                     index, pid, totals.get('gps_messages_received_total', 0), totals.get('gps_messages_failed_total', 0),
+                     totals.get('gps_rows_inserted_total', 0), totals.get('gps_open_connections', 0),
+                     totals.get('gps_pending_rows', 0))
+
+    def request_stop(self, signum, frame):
+        self.stopping = True
+
+    def request_restart(self, signum, frame):
+        self.restart_requested = True
+
+    def run(self):
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise SystemExit("--workers needs SO_REUSEPORT, which this platform does not have.")
+        backend = get_backend(self.args.backend)
+        if backend.embedded:
+            # Migrate once here rather than in every worker at the same time.
+            conn = backend.connect()
+            migrate(conn, backend, quiet=True)
+            conn.close()
+        signal.signal(signal.SIGTERM, self.request_stop)
+        signal.signal(signal.SIGINT, self.request_stop)
+        signal.signal(signal.SIGHUP, self.request_restart)
+        if self.args.metrics_port:
+            start_http_server(self.args.metrics_port, registry=self.registry)
+
+        for index in range(self.args.workers):
+            self.workers[index] = self.spawn(index)
+        log.info("Started %d workers on port %s", self.args.workers, self.args.port)
+        next_stats = time.monotonic() + self.args.stats_interval
+        while not self.stopping:
+            self.drain_events(timeout=0.5)
+            if self.restart_requested:
+                self.restart_requested = False
+                self.rolling_restart()
+            for index, process in list(self.workers.items()):
+                if not process.is_alive() and not self.stopping:
+                    if time.monotonic() - self.started_at[index] < self.RESPAWN_BACKOFF:
+                        continue
+                    log.warning("%s (pid %d) exited with code %s; starting it again", process.name, process.pid, process.exitcode)
+                    self.restarts.labels(index).inc()
+                    self.workers[index] = self.spawn(index)
+            if time.monotonic() >= next_stats:
+                next_stats += self.args.stats_interval
+                self.log_stats()
+
+        log.info("Stopping %d workers", len(self.workers))
+        for process in self.workers.values():
+            process.terminate()
+        for process in self.workers.values():
+            self.stop_worker(process)
+
 if __name__ == "__main__":
-    server = Server()
-    server.start()
+    parser = argparse.ArgumentParser(description="TCP ingest server for Pico telemetry.")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5889)
+    parser.add_argument('--mode', choices=['threaded', 'async'], default='threaded',
+                        help="threaded: one thread per connection, async: single asyncio event loop")
+    parser.add_argument('--max-connections', type=int, default=10000,
+                        help="Connection limit for async mode")
+    parser.add_argument('--batch-size', type=int, default=100,
+                        help="Rows per group commit")
+    parser.add_argument('--flush-ms', type=int, default=500,
+                        help="Longest a row waits in the buffer before it is committed")
+    parser.add_argument('--fanout', default=FANOUT_PATH,
+                        help="Unix socket the API listens on for live fixes, or 'none' to disable")
+    parser.add_argument('--geofences',
+                        help="JSON file of geofences to check fixes against (see geofence.py); reloaded when it changes")
+    parser.add_argument('--backend', choices=list(BACKENDS),
+                        help="Storage backend (default: STORAGE_BACKEND or secret.backend, else mariadb)")
+    parser.add_argument('--metrics-port', type=int, default=9188,
+                        help="Serve Prometheus metrics on 127.0.0.1 at this port, or 0 to disable")
+    parser.add_argument('--log-level', choices=LEVELS, default='INFO',
+                        help="DEBUG logs every message received")
+    parser.add_argument('--require-encryption', action='store_true',
+                        help="Refuse plaintext fixes; keys come from TELEMETRY_KEY or secret.telemetry_key/device_keys")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Worker processes sharing the port with SO_REUSEPORT; SIGHUP restarts them one by one")
+    parser.add_argument('--stats-interval', type=float, default=60.0,
+                        help="Seconds between per-worker stats lines with --workers")
+    parser.add_argument('--stop-timeout', type=float, default=30.0,
+                        help="Seconds a worker gets to flush and exit, or to come up on restart")
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        setup_logging(args.log_level, process_name=True)
+        Supervisor(args).run()
+        sys.exit(0)
+
+    setup_logging(args.log_level)
+    if args.metrics_port:
+        start_http_server(args.metrics_port)
+
+    # Turn SIGTERM into a normal exit so the buffered rows are flushed on the way out.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    build_server(args).start()
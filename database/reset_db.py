@@ -1,25 +1,20 @@
-import mariadb
-import secret  # Make sure to have a secret.py file with the DB credentials
+from migrate_db import LATEST_TABLE_VERSION, check_schema_version
+from storage import DB_ERRORS, get_backend
 
-def connect_to_database():
-    """Connect to the MariaDB database and return the connection."""
+def connect_to_database(backend):
+    """Connect to the database and return the connection."""
     try:
-        conn = mariadb.connect(
-            host=secret.dbhost,
-            database=secret.db,
-            user=secret.user,
-            password=secret.password
-        )
-        return conn
-    except mariadb.Error as e:
-        print(f"Error connecting to MariaDB: {e}")
+        return backend.connect()
+    except DB_ERRORS as e:
+        print(f"Error connecting to the database: {e}")
         return None
 
-def delete_all_entries(conn, table_name):
+def delete_all_entries(conn, backend, table_name):
     """
-    Deletes all entries from the specified table in the MariaDB database.
+    Deletes all entries from the specified table.
 
     :param conn: Database connection.
+    :param backend: Storage backend the connection came from.
     :param table_name: Name of the table to clear.
     """
     try:
@@ -27,18 +22,21 @@ def delete_all_entries(conn, table_name):
         delete_query = f"DELETE FROM {table_name};"
         cursor.execute(delete_query)
         conn.commit()
-        reset_counter = "ALTER TABLE sensor_data AUTO_INCREMENT = 1;"
-        cursor.execute(reset_counter)
+        backend.reset_counter(cursor, table_name)
         conn.commit()
         print(f"All entries from '{table_name}' have been deleted.")
-    except mariadb.Error as e:
-        print(f"Error deleting entries from MariaDB: {e}")
+    except DB_ERRORS as e:
+        print(f"Error deleting entries from the database: {e}")
 
 def main():
-    conn = connect_to_database()
+    backend = get_backend()
+    conn = connect_to_database(backend)
     if conn is not None:
         table_name = "sensor_data"  # Replace with your table name
-        delete_all_entries(conn, table_name)
+        delete_all_entries(conn, backend, table_name)
+        # The API reads latest positions from device_latest once it exists.
+        if check_schema_version(conn) >= LATEST_TABLE_VERSION:
+            delete_all_entries(conn, backend, "device_latest")
         conn.close()
 
 if __name__ == '__main__':
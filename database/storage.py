@@ -0,0 +1,206 @@
+"""
+Storage backends shared by the ingest servers, the API and the maintenance scripts.
+
+Two backends speak the same schema:
+
+    mariadb  the default, a MariaDB server using the credentials in secret.py
+    sqlite   an embedded database file in WAL mode, for single-node sites and
+             for running the whole stack without a database server
+
+Pick one with the STORAGE_BACKEND environment variable or `backend = 'sqlite'`
+in secret.py. The SQLite file is SQLITE_PATH / secret.sqlite_path, by default
+gps_tracker.db next to this module, so ingest and the API find the same file.
+
+Each backend hands out plain DB-API connections. Queries use ? placeholders,
+which both drivers accept, and only the statements whose syntax differs (table
+creation, the device_latest upsert) go through the backend. Catch DB_ERRORS to
+handle errors from either driver.
+"""
+import os
+import sqlite3
+from datetime import datetime
+
+try:
+    import mariadb
+except ImportError:
+    # SQLite-only installs don't need the MariaDB connector.
+    mariadb = None
+
+try:
+    import secret  # Make sure to have a secret.py file with the DB credentials
+except ImportError:
+    secret = None
+
+DEFAULT_SQLITE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gps_tracker.db')
+
+
+class StorageError(Exception):
+    """Errors raised by this layer rather than by a database driver."""
+
+
+DB_ERRORS = (StorageError, sqlite3.Error) + ((mariadb.Error,) if mariadb else ())
+
+# Statements whose syntax differs between backends, keyed by backend name.
+CREATE_SENSOR_DATA = {
+    'mariadb': """
+        CREATE TABLE IF NOT EXISTS sensor_data (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            device_id VARCHAR(255),
+            longitude DOUBLE,
+            latitude DOUBLE,
+            elevation DOUBLE,
+            timestamp DATETIME
+        )
+    """,
+    'sqlite': """
+        CREATE TABLE IF NOT EXISTS sensor_data (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            device_id VARCHAR(255),
+            longitude DOUBLE,
+            latitude DOUBLE,
+            elevation DOUBLE,
+            timestamp DATETIME
+        )
+    """,
+}
+
+INSERT_FIXES = """
+    INSERT INTO sensor_data (device_id, longitude, latitude, elevation, timestamp)
+    VALUES (?, ?, ?, ?, ?)
+"""
+
+
+def newest_per_device(rows):
+    """The newest of each device's (device_id, longitude, latitude, elevation, timestamp) rows."""
+    latest = {}
+    for row in rows:
+        # Timestamps are zero-padded strings, so string order is time order.
+        if row[0] not in latest or row[4] >= latest[row[0]][4]:
+            latest[row[0]] = row
+    return list(latest.values())
+
+
+class MariaDBBackend:
+    name = 'mariadb'
+    # The schema is managed separately with migrate_db.py.
+    embedded = False
+
+    def __init__(self, **connect_args):
+        if not connect_args and secret is not None:
+            connect_args = dict(host=secret.dbhost, database=secret.db, user=secret.user, password=secret.password)
+        self.connect_args = connect_args
+
+    def connect(self, **options):
+        """options are passed to mariadb.connect on top of the credentials, e.g. local_infile=True."""
+        if mariadb is None:
+            raise StorageError("The mariadb package is not installed; pip install mariadb or use the sqlite backend.")
+        return mariadb.connect(**self.connect_args, **options)
+
+    def sql(self, statement):
+        return statement if isinstance(statement, str) else statement[self.name]
+
+    @staticmethod
+    def ping(conn):
+        conn.ping()
+
+    @staticmethod
+    def insert_fixes(cursor, rows):
+        cursor.executemany(INSERT_FIXES, rows)
+
+    @staticmethod
+    def upsert_latest(cursor, rows):
+        """
+        Move each device's row in device_latest forward to the newest fix in rows.
+        A fix older than the stored one (a drained offline backlog) leaves it alone.
+        """
+        # Assignments run left to right, so timestamp has to be updated last.
+        cursor.executemany("""
+            INSERT INTO device_latest (device_id, longitude, latitude, elevation, timestamp)
+            VALUES (?, ?, ?, ?, ?)
+            ON DUPLICATE KEY UPDATE
+                longitude = IF(VALUES(timestamp) >= timestamp, VALUES(longitude), longitude),
+                latitude = IF(VALUES(timestamp) >= timestamp, VALUES(latitude), latitude),
+                elevation = IF(VALUES(timestamp) >= timestamp, VALUES(elevation), elevation),
+                timestamp = GREATEST(timestamp, VALUES(timestamp))
+        """, newest_per_device(rows))
+
+    @staticmethod
+    def reset_counter(cursor, table):
+        cursor.execute(f"ALTER TABLE {table} AUTO_INCREMENT = 1")
+
+
+class SQLiteConnection(sqlite3.Connection):
+    """Accepts the MariaDB-only cursor(buffered=...) argument; SQLite cursors always stream."""
+    def cursor(self, *args, buffered=None, **kwargs):
+        return super().cursor(*args, **kwargs)
+
+
+# Store datetimes the way MariaDB prints them and read DATETIME/TIMESTAMP
+# columns back as datetime objects, like the MariaDB connector returns them.
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(' '))
+sqlite3.register_converter('DATETIME', lambda value: datetime.fromisoformat(value.decode()))
+sqlite3.register_converter('TIMESTAMP', lambda value: datetime.fromisoformat(value.decode()))
+
+
+class SQLiteBackend:
+    name = 'sqlite'
+    # No server and no DBA: whoever opens the file first brings the schema up to date.
+    embedded = True
+
+    def __init__(self, path=DEFAULT_SQLITE_PATH, busy_timeout=5.0):
+        self.path = path
+        self.busy_timeout = busy_timeout
+
+    def connect(self):
+        # Pooled connections move between threads, one thread at a time.
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout, detect_types=sqlite3.PARSE_DECLTYPES,
+                               check_same_thread=False, factory=SQLiteConnection)
+        # WAL lets the API read while ingest writes; NORMAL only syncs at checkpoints,
+        # which can lose the last commits on power loss but never corrupts the file.
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def sql(self, statement):
+        return statement if isinstance(statement, str) else statement[self.name]
+
+    @staticmethod
+    def ping(conn):
+        conn.execute("SELECT 1")
+
+    @staticmethod
+    def insert_fixes(cursor, rows):
+        # DATETIME is stored as text here, so drop the fraction MariaDB would drop;
+        # otherwise string comparisons against whole seconds would be off.
+        cursor.executemany(INSERT_FIXES, [row[:4] + (str(row[4])[:19],) for row in rows])
+
+    @staticmethod
+    def upsert_latest(cursor, rows):
+        """Same as MariaDBBackend.upsert_latest."""
+        cursor.executemany("""
+            INSERT INTO device_latest (device_id, longitude, latitude, elevation, timestamp)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (device_id) DO UPDATE SET
+                longitude = excluded.longitude,
+                latitude = excluded.latitude,
+                elevation = excluded.elevation,
+                timestamp = excluded.timestamp
+            WHERE excluded.timestamp >= device_latest.timestamp
+        """, [row[:4] + (str(row[4])[:19],) for row in newest_per_device(rows)])
+
+    @staticmethod
+    def reset_counter(cursor, table):
+        cursor.execute("DELETE FROM sqlite_sequence WHERE name = ?", (table,))
+
+
+BACKENDS = {MariaDBBackend.name: MariaDBBackend, SQLiteBackend.name: SQLiteBackend}
+
+
+def get_backend(name=None):
+    """The configured backend, or the one called name."""
+    name = name or os.environ.get('STORAGE_BACKEND') or getattr(secret, 'backend', MariaDBBackend.name)
+    if name not in BACKENDS:
+        raise StorageError(f"Unknown storage backend '{name}', expected one of {', '.join(BACKENDS)}.")
+    if name == SQLiteBackend.name:
+        return SQLiteBackend(os.environ.get('SQLITE_PATH') or getattr(secret, 'sqlite_path', DEFAULT_SQLITE_PATH))
+    return MariaDBBackend()
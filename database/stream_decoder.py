@@ -0,0 +1,195 @@
+"""
+Incremental decoder for the Pico telemetry byte stream.
+
+TCP does not preserve message boundaries, so one recv() can hold several
+messages or only part of one. StreamDecoder buffers what it is fed and hands
+back every complete frame. Five framings are understood and can be mixed on
+one connection:
+
+* newline-delimited JSON: {"device_id": ...}\\n
+* unframed JSON objects back to back, as sent by older firmware: {...}{...}
+* length-prefixed frames: 0x00, payload length as a big-endian uint16, payload
+* fixed-size binary records (see telemetry_codec), returned as one frame per
+  run of consecutive records
+* encrypted frames: 0x82, ciphertext length as a big-endian uint16, ciphertext,
+  likewise returned as one frame per run so they can be decrypted together
+
+Consumed bytes are tracked with an offset and only the unconsumed tail is moved
+to the front of the buffer once per feed(), so a large read full of messages is
+never copied more than once.
+"""
+import re
+import struct
+
+from telemetry_codec import BINARY_V1, ENCRYPTED_HEADER, ENCRYPTED_V1, RECORD_V1
+
+LENGTH_PREFIX = 0x00
+LENGTH_HEADER = struct.Struct('>BH')
+
+OPEN_BRACE = ord('{')
+CLOSE_BRACE = ord('}')
+QUOTE = ord('"')
+BACKSLASH = ord('\\')
+NEWLINE = ord('\n')
+WHITESPACE = b' \t\r\n'
+
+# The only bytes that change the state of the JSON object scanner.
+JSON_TOKENS = re.compile(rb'[{}"\\\n]')
+
+# Returned by the frame readers when they dropped a malformed frame, so that
+# next_frame carries on with the bytes after it.
+DROPPED = object()
+
+
+class StreamDecoder:
+    def __init__(self, max_frame=65536):
+        self.max_frame = max_frame
+        self.buffer = bytearray()
+        self.pos = 0
+        self.errors = 0
+        self.reset_scan()
+
+    def reset_scan(self):
+        # Where the JSON scanner resumes, and its state at that point.
+        self.scan = None
+        self.depth = 0
+        self.in_string = False
+
+    def feed(self, data):
+        """Append data from the socket and return the complete frames as bytes."""
+        self.buffer += data
+        frames = []
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                break
+            frames.append(frame)
+        if self.pos:
+            del self.buffer[:self.pos]
+            if self.scan is not None:
+                self.scan -= self.pos
+            self.pos = 0
+        return frames
+
+    def pending(self):
+        """Number of buffered bytes that do not form a complete frame yet."""
+        return len(self.buffer) - self.pos
+
+    def next_frame(self):
+        """The next complete frame, or None. Malformed input is skipped in a loop, however much of it there is."""
+        buffer = self.buffer
+        end = len(buffer)
+        while True:
+            while self.pos < end and buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos == end:
+                return None
+
+            lead = buffer[self.pos]
+            if lead == OPEN_BRACE:
+                frame = self.next_json_frame()
+            elif lead == LENGTH_PREFIX:
+                frame = self.next_length_prefixed_frame()
+            elif lead == BINARY_V1:
+                frame = self.next_binary_frame()
+            elif lead == ENCRYPTED_V1:
+                frame = self.next_encrypted_frame()
+            else:
+                # Not the start of any frame: skip to the next thing that could be one.
+                self.errors += 1
+                resync = buffer.find(b'{', self.pos)
+                self.pos = resync if resync != -1 else end
+                continue
+            if frame is not DROPPED:
+                return frame
+
+    def next_length_prefixed_frame(self):
+        if len(self.buffer) - self.pos < LENGTH_HEADER.size:
+            return None
+        _, length = LENGTH_HEADER.unpack_from(self.buffer, self.pos)
+        start = self.pos + LENGTH_HEADER.size
+        if len(self.buffer) - start < length:
+            return None
+        self.pos = start + length
+        return bytes(self.buffer[start:self.pos])
+
+    def next_binary_frame(self):
+        start = end = self.pos
+        size = RECORD_V1.size
+        while len(self.buffer) - end >= size and self.buffer[end] == BINARY_V1:
+            end += size
+        if end == start:
+            return None
+        self.pos = end
+        return bytes(self.buffer[start:end])
+
+    def next_encrypted_frame(self):
+        start = end = self.pos
+        size = ENCRYPTED_HEADER.size
+        while len(self.buffer) - end >= size and self.buffer[end] == ENCRYPTED_V1:
+            _, length = ENCRYPTED_HEADER.unpack_from(self.buffer, end)
+            if len(self.buffer) - end - size < length:
+                break
+            end += size + length
+        if end == start:
+            return None
+        self.pos = end
+        return bytes(self.buffer[start:end])
+
+    def next_json_frame(self):
+        buffer = self.buffer
+        if self.scan is None:
+            # Fast path for the common newline-delimited flat object: one brace
+            # pair on the line means there is nothing to scan for.
+            newline = buffer.find(b'\n', self.pos)
+            if newline != -1:
+                line_end = newline
+                while line_end > self.pos and buffer[line_end - 1] in WHITESPACE:
+                    line_end -= 1
+                if (buffer[line_end - 1] == CLOSE_BRACE
+                        and buffer.count(b'{', self.pos, line_end) == 1
+                        and buffer.count(b'}', self.pos, line_end) == 1):
+                    start, self.pos = self.pos, newline + 1
+                    return bytes(buffer[start:line_end])
+            self.scan = self.pos
+        skip_to = self.scan
+        for match in JSON_TOKENS.finditer(buffer, self.scan):
+            i = match.start()
+            if i < skip_to:
+                continue
+            c = buffer[i]
+            if c == NEWLINE:
+                # Neither the firmware nor a newline-delimited sender puts a raw
+                # newline inside an object, so this one ends a malformed frame.
+                return self.drop_frame(i + 1)
+            if self.in_string:
+                if c == BACKSLASH:
+                    skip_to = i + 2
+                elif c == QUOTE:
+                    self.in_string = False
+            elif c == QUOTE:
+                self.in_string = True
+            elif c == OPEN_BRACE:
+                self.depth += 1
+            elif c == CLOSE_BRACE:
+                self.depth -= 1
+                if self.depth == 0:
+                    start, self.pos = self.pos, i + 1
+                    self.reset_scan()
+                    return bytes(buffer[start:self.pos])
+
+        # Incomplete object: the next feed() resumes where this scan stopped.
+        if skip_to > len(buffer):
+            # The buffer ends on a backslash; rescan it once the escaped byte arrives.
+            self.scan = len(buffer) - 1
+        else:
+            self.scan = len(buffer)
+        if len(buffer) - self.pos > self.max_frame:
+            return self.drop_frame(len(buffer))
+        return None
+
+    def drop_frame(self, end):
+        self.errors += 1
+        self.pos = end
+        self.reset_scan()
+        return DROPPED
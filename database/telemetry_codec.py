@@ -0,0 +1,100 @@
+"""
+Compact binary telemetry records and per-connection format negotiation.
+
+A version 1 record is 21 bytes, little-endian, fixed layout:
+
+    B  version       0x81, also the frame marker the stream decoder looks for
+    I  device_id
+    i  latitude      degrees * 1e7
+    i  longitude     degrees * 1e7
+    i  elevation     centimetres
+    I  epoch time    seconds since 1970-01-01 UTC
+
+A device asks for a format by sending {"hello": {"formats": [...]}} as its first
+JSON message. The server answers {"format": ...} with the first one it supports,
+and a device that never gets an answer keeps sending one JSON fix per message.
+An answer also tells the device that JSON batch messages are understood.
+
+Encrypted telemetry wraps any of those messages in a frame of its own:
+
+    B  0x82
+    H  ciphertext length, big-endian
+       AES-256-ECB ciphertext of the message, padded to a multiple of 32 bytes
+       the way the firmware's EncryptionManager pads it
+
+A device that encrypts says so in its hello, {"hello": {..., "device_id": "7",
+"encrypted": true}}, so the server can pick that device's key, and the answer
+carries "encrypted": whether the server has a key for it. Encrypted fixes on
+that connection are then only accepted for that device.
+"""
+import json
+import struct
+from datetime import datetime, timezone
+
+BINARY_V1 = 0x81
+RECORD_V1 = struct.Struct('<BIiiiI')
+ENCRYPTED_V1 = 0x82
+ENCRYPTED_HEADER = struct.Struct('>BH')
+# The firmware pads both the key and each message to this many bytes.
+CRYPTO_BLOCK = 32
+COORD_SCALE = 10_000_000
+ELEVATION_SCALE = 100
+
+FORMAT_JSON = 'json'
+FORMAT_BINARY_V1 = 'bin1'
+SUPPORTED_FORMATS = (FORMAT_BINARY_V1, FORMAT_JSON)
+
+
+def encode_record(device_id, latitude, longitude, elevation, epoch):
+    return RECORD_V1.pack(BINARY_V1, int(device_id), round(latitude * COORD_SCALE),
+                          round(longitude * COORD_SCALE), round(elevation * ELEVATION_SCALE), int(epoch))
+
+
+def decode_records(frame):
+    """
+    Decode a run of back-to-back version 1 records into database rows.
+    iter_unpack reads straight out of the frame through a memoryview, so the
+    only objects created are the values in each row.
+    """
+    for _, device_id, latitude, longitude, elevation, epoch in RECORD_V1.iter_unpack(memoryview(frame)):
+        yield (str(device_id), longitude / COORD_SCALE, latitude / COORD_SCALE, elevation / ELEVATION_SCALE, format_epoch(epoch))
+
+
+def decode_batch(message):
+    """
+    Rows from a JSON batch message, sent by devices draining their offline buffer:
+    {"device_id": "1", "batch": [[longitude, latitude, elevation, epoch], ...]}
+    """
+    device_id = str(message['device_id'])
+    return [(device_id, float(longitude), float(latitude), float(elevation), format_epoch(epoch))
+            for longitude, latitude, elevation, epoch in message['batch']]
+
+
+def format_epoch(epoch):
+    return datetime.fromtimestamp(int(epoch), timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f")
+
+
+def negotiate(hello):
+    """Pick the format for a connection from the list a device offered."""
+    offered = hello.get('formats', []) if isinstance(hello, dict) else []
+    for fmt in SUPPORTED_FORMATS:
+        if fmt in offered:
+            return fmt
+    return FORMAT_JSON
+
+
+def hello_reply(fmt, encrypted=None):
+    reply = {"format": fmt}
+    if encrypted is not None:
+        reply["encrypted"] = encrypted
+    return json.dumps(reply).encode("utf-8") + b"\n"
+
+
+def pad(data, block_size=CRYPTO_BLOCK):
+    """PKCS#7-style padding to block_size, as EncryptionManager.pad on the Pico does it."""
+    n = block_size - (len(data) % block_size)
+    return data + bytes([n] * n)
+
+
+def encrypted_frame(ciphertext):
+    return ENCRYPTED_HEADER.pack(ENCRYPTED_V1, len(ciphertext)) + ciphertext
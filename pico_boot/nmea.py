@@ -0,0 +1,394 @@
+"""
+NMEA 0183 parser that does not allocate while parsing.
+
+Reading the GPS with buffer += data.decode() and line.split(',') builds a new
+string for every read, line and field, and on the Pico that garbage is what
+sets off the collector. NMEAParser instead takes the raw bytes as they come
+(from I2C readfrom_into or UART readinto into a reused buffer), writes each
+sentence into a preallocated bytearray ring, XORs the checksum as it goes and
+remembers where each field starts. Once the *hh checksum matches, the fields
+are decoded straight out of the ring into small ints: coordinates in 1e-7
+degrees, altitude in cm, speed in 1/1000 knot, DOPs in hundredths, exactly
+the scaled ints FixBuffer stores, with no float rounding on the way.
+
+GGA, RMC, GSA and ZDA are understood, from any talker (GP, GN, GL, ...);
+other sentences are checked and skipped. The results are plain attributes,
+and feed() returns which sentence types it parsed:
+
+    gps = NMEAParser()
+    buf = bytearray(32)
+    i2c.readfrom_into(0x10, buf)
+    if gps.feed(buf) & GGA and gps.fix_quality:
+        push(gps.lat_e7, gps.lon_e7, gps.altitude_cm)
+
+Runs under MicroPython and CPython alike; bench_nmea.py checks it against
+recorded sentences on a desktop. On 32-bit ports, ints beyond +-2**30 are
+heap objects, so longitudes past 107 degrees cost one small allocation per
+fix, and epoch() allocates (it is meant to be called once per fix, not per
+byte).
+"""
+try:
+    from micropython import const
+except ImportError:
+    def const(value):
+        return value
+
+# Bits in the mask feed() returns.
+GGA = const(1)
+RMC = const(2)
+GSA = const(4)
+ZDA = const(8)
+
+RING_SIZE = const(256)
+# Longest sentence NMEA 0183 allows, from '$' to the checksum, is 82 bytes with CR LF.
+MAX_SENTENCE = const(82)
+MAX_FIELDS = const(24)
+
+# Sentence formatters packed into ints so dispatching compares ints, not strings.
+_GGA = const(0x474741)
+_RMC = const(0x524D43)
+_GSA = const(0x475341)
+_ZDA = const(0x5A4441)
+
+_IDLE = const(0)
+_BODY = const(1)
+_CHECK_HIGH = const(2)
+_CHECK_LOW = const(3)
+
+
+def _hex_value(c):
+    if 48 <= c <= 57:
+        return c - 48
+    if 65 <= c <= 70:
+        return c - 55
+    if 97 <= c <= 102:
+        return c - 87
+    return -1
+
+
+def days_from_civil(year, month, day):
+    """Days since 1970-01-01 of a Gregorian date."""
+    year -= month <= 2
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
+
+
+class NMEAParser:
+    def __init__(self, ring_size=RING_SIZE):
+        if ring_size & (ring_size - 1) or ring_size < 2 * MAX_SENTENCE:
+            raise ValueError("ring_size must be a power of two of at least 2 * MAX_SENTENCE")
+        self.ring = bytearray(ring_size)
+        self.mask = ring_size - 1
+        # The sentence being received: ring index of the byte after '$', bytes
+        # so far, offset of each field's first byte and of the '*'.
+        self.start = 0
+        self.length = 0
+        self.fields = bytearray(MAX_FIELDS + 1)
+        self.field_count = 0
+        self.end = 0
+        self.state = _IDLE
+        self.checksum = 0
+        self.expected = 0
+
+        # UTC time of the last GGA, RMC or ZDA; date of the last RMC or ZDA
+        # (year 0 until one is seen) and the time of day it came with.
+        self.hour = 0
+        self.minute = 0
+        self.second = 0
+        self.year = 0
+        self.month = 0
+        self.day = 0
+        self.date_seconds = 0
+        # GGA
+        self.fix_quality = 0
+        self.satellites = 0
+        self.altitude_cm = 0
+        # GGA or RMC with a fix: 1e-7 degrees, negative south and west.
+        self.lat_e7 = 0
+        self.lon_e7 = 0
+        self.has_position = False
+        # RMC
+        self.valid = False
+        self.speed_knots_e3 = 0
+        self.course_e2 = 0
+        # GSA (the last one, where a multi-constellation receiver sends one per system)
+        self.fix_type = 0
+        self.satellites_used = 0
+        self.pdop_e2 = 0
+        self.hdop_e2 = 0
+        self.vdop_e2 = 0
+
+        self.sentences = 0
+        self.checksum_errors = 0
+        self.overflows = 0
+        self.malformed = 0
+        self.unsupported = 0
+
+    def reset(self):
+        """Drop a partly received sentence, e.g. after the reads were interrupted."""
+        self.state = _IDLE
+
+    def feed(self, data, n=-1):
+        """
+        Consume the first n bytes of data (a bytes-like object; all of it by
+        default). Sentences may be split across calls. Returns a mask of the
+        sentence types parsed (GGA | RMC | GSA | ZDA).
+        """
+        if n < 0:
+            n = len(data)
+        parsed = 0
+        ring = self.ring
+        mask = self.mask
+        fields = self.fields
+        # The per-byte state lives in locals while the loop runs.
+        state = self.state
+        start = self.start
+        length = self.length
+        checksum = self.checksum
+        for i in range(n):
+            c = data[i]
+            if c == 36:  # '$' starts a sentence, abandoning any partial one
+                start = (start + length + 1) & mask
+                length = 0
+                checksum = 0
+                self.field_count = 1
+                fields[0] = 0
+                state = _BODY
+            # A sentence ends with its checksum, so LF carries nothing; skipping
+            # it also skips the '\n' an I2C receiver pads empty reads with,
+            # which can land in the middle of a sentence.
+            elif state == _IDLE or c == 10:
+                continue
+            elif state == _BODY:
+                if c == 42:  # '*'
+                    self.end = length
+                    state = _CHECK_HIGH
+                elif c == 13:  # a line without a checksum
+                    self.checksum_errors += 1
+                    state = _IDLE
+                elif length == MAX_SENTENCE:  # noise that never ends
+                    self.overflows += 1
+                    state = _IDLE
+                else:
+                    ring[(start + length) & mask] = c
+                    length += 1
+                    checksum ^= c
+                    if c == 44:  # ','
+                        if self.field_count == MAX_FIELDS:
+                            self.overflows += 1
+                            state = _IDLE
+                        else:
+                            fields[self.field_count] = length
+                            self.field_count += 1
+            else:
+                value = _hex_value(c)
+                if value < 0:
+                    self.checksum_errors += 1
+                    state = _IDLE
+                elif state == _CHECK_HIGH:
+                    self.expected = value << 4
+                    state = _CHECK_LOW
+                else:
+                    state = _IDLE
+                    if self.expected | value == checksum:
+                        self.start = start
+                        parsed |= self._dispatch()
+                    else:
+                        self.checksum_errors += 1
+        self.state = state
+        self.start = start
+        self.length = length
+        self.checksum = checksum
+        return parsed
+
+    # Field access. Offsets are relative to self.start; field k runs from
+    # fields[k] up to the comma before fields[k + 1], or to the '*'.
+
+    def _char(self, offset):
+        return self.ring[(self.start + offset) & self.mask]
+
+    def _stop(self, k):
+        return self.fields[k + 1] - 1 if k + 1 < self.field_count else self.end
+
+    def _empty(self, k):
+        return k >= self.field_count or self.fields[k] == self._stop(k)
+
+    def _uint(self, k, default=0):
+        """The leading digits of field k as an int, or default if it is empty."""
+        if self._empty(k):
+            return default
+        value = 0
+        for offset in range(self.fields[k], self._stop(k)):
+            digit = self._char(offset) - 48
+            if not 0 <= digit <= 9:
+                break
+            value = value * 10 + digit
+        return value
+
+    def _scaled(self, k, decimals, default=0):
+        """Field k as a signed decimal times 10**decimals, extra decimals truncated."""
+        if self._empty(k):
+            return default
+        offset = self.fields[k]
+        stop = self._stop(k)
+        negative = self._char(offset) == 45  # '-'
+        if negative:
+            offset += 1
+        value = 0
+        remaining = -1  # decimals still to take; -1 until the '.'
+        while offset < stop and remaining:
+            c = self._char(offset)
+            offset += 1
+            if c == 46:  # '.'
+                remaining = decimals
+                continue
+            value = value * 10 + c - 48
+            if remaining > 0:
+                remaining -= 1
+        if remaining < 0:
+            remaining = decimals
+        while remaining:
+            value *= 10
+            remaining -= 1
+        return -value if negative else value
+
+    def _coordinate(self, k, degree_digits):
+        """
+        ddmm.mmmm (or dddmm.mmmm) in field k, hemisphere in field k + 1, as
+        1e-7 degrees. Minutes are kept to 1e-6, which is below a centimetre.
+        """
+        offset = self.fields[k]
+        stop = self._stop(k)
+        degrees = 0
+        for _ in range(degree_digits):
+            degrees = degrees * 10 + self._char(offset) - 48
+            offset += 1
+        minutes = 0  # in 1e-6 minutes
+        scale = 1000000
+        fraction = False
+        while offset < stop:
+            c = self._char(offset)
+            offset += 1
+            if c == 46:
+                fraction = True
+                continue
+            if fraction:
+                if scale == 1:
+                    break
+                scale //= 10
+                minutes += (c - 48) * scale
+            else:
+                minutes = minutes * 10 + (c - 48) * 1000000
+        # 1e-6 minutes to 1e-7 degrees is * 10 / 60.
+        value = degrees * 10000000 + (minutes + 3) // 6
+        hemisphere = self._char(self.fields[k + 1]) if not self._empty(k + 1) else 0
+        return -value if hemisphere == 83 or hemisphere == 87 else value  # 'S', 'W'
+
+    def _time(self, k):
+        if self._stop(k) - self.fields[k] < 6:
+            return
+        offset = self.fields[k]
+        self.hour = (self._char(offset) - 48) * 10 + self._char(offset + 1) - 48
+        self.minute = (self._char(offset + 2) - 48) * 10 + self._char(offset + 3) - 48
+        self.second = (self._char(offset + 4) - 48) * 10 + self._char(offset + 5) - 48
+
+    def _position(self, lat_field, lon_field):
+        if self._empty(lat_field) or self._empty(lon_field):
+            return
+        self.lat_e7 = self._coordinate(lat_field, 2)
+        self.lon_e7 = self._coordinate(lon_field, 3)
+        self.has_position = True
+
+    def _dispatch(self):
+        # Standard sentences have a 5-letter address: 2 for the talker, 3 for the type.
+        if self.field_count < 2 or self.fields[1] != 6:
+            self.unsupported += 1
+            return 0
+        kind = self._char(2) << 16 | self._char(3) << 8 | self._char(4)
+        if kind == _GGA:
+            if self.field_count < 10:
+                self.malformed += 1
+                return 0
+            self._time(1)
+            self.fix_quality = self._uint(6)
+            self.satellites = self._uint(7)
+            if self.fix_quality:
+                self._position(2, 4)
+                self.altitude_cm = self._scaled(9, 2, self.altitude_cm)
+            parsed = GGA
+        elif kind == _RMC:
+            if self.field_count < 10:
+                self.malformed += 1
+                return 0
+            self._time(1)
+            self.valid = self._char(self.fields[2]) == 65  # 'A'
+            if self.valid:
+                self._position(3, 5)
+                self.speed_knots_e3 = self._scaled(7, 3)
+                self.course_e2 = self._scaled(8, 2)
+            if self._stop(9) - self.fields[9] == 6:
+                date = self._uint(9)
+                self.day = date // 10000
+                self.month = date // 100 % 100
+                self.year = 2000 + date % 100
+                self.date_seconds = self.hour * 3600 + self.minute * 60 + self.second
+            parsed = RMC
+        elif kind == _GSA:
+            if self.field_count < 18:
+                self.malformed += 1
+                return 0
+            self.fix_type = self._uint(2)
+            used = 0
+            for k in range(3, 15):
+                if not self._empty(k):
+                    used += 1
+            self.satellites_used = used
+            self.pdop_e2 = self._scaled(15, 2)
+            self.hdop_e2 = self._scaled(16, 2)
+            self.vdop_e2 = self._scaled(17, 2)
+            parsed = GSA
+        elif kind == _ZDA:
+            if self.field_count < 5:
+                self.malformed += 1
+                return 0
+            self._time(1)
+            if not (self._empty(2) or self._empty(3) or self._empty(4)):
+                self.day = self._uint(2)
+                self.month = self._uint(3)
+                self.year = self._uint(4)
+                self.date_seconds = self.hour * 3600 + self.minute * 60 + self.second
+            parsed = ZDA
+        else:
+            self.unsupported += 1
+            return 0
+        self.sentences += 1
+        return parsed
+
+    def epoch(self, seconds=None):
+        """
+        Seconds since 1970 UTC of the last time received, or of seconds (of
+        the UTC day, e.g. saved from a GGA), on the last date received. None
+        before a date arrives. A time well before the one the date came with
+        is just past midnight, so it is taken to be on the next day; one well
+        after it is from before midnight (a fix saved before a date for the
+        new day arrived), so on the day before.
+        """
+        if not self.year:
+            return None
+        if seconds is None:
+            seconds = self.hour * 3600 + self.minute * 60 + self.second
+        days = days_from_civil(self.year, self.month, self.day)
+        if seconds + 43200 < self.date_seconds:
+            days += 1
+        elif seconds - 43200 > self.date_seconds:
+            days -= 1
+        return days * 86400 + seconds
+
+    def latitude(self):
+        return self.lat_e7 / 10000000
+
+    def longitude(self):
+        return self.lon_e7 / 10000000
@@ -6,6 +6,9 @@ from datetime import datetime
 import network
 import time
 import socket
+import struct
+from array import array
+from nmea import NMEAParser, GGA
 #import json
 
 
@@ -18,8 +21,24 @@ class Config:
     TIMEZONE_OFFSET = -5 * 3600
     MACHINE_ID = 1
     GPS_ADDR = 0x10
+    GPS_READ_SIZE = 32         # Bytes per I2C read
+    GPS_MAX_READS = 32         # Reads per poll at most, enough for a second of output
+    TELEMETRY_FORMAT = 'bin1'  # 'bin1' asks the server for binary records, 'json' always sends JSON
+    NEGOTIATE_TIMEOUT_S = 2
+    BUFFER_CAPACITY = 1000     # Fixes kept while offline, 16 bytes each (~8 hours at one per 30 s)
+    BUFFER_PATH = 'fixes.bin'  # Mirror the buffer to flash (16 bytes per fix + 16); None keeps it in RAM only
+    BATCH_SIZE = 50            # Fixes per message when draining the buffer
+    ENCRYPT_TELEMETRY = False  # Encrypt messages with GLOBAL_PASSWORD; the server needs the same key
+
+# Seconds between the 1970 epoch the server expects and the port's own epoch.
+EPOCH_OFFSET = 946684800 if time.gmtime(0)[0] == 2000 else 0
 
 class EncryptionManager:
+    ENCRYPTED_V1 = 0x82
+    # One aes object per key: building one runs the key schedule, and an ECB
+    # object can encrypt any number of messages.
+    ciphers = {}
+
     @staticmethod
     def pad(s, block_size=32):
         n = block_size - (len(s) % block_size)
@@ -31,9 +50,17 @@ class EncryptionManager:
 
     @staticmethod
     def encrypt_msg(msg, cipher):
-        encrypter = aes(EncryptionManager.pad(cipher), 1)
+        encrypter = EncryptionManager.ciphers.get(cipher)
+        if encrypter is None:
+            encrypter = EncryptionManager.ciphers[cipher] = aes(EncryptionManager.pad(cipher), 1)
         return encrypter.encrypt(EncryptionManager.pad(msg))
 
+    @staticmethod
+    def frame(msg, cipher):
+        """msg encrypted and framed for the server: 0x82, big-endian length, ciphertext."""
+        ciphertext = EncryptionManager.encrypt_msg(msg, cipher)
+        return struct.pack('>BH', EncryptionManager.ENCRYPTED_V1, len(ciphertext)) + ciphertext
+
 class WiFiManager:
     def __init__(self, ssid, password):
         self.ssid = ssid
@@ -58,81 +85,295 @@ class WiFiManager:
                 print('WiFi connection failed')
 
 class GPSManager:
+    """
+    Reads the GPS over I2C into one reused buffer and parses it with
+    NMEAParser, so polling the receiver allocates nothing. A fix is the last
+    GGA with a position, kept as the scaled ints FixBuffer stores, and its
+    time on the date current when it came in.
+    """
     def __init__(self, i2c):
         self.i2c = i2c
-        self.lat = None
+        self.nmea = NMEAParser()
+        self.chunk = bytearray(Config.GPS_READ_SIZE)
+        self.lat = None            # 1e-7 degrees, None until the first fix
         self.lon = None
-        self.datetime_utc = None
-        self.elevation = 132.6
+        self.elevation = 13260     # cm, until GGA reports an altitude
+        self.fix_seconds = 0       # UTC seconds of the day of the fix
+        self.fix_epoch = None      # seconds since 1970 UTC of the fix, None before a date arrives
         self.gps_updated = False
 
     async def get_gps_data(self):
         print("Getting GPS data...")
-        buffer = ""
+        nmea = self.nmea
+        chunk = self.chunk
         while True:
             try:
-                data = self.i2c.readfrom(Config.GPS_ADDR, 32)
-                if data:
-                    buffer += data.decode('utf-8')
-                    while '\r\n' in buffer:
-                        line, buffer = buffer.split('\r\n', 1)
-                        if line.startswith('$GNGGA'):
-                            self.parse_gngga(line)
+                # Drain what the receiver has queued; it pads an empty read with '\n'.
+                for _ in range(Config.GPS_MAX_READS):
+                    self.i2c.readfrom_into(Config.GPS_ADDR, chunk)
+                    if nmea.feed(chunk) & GGA and nmea.fix_quality and nmea.has_position:
+                        self.lat = nmea.lat_e7
+                        self.lon = nmea.lon_e7
+                        self.elevation = nmea.altitude_cm
+                        self.fix_seconds = nmea.hour * 3600 + nmea.minute * 60 + nmea.second
+                        # Dated now: by the time the fix is sent, the date may be the next day's.
+                        self.fix_epoch = nmea.epoch()
+                        self.gps_updated = True
+                    if chunk[0] == 10 and chunk[-1] == 10:
+                        break
             except Exception as e:
+                nmea.reset()
                 print("GPS read error:", e)
             await asyncio.sleep(1)
 
-    def parse_gngga(self, sentence):
-        parts = sentence.split(',')
-        if len(parts) > 5 and all(parts[idx].strip() for idx in [1, 2, 3, 4, 5]):
-            self.datetime_utc = f"{parts[1][:2]}:{parts[1][2:4]}:{parts[1][4:]}"
-            lat_deg = float(parts[2][:2])
-            lat_min = float(parts[2][2:])
-            self.lat = (lat_deg + (lat_min / 60.0)) * (-1 if parts[3] == 'S' else 1)
-            lon_deg = float(parts[4][:3])
-            lon_min = float(parts[4][3:])
-            self.lon = (lon_deg + (lon_min / 60.0)) * (-1 if parts[5] == 'W' else 1)
-            self.gps_updated = True
-            print("Lat:", self.lat)
-            print("Lon:", self.lon)
+    def epoch(self):
+        """
+        Seconds since 1970 UTC of the last fix. GGA only has the time; the date
+        comes from the last RMC or ZDA before the fix, or from the RTC before
+        one arrives.
+        """
+        if self.fix_epoch is not None:
+            return self.fix_epoch
+        year, month, day = time.gmtime()[:3]
+        hours, rest = divmod(self.fix_seconds, 3600)
+        return time.mktime((year, month, day, hours, rest // 60, rest % 60, 0, 0)) + EPOCH_OFFSET
+
+class FixBuffer:
+    """
+    Bounded ring of fixes waiting for the server. Fixes are stored as scaled ints
+    in preallocated arrays, and the oldest one is overwritten when the ring is
+    full. With a path, the ring is mirrored to a fixed-size file on flash (a
+    header with head and count, then one slot per fix) so the backlog survives
+    a reboot: a push rewrites one slot and the header, a drop only the header.
+    """
+    RECORD = '<iiiI'  # lat * 1e7, lon * 1e7, elevation in cm, epoch seconds
+    RECORD_SIZE = 16
+    HEADER = '<4sIII'  # magic, capacity, head, count
+    HEADER_SIZE = 16
+    MAGIC = b'FXB1'
+
+    def __init__(self, capacity, path=None):
+        self.capacity = capacity
+        self.lat = array('i', bytes(4 * capacity))
+        self.lon = array('i', bytes(4 * capacity))
+        self.elevation = array('i', bytes(4 * capacity))
+        self.epoch = array('I', bytes(4 * capacity))
+        self.head = 0
+        self.count = 0
+        self.path = path
+        self.record = bytearray(self.RECORD_SIZE)
+        if path:
+            self.load()
+
+    def push(self, lat, lon, elevation, epoch, persist=True):
+        """Add a fix given as scaled ints (see RECORD)."""
+        i = (self.head + self.count) % self.capacity
+        if self.count == self.capacity:
+            self.head = (self.head + 1) % self.capacity
+        else:
+            self.count += 1
+        self.lat[i] = lat
+        self.lon[i] = lon
+        self.elevation[i] = elevation
+        self.epoch[i] = epoch
+        if self.path and persist:
+            struct.pack_into(self.RECORD, self.record, 0, lat, lon, elevation, epoch)
+            self.write(i, self.record)
+
+    def get(self, n):
+        """The n-th oldest fix as (lat, lon, elevation, epoch)."""
+        i = (self.head + n) % self.capacity
+        return self.lat[i], self.lon[i], self.elevation[i], self.epoch[i]
+
+    def drop(self, n):
+        """Forget the n oldest fixes once the server has them."""
+        n = min(n, self.count)
+        self.head = (self.head + n) % self.capacity
+        self.count -= n
+        if self.path:
+            self.write()
+
+    def header(self):
+        return struct.pack(self.HEADER, self.MAGIC, self.capacity, self.head, self.count)
+
+    def write(self, slot=None, record=None):
+        """Update the file in place: the given slot, if any, then the header."""
+        try:
+            with open(self.path, 'r+b') as f:
+                if slot is not None:
+                    f.seek(self.HEADER_SIZE + slot * self.RECORD_SIZE)
+                    f.write(record)
+                f.seek(0)
+                f.write(self.header())
+        except OSError as e:
+            print("Could not persist fix buffer:", e)
+
+    def save(self):
+        """Write the whole file, every slot included."""
+        try:
+            with open(self.path, 'wb') as f:
+                f.write(self.header())
+                for i in range(self.capacity):
+                    struct.pack_into(self.RECORD, self.record, 0, self.lat[i], self.lon[i], self.elevation[i], self.epoch[i])
+                    f.write(self.record)
+        except OSError as e:
+            print("Could not persist fix buffer:", e)
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                header = f.read(self.HEADER_SIZE)
+                if len(header) == self.HEADER_SIZE and header[:4] == self.MAGIC:
+                    _, capacity, head, count = struct.unpack(self.HEADER, header)
+                    for n in range(count):
+                        f.seek(self.HEADER_SIZE + (head + n) % capacity * self.RECORD_SIZE)
+                        record = f.read(self.RECORD_SIZE)
+                        if len(record) < self.RECORD_SIZE:
+                            break
+                        self.push(*struct.unpack(self.RECORD, record), persist=False)
+                else:
+                    # Older firmware appended one record per fix.
+                    f.seek(0)
+                    while True:
+                        record = f.read(self.RECORD_SIZE)
+                        if len(record) < self.RECORD_SIZE:
+                            break
+                        self.push(*struct.unpack(self.RECORD, record), persist=False)
+            print("Loaded", self.count, "buffered fixes from flash")
+        except OSError:
+            pass
+        # Start from a file laid out for this capacity; once per boot.
+        self.save()
+
+def scaled_str(value, digits):
+    """Format a scaled int as a decimal string without going through a (single precision) float."""
+    scale = 10 ** digits
+    sign = '-' if value < 0 else ''
+    value = abs(value)
+    fraction = str(value % scale)
+    return '{}{}.{}{}'.format(sign, value // scale, '0' * (digits - len(fraction)), fraction)
 
 class TCPConnection:
+    BINARY_V1 = 0x81
+
     def __init__(self):
         self.host = Config.SERVER_HOST
         self.port = Config.SERVER_PORT
         self.socket = None
+        # 'legacy' until a server answers the hello, then 'json' or 'bin1'.
+        self.format = 'legacy'
+        self.encrypted = False
 
-    async def connect(self):
-        """Establishes a TCP connection and handles reconnection on failures."""
-        while True:
+    def connect(self):
+        """Makes one attempt to establish the TCP connection. Returns whether it succeeded."""
+        try:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            addr_info = socket.getaddrinfo(self.host, self.port)[0][-1]
+            print(addr_info)
+            self.socket.connect(addr_info)
+            print("TCP connection established with:", addr_info)
+            self.negotiate()
+            return True
+        except Exception as e:
+            print("Failed to connect to TCP server:", e)
+            self.close()
+            return False
+
+    def close(self):
+        if self.socket:
             try:
-                self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                addr_info = socket.getaddrinfo(self.host, self.port)[0][-1]
-                print(addr_info)
-                self.socket.connect(addr_info)
-                print("TCP connection established with:", addr_info)
-                break
-            except Exception as e:
-                print("Failed to connect to TCP server:", e)
-                await asyncio.sleep(5)  # Retry after 5 seconds
+                self.socket.close()
+            except Exception:
+                pass
+        self.socket = None
+
+    def negotiate(self):
+        """
+        Offer the server our formats. A server that answers also takes batches;
+        one that doesn't gets the original one-fix-per-message JSON.
+        """
+        self.format = 'legacy'
+        self.encrypted = False
+        formats = b'["json"]' if Config.TELEMETRY_FORMAT == 'json' else b'["bin1", "json"]'
+        # Tell the server who we are so it can pick this device's key.
+        encryption = ', "device_id": "{}", "encrypted": true'.format(Config.MACHINE_ID).encode() if Config.ENCRYPT_TELEMETRY else b''
+        try:
+            self.socket.settimeout(Config.NEGOTIATE_TIMEOUT_S)
+            self.socket.send(b'{"hello": {"formats": ' + formats + encryption + b'}}\n')
+            reply = self.socket.recv(64)
+            if b'"bin1"' in reply:
+                self.format = 'bin1'
+            elif b'"json"' in reply:
+                self.format = 'json'
+            if Config.ENCRYPT_TELEMETRY:
+                # Only encrypt for a server that says it holds our key.
+                self.encrypted = b'"encrypted": true' in reply
+                if not self.encrypted:
+                    print("Server has no key for this device; sending plaintext")
+        except Exception as e:
+            print("Format negotiation failed, sending legacy JSON:", e)
+        finally:
+            self.socket.settimeout(None)
+        print("Telemetry format:", self.format, "(encrypted)" if self.encrypted else "")
 
-    async def send_telemetry(self, gps_manager):
-        """Sends encrypted GPS data to the server at regular intervals."""
+    def encode_batch(self, fix_buffer, count):
+        """Encode the count oldest buffered fixes as one message in the negotiated format."""
+        if self.format == 'bin1':
+            # 21-byte records: version, device id, lat/lon * 1e7, elevation in cm, epoch seconds.
+            message = bytearray()
+            for n in range(count):
+                lat, lon, elevation, epoch = fix_buffer.get(n)
+                message += struct.pack('<BIiiiI', self.BINARY_V1, Config.MACHINE_ID, lat, lon, elevation, epoch)
+            return message
+        fixes = []
+        for n in range(count):
+            lat, lon, elevation, epoch = fix_buffer.get(n)
+            fixes.append('[{}, {}, {}, {}]'.format(scaled_str(lon, 7), scaled_str(lat, 7), scaled_str(elevation, 2), epoch))
+        return '{{"device_id": "{}", "batch": [{}]}}\n'.format(Config.MACHINE_ID, ', '.join(fixes)).encode("utf-8")
+
+    def encode_legacy(self, fix):
+        lat, lon, elevation, epoch = fix
+        t = time.gmtime(epoch - EPOCH_OFFSET)
+        # Newline-terminated so the server can frame it
+        return '{{"device_id": "{}", "longitude": "{}", "latitude": "{}", "elevation": "{}", "timestamp": "{:02d}:{:02d}:{:02d}"}}\n'.format(
+            Config.MACHINE_ID, scaled_str(lon, 7), scaled_str(lat, 7), scaled_str(elevation, 2), t[3], t[4], t[5]).encode("utf-8")
+
+    def drain(self, fix_buffer):
+        """Send everything buffered, oldest first, dropping each batch once it is on the wire."""
+        while fix_buffer.count:
+            if self.format == 'legacy':
+                count = 1
+                message = self.encode_legacy(fix_buffer.get(0))
+            else:
+                count = min(fix_buffer.count, Config.BATCH_SIZE)
+                message = self.encode_batch(fix_buffer, count)
+            if self.encrypted:
+                message = EncryptionManager.frame(message, Config.GLOBAL_PASSWORD)
+            self.socket.sendall(message)
+            fix_buffer.drop(count)
+            print("Telemetry sent:", count, "fixes")
+
+    async def send_telemetry(self, gps_manager, wifi_manager, fix_buffer):
+        """
+        Buffers a fix every interval and sends the whole backlog whenever the
+        server is reachable, so time out of WiFi range doesn't lose the track.
+        """
         while True:
             await asyncio.sleep(1)
-            # Prepare the message with current GPS data
-            message = '{{"device_id": "{}", "longitude": "{}", "latitude": "{}", "elevation": "{}", "timestamp": "{}"}}'.format(
-                Config.MACHINE_ID, gps_manager.lon, gps_manager.lat, gps_manager.elevation, gps_manager.datetime_utc).encode("utf-8")
             if gps_manager.lon == None:
                 continue
-            #encrypted_message = EncryptionManager.encrypt_msg(message.encode('utf-8'), Config.GLOBAL_PASSWORD)
-            try:
-                self.socket.send(message)
-                print("Telemetry sent:", message)
-                await asyncio.sleep(30)  # Wait 30 second before sending the next telemetry
-            except Exception as e:
-                print("Error sending telemetry:", e)
-                await self.connect()  # Attempt to reconnect if sending fails
+            fix_buffer.push(gps_manager.lat, gps_manager.lon, gps_manager.elevation, gps_manager.epoch())
+            if not wifi_manager.wlan.isconnected():
+                await wifi_manager.connect()
+            if self.socket is None and wifi_manager.wlan.isconnected():
+                self.connect()
+            if self.socket is not None:
+                try:
+                    self.drain(fix_buffer)
+                except Exception as e:
+                    print("Error sending telemetry:", e)
+                    self.close()  # Reconnect on the next interval; the fixes stay buffered
+            await asyncio.sleep(30)  # Wait 30 second before buffering the next fix
 
 
 async def main():
@@ -144,14 +385,15 @@ async def main():
     i2c = I2C(0, sda=Pin(0), scl=Pin(1))
     gps_manager = GPSManager(i2c)
     tcp_connection = TCPConnection()
-    await tcp_connection.connect()
+    tcp_connection.connect()
+    fix_buffer = FixBuffer(Config.BUFFER_CAPACITY, Config.BUFFER_PATH)
 
     # Start the GPS data retrieval task in the background
     gps_task = asyncio.create_task(gps_manager.get_gps_data())
 
     print("Started GPS data retrieval task.")
 
-    telemetry_task = asyncio.create_task(tcp_connection.send_telemetry(gps_manager))
+    telemetry_task = asyncio.create_task(tcp_connection.send_telemetry(gps_manager, wifi_manager, fix_buffer))
     print("Started telemetry task.")
 
     await asyncio.gather(gps_task, telemetry_task)  # Wait for both tasks to finish
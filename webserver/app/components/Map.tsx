@@ -50,6 +50,13 @@ interface GeoData {
   status?: string
 }
 
+interface StatusChange {
+  device_id: string
+  status: string
+  previous: string | null
+  last_seen: string
+}
+
 type Position = {
   id: string
   lat: number
@@ -113,6 +120,58 @@ const Map = ({
     null,
   )
 
+  // Whether pushed live fixes should move the markers (only when every accessory's latest position is shown).
+  const liveMarkersRef = useRef(true)
+
+  // The visible part of the map, as of the last viewport request.
+  const viewportRef = useRef<google.maps.LatLngBounds | null>(null)
+
+  // The time of the newest fix seen for each accessory.
+  const lastFixRef = useRef(new globalThis.Map<string, number>())
+
+  /**
+   * Record a fix's time for its accessory. Returns false for a fix older
+   * than one already seen, e.g. from a drained offline backlog.
+   */
+  const isNewestFix = (item: GeoData) => {
+    const id = item.device_id || ''
+    const time = item.timestamp ? Date.parse(item.timestamp) : NaN
+    if (Number.isNaN(time)) return true
+    const seen = lastFixRef.current.get(id)
+    if (seen !== undefined && time < seen) return false
+    lastFixRef.current.set(id, time)
+    return true
+  }
+
+  /**
+   * Merge fixes into the status list, replacing each accessory's entry
+   * or adding one for an accessory not listed yet.
+   *
+   * @param {GeoData[]} items - Fixes that passed isNewestFix.
+   */
+  const mergeStatusEntries = (items: GeoData[]) => {
+    setLocationAndStatus(prev => {
+      const merged = [...(prev || [])]
+      items.forEach(item => {
+        const entry = {
+          id: item.device_id || '',
+          location: { lat: item.latitude, lng: item.longitude },
+          status: item.status || 'online',
+          timestamp: item.timestamp || '',
+        }
+        const index = merged.findIndex(e => e.id === entry.id)
+        if (index === -1) merged.push(entry)
+        else merged[index] = entry
+      })
+      return merged
+    })
+  }
+
+  useEffect(() => {
+    liveMarkersRef.current =
+      selectedAccessoryId === null && currentSelectedDays === 0
+  }, [selectedAccessoryId, currentSelectedDays])
+
   /**
    * Update the markers.
    * Issue with placement for custom markers:
@@ -274,6 +333,35 @@ const Map = ({
     }
   }, [selectedAccessoryId])
 
+  /**
+   * Ground distance covered by one screen pixel at the current zoom. Sent as
+   * the history simplification tolerance, so only points that would land on
+   * the same pixels are dropped.
+   */
+  const metresPerPixel = () => {
+    const zoom = map?.getZoom() ?? 16
+    const lat = map?.getCenter()?.lat() ?? 0
+    return (156543.03392 * Math.cos((lat * Math.PI) / 180)) / Math.pow(2, zoom)
+  }
+
+  /**
+   * Ask for the latest positions of the accessories inside the visible part
+   * of the map only, instead of every accessory.
+   */
+  const requestViewport = () => {
+    const bounds = map?.getBounds()
+    if (!socket || !bounds) return
+    viewportRef.current = bounds
+    const northEast = bounds.getNorthEast()
+    const southWest = bounds.getSouthWest()
+    socket.emit('get_viewport_data', {
+      west: southWest.lng(),
+      south: southWest.lat(),
+      east: northEast.lng(),
+      north: northEast.lat(),
+    })
+  }
+
   /**
    * Get the historical data based on the selected accessory and
    * date and update the map with the markers.
@@ -285,6 +373,7 @@ const Map = ({
           socket?.emit('get_history_data', {
             days: currentSelectedDays,
             device_id: selectedAccessoryId,
+            tolerance: metresPerPixel(),
           })
         }, 5)
       } else {
@@ -293,9 +382,7 @@ const Map = ({
         })
       }
     } else {
-      socket?.emit('get_latest_data', {
-        all: true,
-      })
+      requestViewport()
     }
     setRefreshMap(prev => !prev)
   }
@@ -310,6 +397,7 @@ const Map = ({
           setLocationAndStatus(null)
           return
         }
+        data.forEach(isNewestFix)
         const updatedData = data.map((item: GeoData) => ({
           id: item.device_id || '',
           location: {
@@ -323,10 +411,69 @@ const Map = ({
         setLocationAndStatus(updatedData)
       })
 
-      socket.emit('get_latest_data', { all: true })
+      /**
+       * Merge fixes pushed by the server into the current state,
+       * replacing each accessory's previous entry unless the pushed
+       * fix is older than the one already shown.
+       */
+      socket.on('live_data', (pushed: GeoData[]) => {
+        const items = pushed.filter(isNewestFix)
+        if (items.length === 0) return
+        mergeStatusEntries(items)
+
+        if (liveMarkersRef.current) {
+          setPositions(prev => {
+            const merged = [...prev]
+            items.forEach(item => {
+              const position = {
+                id: item.device_id || '',
+                lat: item.latitude,
+                lng: item.longitude,
+              }
+              // Only accessories in view have markers; one that moved out loses its marker.
+              const visible =
+                viewportRef.current === null ||
+                viewportRef.current.contains(position)
+              const index = merged.findIndex(p => p.id === position.id)
+              if (index === -1) {
+                if (visible) merged.push(position)
+              } else if (visible) merged[index] = position
+              else merged.splice(index, 1)
+            })
+            return merged
+          })
+        }
+      })
+
+      /**
+       * Apply status transitions pushed by the server as accessories
+       * go quiet or report again, instead of polling for them.
+       */
+      socket.on('status_change', (changes: StatusChange[]) => {
+        setLocationAndStatus(prev => {
+          if (!prev) return prev
+          const byId = new globalThis.Map(
+            changes.map(change => [change.device_id, change.status]),
+          )
+          return prev.map(entry =>
+            byId.has(entry.id)
+              ? { ...entry, status: byId.get(entry.id) as string }
+              : entry,
+          )
+        })
+      })
+
+      // Rooms don't survive a reconnect, so subscribe again every time.
+      const subscribeLive = () => socket.emit('subscribe', {})
+      socket.on('connect', subscribeLive)
+      if (socket.connected) subscribeLive()
 
       return () => {
         socket.off('latest_data_response')
+        socket.off('live_data')
+        socket.off('status_change')
+        socket.off('connect', subscribeLive)
+        socket.emit('unsubscribe', {})
       }
     }
   }, [socket])
@@ -356,6 +503,9 @@ const Map = ({
           return
         }
 
+        // With every accessory shown, markers come from viewport_data_response.
+        if (liveMarkersRef.current) return
+
         const positions = data.map((data: GeoData) => ({
           id: data.device_id,
           lat: data.latitude,
@@ -364,16 +514,60 @@ const Map = ({
 
         setPositions(positions)
       })
+
+      socket.on('viewport_data_response', (data: any) => {
+        if (data.error || !liveMarkersRef.current) {
+          return
+        }
+
+        // Drop answers for a view the map has already moved away from.
+        const viewport = viewportRef.current
+        if (
+          viewport &&
+          (viewport.getSouthWest().lng() !== data.bbox.west ||
+            viewport.getNorthEast().lat() !== data.bbox.north)
+        ) {
+          return
+        }
+
+        const positions = data.devices.map((data: GeoData) => ({
+          id: data.device_id,
+          lat: data.latitude,
+          lng: data.longitude,
+        }))
+
+        setPositions(positions)
+
+        // The status list keeps accessories out of view as last seen; live_data
+        // and status_change keep it current from here.
+        const items = data.devices.filter(isNewestFix)
+        if (items.length === 0) return
+        mergeStatusEntries(items)
+      })
     }
 
     return () => {
       if (socket) {
         socket.off('history_data_response')
         socket.off('latest_data_response')
+        socket.off('viewport_data_response')
       }
     }
   }, [socket, setLocationAndStatus])
 
+  /**
+   * Reload the markers for the visible area whenever the map
+   * settles after a pan or zoom.
+   */
+  useEffect(() => {
+    if (map && socket) {
+      const listener = map.addListener('idle', () => {
+        if (liveMarkersRef.current) requestViewport()
+      })
+      return () => listener.remove()
+    }
+  }, [map, socket])
+
   /**
    * Poll the websocket until it connects
    * while sending the request to display
@@ -0,0 +1,83 @@
+"""
+Benchmark nearest-device queries over the latest positions of a large fleet.
+
+Loads --devices devices placed by fleet_sim into NearestIndex, moves a share
+of them as pushed fixes would, and measures query latency for several n. It
+also checks every answer against a full great-circle scan of all positions,
+which doubles as the cost of the old approach: pull every device with
+get_latest_data(all) and sort by distance in the browser.
+
+    python3 bench_nearest.py
+    python3 bench_nearest.py --devices 100000 --moves 20000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'database'))
+from fleet_sim import Fleet
+from proximity import NearestIndex, haversine_m
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark nearest-device queries.")
+    parser.add_argument('--devices', type=int, default=100000)
+    parser.add_argument('--radius-km', type=float, default=100.0, help="Radius of the area the fleet is spread over")
+    parser.add_argument('--moves', type=int, default=20000, help="Fixes applied after the initial load")
+    parser.add_argument('--queries', type=int, default=500, help="Queries per n")
+    args = parser.parse_args()
+
+    fleet = Fleet(args.devices, radius_m=args.radius_km * 1000.0)
+    lats, lons, _ = fleet.step()
+    ids = [str(device_id) for device_id in fleet.ids]
+    index = NearestIndex()
+    start = time.perf_counter()
+    index.update(zip(ids, lons.tolist(), lats.tolist()))
+    index.nearest(float(lons[0]), float(lats[0]), 1)
+    print(f"{args.devices} devices over {args.radius_km:.0f} km, loaded and built in "
+          f"{(time.perf_counter() - start) * 1000:.0f} ms")
+
+    # Pushed fixes arrive a device or a batch at a time; move some devices a few hundred metres.
+    rng = np.random.default_rng(2)
+    moved = rng.integers(0, args.devices, args.moves)
+    lats[moved] += rng.normal(0, 0.003, args.moves)
+    lons[moved] += rng.normal(0, 0.004, args.moves)
+    start = time.perf_counter()
+    for i in range(0, args.moves, 50):
+        batch = moved[i:i + 50]
+        index.update((ids[j], float(lons[j]), float(lats[j])) for j in batch.tolist())
+    print(f"  updates  {args.moves / (time.perf_counter() - start):>10.0f} fixes/s")
+
+    sample = random.Random(3)
+    for n in (1, 10, 100):
+        timings = []
+        scans = []
+        for _ in range(args.queries):
+            j = sample.randrange(args.devices)
+            lon, lat = float(lons[j]) + sample.uniform(-0.01, 0.01), float(lats[j]) + sample.uniform(-0.01, 0.01)
+            start = time.perf_counter()
+            found = index.nearest(lon, lat, n)
+            timings.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            distances = haversine_m(lon, lat, lons, lats)
+            expected = np.sort(distances)[:n]
+            scans.append(time.perf_counter() - start)
+            assert np.allclose([metres for _, metres in found], expected, atol=0.01), (lon, lat, n)
+            assert all(abs(distances[int(device_id) - 1] - metres) < 0.01 for device_id, metres in found)
+        timings.sort()
+        scans.sort()
+        print(f"  n={n:<4} tree p50 {percentile(timings, 0.5) * 1000:6.3f} ms  p99 {percentile(timings, 0.99) * 1000:6.3f} ms"
+              f"   full scan p50 {percentile(scans, 0.5) * 1000:6.2f} ms")
+    print(f"  all {args.queries * 3} answers matched the full scan; {index.rebuilds} tree builds")
+
+
+if __name__ == '__main__':
+    main()
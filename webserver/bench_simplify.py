@@ -0,0 +1,91 @@
+"""
+Benchmark history simplification against sending the raw track.
+
+Builds a synthetic five-day track at one fix per 30 seconds (a walk with GPS
+jitter and long stationary stretches, like a tracked item mostly sitting
+still), then compares the history_data_response payload and the time to
+produce it with and without simplification.
+
+    python3 bench_simplify.py --points 14400
+"""
+import argparse
+import json
+import math
+import random
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from track_simplify import project, rank_points, select_level, simplify
+
+
+def synthetic_track(points, seed=1):
+    random.seed(seed)
+    lat, lon = 40.95499, -76.88504
+    heading = random.uniform(0, 2 * math.pi)
+    start = datetime(2024, 1, 1)
+    rows = []
+    moving = False
+    for i in range(points):
+        if random.random() < 0.01:
+            moving = not moving
+        if moving:
+            heading += random.gauss(0, 0.3)
+            step = random.uniform(5, 40) / 111320  # metres per 30 s, in degrees
+            lat += step * math.cos(heading)
+            lon += step * math.sin(heading) / math.cos(math.radians(lat))
+        jitter_lat = random.gauss(0, 3) / 110540
+        jitter_lon = random.gauss(0, 3) / 84000
+        rows.append((i + 1, '1', lon + jitter_lon, lat + jitter_lat, 132.6, start + timedelta(seconds=30 * i)))
+    return rows
+
+
+def to_payload(rows):
+    return json.dumps([{"id": row[0], "device_id": row[1], "longitude": row[2], "latitude": row[3],
+                        "elevation": row[4], "timestamp": row[5].isoformat()} for row in rows])
+
+
+def timed(fn, repeat):
+    best = math.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return result, best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark track simplification.")
+    parser.add_argument('--points', type=int, default=14400, help="Raw fixes in the track")
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    rows = synthetic_track(args.points)
+    latitudes = [row[3] for row in rows]
+    longitudes = [row[2] for row in rows]
+
+    raw_payload, raw_ms = timed(lambda: to_payload(rows), args.repeat)
+    print(f"{'mode':<22}{'points':>8}{'payload KiB':>13}{'simplify ms':>13}{'total ms':>10}")
+    print(f"{'raw':<22}{len(rows):>8}{len(raw_payload) / 1024:>13.1f}{0:>13.2f}{raw_ms:>10.2f}")
+
+    cases = [('tolerance 2 m', {'tolerance': 2.0}), ('tolerance 10 m', {'tolerance': 10.0}),
+             ('tolerance 50 m', {'tolerance': 50.0}), ('max_points 2000', {'max_points': 2000}),
+             ('max_points 500', {'max_points': 500})]
+    for name, params in cases:
+        keep, simplify_ms = timed(lambda: simplify(latitudes, longitudes, **params), args.repeat)
+        kept = [rows[i] for i in keep]
+        payload, payload_ms = timed(lambda: to_payload(kept), args.repeat)
+        print(f"{name:<22}{len(kept):>8}{len(payload) / 1024:>13.1f}{simplify_ms:>13.2f}{simplify_ms + payload_ms:>10.2f}")
+
+    # Precomputing a full ranking once per device-day lets every zoom level be sliced out of it.
+    x, y = project(latitudes, longitudes)
+    (order, deviations), rank_ms = timed(lambda: rank_points(x, y), 1)
+    _, level_ms = timed(lambda: select_level(order, deviations, tolerance=10.0), args.repeat)
+    print(f"\nfull ranking of {len(order)} points: {rank_ms:.1f} ms once, then {level_ms:.3f} ms per level")
+    # In tolerance mode the two implementations keep exactly the same points.
+    assert np.array_equal(select_level(order, deviations, tolerance=10.0), simplify(latitudes, longitudes, tolerance=10.0))
+
+
+if __name__ == '__main__':
+    main()
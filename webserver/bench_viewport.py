@@ -0,0 +1,129 @@
+"""
+Benchmark viewport queries over the latest positions of a large fleet.
+
+Places --devices devices with fleet_sim across a --radius-km area and
+measures, for map views at several zoom levels centred on random devices:
+
+    index    LatestPositions.in_bbox alone
+    handler  a get_viewport_data round trip through flask_api's Socket.IO
+             handlers (test client, temporary SQLite database), including
+             building and serialising the response
+
+next to what the map did before: fetch every device with get_latest_data
+and filter it in the browser, approximated by the size of that payload and
+a scan over all rows.
+
+    python3 bench_viewport.py
+    python3 bench_viewport.py --devices 100000 --queries 200
+"""
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'database'))
+from fleet_sim import Fleet
+from latest_positions import LatestPositions
+
+# A 1280x800 map view at a given zoom level, in degrees of longitude at the equator.
+VIEW_PX = (1280, 800)
+ZOOMS = (17, 14, 11, 8)
+
+
+def fleet_rows(devices, radius_km, seed=1):
+    fleet = Fleet(devices, seed=seed, radius_m=radius_km * 1000.0)
+    lats, lons, elevs = fleet.step()
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    return [(str(device_id), float(lon), float(lat), float(elev), now - timedelta(seconds=rng.uniform(0, 3600)))
+            for device_id, lat, lon, elev in zip(fleet.ids, lats, lons, elevs)]
+
+
+def viewport(row, zoom):
+    width = VIEW_PX[0] * 360.0 / (256 * 2 ** zoom)
+    height = width * VIEW_PX[1] / VIEW_PX[0] * math.cos(math.radians(row[2]))
+    return {"west": row[1] - width / 2, "south": row[2] - height / 2,
+            "east": row[1] + width / 2, "north": row[2] + height / 2}
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def summary(timings):
+    timings = sorted(timings)
+    return f"p50 {percentile(timings, 0.5) * 1000:7.3f} ms  p99 {percentile(timings, 0.99) * 1000:7.3f} ms"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark viewport queries over latest positions.")
+    parser.add_argument('--devices', type=int, default=100000)
+    parser.add_argument('--radius-km', type=float, default=100.0, help="Radius of the area the fleet is spread over")
+    parser.add_argument('--queries', type=int, default=200, help="Viewports per zoom level")
+    parser.add_argument('--no-handler', action='store_true', help="Only benchmark the index")
+    args = parser.parse_args()
+
+    rows = fleet_rows(args.devices, args.radius_km)
+    index = LatestPositions()
+    start = time.perf_counter()
+    index.load(rows)
+    load_ms = (time.perf_counter() - start) * 1000
+    print(f"{args.devices} devices over {args.radius_km:.0f} km, {len(index.cells)} occupied cells, "
+          f"loaded in {load_ms:.0f} ms")
+
+    # Moving every device once, as on_fanout does with pushed fixes.
+    moved = [(row[0], row[1] + 0.001, row[2], row[3], row[4] + timedelta(seconds=30)) for row in rows]
+    start = time.perf_counter()
+    for i in range(0, len(moved), 100):
+        index.update(moved[i:i + 100])
+    print(f"  updates   {len(moved) / (time.perf_counter() - start):>10.0f} fixes/s")
+
+    all_payload = json.dumps([{"device_id": row[0], "longitude": row[1], "latitude": row[2], "elevation": row[3],
+                               "timestamp": row[4].isoformat(), "status": "online"} for row in moved])
+    start = time.perf_counter()
+    box = viewport(moved[0], ZOOMS[0])
+    [row for row in moved if box['west'] <= row[1] <= box['east'] and box['south'] <= row[2] <= box['north']]
+    scan_ms = (time.perf_counter() - start) * 1000
+    print(f"  before: get_latest_data(all) is {len(all_payload) / 1e6:.1f} MB, plus a {scan_ms:.1f} ms scan to filter it")
+
+    client = None
+    if not args.no_handler:
+        directory = tempfile.mkdtemp()
+        os.environ['STORAGE_BACKEND'] = 'sqlite'
+        os.environ['SQLITE_PATH'] = os.path.join(directory, 'bench.db')
+        import flask_api
+        flask_api.positions = index
+        index.loaded_at = time.monotonic()
+        client = flask_api.socketio.test_client(flask_api.app)
+
+    rng = random.Random(2)
+    for zoom in ZOOMS:
+        boxes = [viewport(rng.choice(moved), zoom) for _ in range(args.queries)]
+        timings = []
+        found = 0
+        for box in boxes:
+            start = time.perf_counter()
+            result, _ = index.in_bbox(box['west'], box['south'], box['east'], box['north'], limit=5000)
+            timings.append(time.perf_counter() - start)
+            found += len(result)
+        line = f"  zoom {zoom:>2}  {found / len(boxes):>8.0f} devices  index {summary(timings)}"
+        if client is not None:
+            timings = []
+            size = 0
+            for box in boxes:
+                start = time.perf_counter()
+                client.emit('get_viewport_data', box)
+                response = client.get_received()[-1]['args'][0]
+                timings.append(time.perf_counter() - start)
+                size += len(json.dumps(response))
+            line += f"  handler {summary(timings)}  {size / len(boxes) / 1000:.1f} kB"
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+"""
+Database connection pool for the API.
+
+mariadb.ConnectionPool fails get_connection() outright as soon as every
+connection is checked out, so a burst of more than pool_size requests turned
+into errors. PoolManager queues the extra requests instead, up to max_waiters
+of them for at most acquire_timeout seconds each, and only then gives up with
+PoolTimeout (a StorageError, so handlers catching DB_ERRORS still see it).
+It works the same over either storage backend.
+
+Connections are opened on demand up to size. Checking one out that has sat
+idle for longer than health_check_interval pings it first and reopens it if
+the server went away. Returning one rolls back any open transaction so the
+next user does not read from a stale snapshot.
+
+Callers use it like the mariadb pool: conn = pool.get_connection(), then
+conn.close() to hand the connection back.
+"""
+import bisect
+import threading
+import time
+from collections import deque
+
+from storage import DB_ERRORS, StorageError
+
+# Upper bounds (milliseconds) of the acquisition wait histogram buckets.
+WAIT_BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+
+
+class PoolTimeout(StorageError):
+    """No connection became free in time, or too many requests were already waiting."""
+
+
+class PooledConnection:
+    """A checked-out connection. close() returns it to the pool instead of closing it."""
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool.release(conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PoolManager:
+    def __init__(self, backend, size=10, max_waiters=100, acquire_timeout=5.0, health_check_interval=30.0):
+        self.backend = backend
+        self.size = size
+        self.max_waiters = max_waiters
+        self.acquire_timeout = acquire_timeout
+        self.health_check_interval = health_check_interval
+        self.idle = deque()  # (connection, returned at), most recently returned last
+        self.opened = 0
+        self.in_use = 0
+        self.waiters = 0
+        self.cond = threading.Condition()
+        self.acquired = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.reconnects = 0
+        self.discarded = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.wait_histogram = [0] * (len(WAIT_BUCKETS_MS) + 1)
+
+    def get_connection(self, timeout=None):
+        """Check out a connection, waiting up to timeout (default acquire_timeout) seconds for one."""
+        timeout = self.acquire_timeout if timeout is None else timeout
+        start = time.monotonic()
+        with self.cond:
+            if not self.idle and self.opened >= self.size:
+                if self.waiters >= self.max_waiters:
+                    self.rejected += 1
+                    raise PoolTimeout(f"Database busy: {self.waiters} requests already waiting for a connection")
+                self.waiters += 1
+                try:
+                    while not self.idle and self.opened >= self.size:
+                        remaining = start + timeout - time.monotonic()
+                        if remaining <= 0:
+                            self.timeouts += 1
+                            raise PoolTimeout(f"Database busy: no connection free after {timeout:.1f} s")
+                        self.cond.wait(remaining)
+                finally:
+                    self.waiters -= 1
+            if self.idle:
+                # The most recently used connection is the least likely to have gone stale.
+                conn, returned_at = self.idle.pop()
+            else:
+                conn, returned_at = None, None
+                self.opened += 1
+            self.in_use += 1
+
+        # Connecting and pinging happen outside the lock so they don't hold up other requests.
+        try:
+            if conn is None:
+                conn = self.backend.connect()
+            elif time.monotonic() - returned_at > self.health_check_interval:
+                conn = self.check(conn)
+        except DB_ERRORS:
+            with self.cond:
+                self.opened -= 1
+                self.in_use -= 1
+                self.cond.notify()
+            raise
+        self.record_wait(time.monotonic() - start)
+        return PooledConnection(self, conn)
+
+    def check(self, conn):
+        """Ping an idle connection, and replace it if the server closed it."""
+        try:
+            self.backend.ping(conn)
+            return conn
+        except DB_ERRORS:
+            self.reconnects += 1
+            self.close_quietly(conn)
+            return self.backend.connect()
+
+    def release(self, conn):
+        try:
+            conn.rollback()
+            healthy = True
+        except DB_ERRORS:
+            healthy = False
+            self.close_quietly(conn)
+        with self.cond:
+            self.in_use -= 1
+            if healthy and self.size > 0:
+                self.idle.append((conn, time.monotonic()))
+            else:
+                self.opened -= 1
+                if healthy:
+                    # The pool was closed while this connection was out.
+                    self.close_quietly(conn)
+                else:
+                    self.discarded += 1
+            self.cond.notify()
+
+    def record_wait(self, seconds):
+        with self.cond:
+            self.acquired += 1
+            self.total_wait += seconds
+            self.max_wait = max(self.max_wait, seconds)
+            self.wait_histogram[bisect.bisect_left(WAIT_BUCKETS_MS, seconds * 1000)] += 1
+
+    @staticmethod
+    def close_quietly(conn):
+        try:
+            conn.close()
+        except DB_ERRORS:
+            pass
+
+    def close(self):
+        """Close the idle connections. Checked-out ones are closed as they come back."""
+        with self.cond:
+            idle, self.idle = self.idle, deque()
+            self.opened -= len(idle)
+            self.size = 0
+        for conn, _ in idle:
+            self.close_quietly(conn)
+
+    def stats(self):
+        with self.cond:
+            labels = [f"le_{bound}ms" for bound in WAIT_BUCKETS_MS] + ["inf"]
+            return {
+                "size": self.size,
+                "opened": self.opened,
+                "in_use": self.in_use,
+                "idle": len(self.idle),
+                "waiters": self.waiters,
+                "max_waiters": self.max_waiters,
+                "acquired": self.acquired,
+                "timeouts": self.timeouts,
+                "rejected": self.rejected,
+                "reconnects": self.reconnects,
+                "discarded": self.discarded,
+                "avg_wait_ms": round(self.total_wait / self.acquired * 1000, 3) if self.acquired else None,
+                "max_wait_ms": round(self.max_wait * 1000, 3),
+                "wait_histogram": dict(zip(labels, self.wait_histogram)),
+            }
@@ -1,34 +1,156 @@
 """
 Flask REST API with WebSockets
 """
-from flask import Flask, jsonify, request
+import base64
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from flask import Flask, Response, jsonify, request
 from flask_restful import Api
-from flask_socketio import SocketIO, emit
-import mariadb
-import secret
+from flask_socketio import SocketIO, emit, join_room, leave_room
 from datetime import datetime, timedelta, timezone
 from flask_cors import CORS
+from hot_cache import TTLCache
+from latest_positions import LatestPositions
+from proximity import NearestIndex
+from status_tracker import STATUSES, StatusTracker
+from track_simplify import simplify
+
+# Modules shared with the ingest server live in ../database.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'database'))
+from archive import ArchiveReader
+from db_pool import PoolManager, PoolTimeout
+from fanout import DEFAULT_PATH as FANOUT_PATH, FanoutSubscriber
+from log_setup import setup_logging
+from metrics import CONTENT_TYPE, REGISTRY, Counter, Gauge, Histogram
+from migrate_db import LATEST_TABLE_VERSION, check_schema_version, migrate
+from storage import DB_ERRORS, get_backend
 
 PENDING_THRESHOLD = 5 * 60 # 5 minutes in seconds.
 OFFLINE_THRESHOLD = 10 * 60 # 10 minutes in seconds.
+# How often due status transitions are pushed to subscribers.
+STATUS_TICK = 1.0 # seconds
+
+log = logging.getLogger('api')
+
+# Chunked history: rows per 'history_chunk' event, and chunks per request
+# before the client has to ask again with the continuation token.
+HISTORY_CHUNK_SIZE = 500
+MAX_HISTORY_CHUNK_SIZE = 5000
+HISTORY_CHUNKS_PER_REQUEST = 20
+
+# History moved out of sensor_data by database/archive.py, for long-range queries.
+archive = ArchiveReader()
+
+# Socket.IO rooms for live updates pushed from the ingest server.
+ALL_DEVICES_ROOM = 'devices:all'
+
+# Read-path caches. on_fanout keeps them current as the ingest server commits
+# fixes; the TTL bounds how stale an entry can get if a notification is lost
+# or the ingest server runs without the fan-out channel.
+CACHE_TTL = 30 # seconds
+known_devices = TTLCache('known_devices', max_entries=10000, ttl=5 * 60)
+latest_cache = TTLCache('latest', max_entries=10000, ttl=CACHE_TTL)
+# History windows are weighed in rows: one multi-day track can hold more than
+# a hundred cached short ones, so the budget is rows, not windows.
+HISTORY_CACHE_ROWS = 500000
+history_cache = TTLCache('history', max_entries=256, ttl=CACHE_TTL, max_weight=HISTORY_CACHE_ROWS)
+CACHES = (known_devices, latest_cache, history_cache)
+# latest_cache keys besides device ids: every device's row, and the newest row overall.
+LATEST_ALL = ('all',)
+LATEST_NEWEST = ('newest',)
+
+# Every device's latest position on a grid, for viewport queries, and in a
+# KD-tree for nearest-device queries. Loaded from the database on first use,
+# kept current by on_fanout and reloaded every few minutes in case a
+# notification was lost.
+positions = LatestPositions()
+nearest_index = NearestIndex()
+positions_reload = threading.Lock()
+# Every known device's online/pending/offline status, updated as fixes arrive
+# and as thresholds pass; transitions are pushed as 'status_change'.
+statuses = StatusTracker(PENDING_THRESHOLD, OFFLINE_THRESHOLD)
+# Most devices one viewport response carries; zoomed far out, the map asks again closer in.
+MAX_VIEWPORT_DEVICES = 5000
+MAX_NEAREST_DEVICES = 1000
 
 app = Flask(__name__)
 CORS(app, resources={r"/api/*": {"origins": "*"}})
 socketio = SocketIO(app, cors_allowed_origins="*")
 api = Api(app)
 
-# Establish a connection pool for efficient MariaDB connections 
-# Change the pool size to add more accessories!
-pool = mariadb.ConnectionPool(
-    pool_name="app_pool",
-    pool_size=10,
-    host=secret.dbhost,
-    database=secret.db,
-    user=secret.user,
-    password=secret.password
+# MariaDB, or an embedded SQLite file for single-node sites (see database/storage.py).
+backend = get_backend()
+
+# Establish a connection pool for efficient database connections.
+# The pool size caps concurrent queries, not accessories: requests beyond it
+# wait in line (up to max_waiters of them, for acquire_timeout seconds each).
+pool = PoolManager(
+    backend,
+    size=10,
+    max_waiters=100,
+    acquire_timeout=5.0,
+    health_check_interval=30.0,
 )
 
+# Warn early if the indexes the queries below rely on are missing.
+with pool.get_connection() as _conn:
+    if backend.embedded:
+        migrate(_conn, backend, quiet=True)
+    # With device_latest, latest-position lookups no longer scan the history.
+    USE_LATEST_TABLE = check_schema_version(_conn) >= LATEST_TABLE_VERSION
+
+# Prometheus metrics, scraped from /metrics. Pool and cache figures are read
+# from the objects that already keep them when the page is rendered.
+HANDLER_SECONDS = Histogram('gps_api_handler_seconds', "Time spent in each API handler.", ['handler'])
+FIXES_PUSHED = Counter('gps_api_fixes_pushed_total', "Fixes from the ingest server pushed to Socket.IO subscribers.")
+GEOFENCE_EVENTS_PUSHED = Counter('gps_api_geofence_events_pushed_total',
+                                 "Geofence enter/exit events pushed to Socket.IO subscribers.")
+POOL_CONNECTIONS = Gauge('gps_api_pool_connections', "Pooled database connections, by state.", ['state'])
+POOL_CONNECTIONS.labels('in_use').set_function(lambda: pool.in_use)
+POOL_CONNECTIONS.labels('idle').set_function(lambda: len(pool.idle))
+Gauge('gps_api_pool_size', "Most connections the pool opens.").set_function(lambda: pool.size)
+Gauge('gps_api_pool_waiters', "Requests waiting for a pooled connection.").set_function(lambda: pool.waiters)
+POOL_EVENTS = Counter('gps_api_pool_events_total', "Pool acquisitions, timeouts, rejections and reconnects.", ['event'])
+for _event in ('acquired', 'timeouts', 'rejected', 'reconnects'):
+    POOL_EVENTS.labels(_event).set_function(functools.partial(getattr, pool, _event))
+CACHE_LOOKUPS = Counter('gps_api_cache_lookups_total', "Read cache lookups, by result.", ['cache', 'result'])
+CACHE_ENTRIES = Gauge('gps_api_cache_entries', "Entries held by each read cache.", ['cache'])
+for _cache in CACHES:
+    CACHE_LOOKUPS.labels(_cache.name, 'hit').set_function(functools.partial(getattr, _cache, 'hits'))
+    CACHE_LOOKUPS.labels(_cache.name, 'miss').set_function(functools.partial(getattr, _cache, 'misses'))
+    CACHE_ENTRIES.labels(_cache.name).set_function(lambda cache=_cache: len(cache.entries))
+Gauge('gps_api_positions', "Devices in the in-memory latest position index.").set_function(lambda: len(positions))
+STATUS_CHANGES = Counter('gps_api_status_changes_total', "Device status transitions pushed to subscribers.", ['status'])
+DEVICES = Gauge('gps_api_devices', "Tracked devices, by status.", ['status'])
+for _status in STATUSES:
+    DEVICES.labels(_status).set_function(lambda status=_status: statuses.counts[status])
+
+
+def timed(handler_name):
+    """Record the decorated handler's latency in HANDLER_SECONDS."""
+    child = HANDLER_SECONDS.labels(handler_name)
+
+    def decorate(handler):
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            with child.time():
+                return handler(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+
 @app.route('/api/check_device_existence', methods=['POST'])
+@timed('check_device_existence')
 def check_device_existence():
     try:
         # Extract the accessory ID from the POST request
@@ -37,40 +159,207 @@ def check_device_existence():
         if device_id is None:
             return jsonify({"error": "Missing 'device_id' in the request body."}), 400
 
-        # Connect to the database
-        conn = pool.get_connection()
-        cursor = conn.cursor()
+        exists = known_devices.get(str(device_id))
+        if exists is None:
+            # Connect to the database; the connection goes back to the pool even if the query fails.
+            with pool.get_connection() as conn:
+                cursor = conn.cursor()
 
-        # Query the database to check if the device_id address exists
-        cursor.execute("SELECT COUNT(*) FROM sensor_data WHERE device_id = ?", (device_id,))
-        count = cursor.fetchone()[0]
-        cursor.close()
-        conn.close()
+                # Query the database to check if the device_id address exists
+                table = "device_latest" if USE_LATEST_TABLE else "sensor_data"
+                cursor.execute(f"SELECT COUNT(*) FROM {table} WHERE device_id = ?", (device_id,))
+                exists = cursor.fetchone()[0] > 0
+                cursor.close()
+            # Misses are cached too; a device's first fix flips its entry in on_fanout.
+            known_devices.put(str(device_id), exists)
 
-        if count > 0:
+        if exists:
             return jsonify({"exists": True}), 200
         else:
             return jsonify({"exists": False}), 200
-    except mariadb.Error as e:
+    except PoolTimeout as e:
+        return {"error": str(e)}, 503
+    except DB_ERRORS as e:
         return {"error": f"Database error: {e}"}, 500
     except Exception as e:
         return {"error": f"An error occurred: {e}"}, 500
 
 
 @socketio.on('get_latest_data')
+@timed('get_latest_data')
 def get_sensordata_live(data):
     try:
-        conn = pool.get_connection()
-        cursor = conn.cursor()
-        
         device_id = data.get('device_id')
         all_data = data.get('all', False)
 
-        if device_id:
+        key = str(device_id) if device_id else LATEST_ALL if all_data else LATEST_NEWEST
+        cached = latest_cache.get(key)
+        if cached is not None:
+            data = list(cached.values()) if key == LATEST_ALL else [cached]
+        else:
+            data = query_latest(device_id, all_data)
+            if data:
+                latest_cache.put(key, {row[0]: row for row in data} if key == LATEST_ALL else data[0])
+
+        if data:
+            now = datetime.now(timezone.utc)
+            emit('latest_data_response', [latest_row(row, status_of(row, now)) for row in data])
+        else:
+            emit('latest_data_response', {"error": "No data found"}, broadcast=False)
+    except DB_ERRORS as e:
+        emit('latest_data_response', {"error": f"Couldn't access the database: {e}"}, broadcast=False)
+    except Exception as e:
+        emit('latest_data_response', {"error": f"An error occurred: {e}"}, broadcast=False)
+
+
+def device_status(timestamp, now):
+    """online, pending or offline, from the age of a naive UTC timestamp."""
+    time_diff = (now - timestamp.replace(tzinfo=timezone.utc)).total_seconds()
+    return 'online' if time_diff <= PENDING_THRESHOLD else 'pending' if time_diff <= OFFLINE_THRESHOLD else 'offline'
+
+
+def status_of(row, now):
+    """
+    The status of a latest row's device: the tracked one, an O(1) lookup, or
+    for a device the tracker has not seen yet, one from the row's own age.
+    """
+    return statuses.status(row[0]) or device_status(row[4], now)
+
+
+def epoch(timestamp):
+    return timestamp.replace(tzinfo=timezone.utc).timestamp()
+
+
+def latest_row(row, status):
+    return {"device_id": row[0], "longitude": row[1], "latitude": row[2], "elevation": row[3], "timestamp": row[4].isoformat(), "status": status}
+
+
+def parse_utc(value):
+    """An ISO timestamp as a naive UTC datetime, like the ones in the database."""
+    timestamp = datetime.fromisoformat(value)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+def current_positions():
+    """
+    positions, (re)loaded from the database when stale. Only the first load
+    makes requests wait; later reloads are done by whichever request finds
+    the index stale first, while the others keep using it as it is.
+    """
+    if positions.stale() and positions_reload.acquire(blocking=positions.loaded_at is None):
+        try:
+            if positions.stale():
+                first_load = positions.loaded_at is None
+                applied = positions.load(query_latest(None, True))
+                nearest_index.update(applied)
+                changes = track(applied)
+                # A reload only finds changes whose notification was lost; the first load finds every device.
+                if not first_load:
+                    push_status_changes(changes)
+        finally:
+            positions_reload.release()
+    return positions
+
+
+@socketio.on('get_viewport_data')
+@timed('get_viewport_data')
+def get_viewport_data(data):
+    """
+    Latest position of every device inside a map viewport. Request:
+    {"west", "south", "east", "north"} in degrees, optionally "since" and/or
+    "until" (ISO, UTC) to keep only devices last seen in that window, and
+    "limit". The response echoes the box so the client can drop answers for a
+    view it has already left: {"bbox", "devices", "truncated"}.
+    """
+    try:
+        try:
+            bbox = [float(data[key]) for key in ('west', 'south', 'east', 'north')]
+        except (KeyError, TypeError, ValueError):
+            emit('viewport_data_response', {"error": "Missing or invalid 'west', 'south', 'east' or 'north' parameter."}, broadcast=False)
+            return
+        since = parse_utc(data['since']) if data.get('since') else None
+        until = parse_utc(data['until']) if data.get('until') else None
+        limit = min(max(int(data.get('limit', MAX_VIEWPORT_DEVICES)), 1), MAX_VIEWPORT_DEVICES)
+
+        rows, truncated = current_positions().in_bbox(*bbox, since=since, until=until, limit=limit)
+        now = datetime.now(timezone.utc)
+        emit('viewport_data_response', {
+            "bbox": dict(zip(('west', 'south', 'east', 'north'), bbox)),
+            "devices": [latest_row(row, status_of(row, now)) for row in rows],
+            "truncated": truncated,
+        })
+    except PoolTimeout as e:
+        emit('viewport_data_response', {"error": str(e)}, broadcast=False)
+    except DB_ERRORS as e:
+        emit('viewport_data_response', {"error": f"Database error: {e}"}, broadcast=False)
+    except Exception as e:
+        emit('viewport_data_response', {"error": f"An error occurred: {e}"}, broadcast=False)
+
+
+@socketio.on('get_nearest_devices')
+@timed('get_nearest_devices')
+def get_nearest_devices(data):
+    """
+    The devices whose latest position is nearest to a point, by great-circle
+    distance. Request: {"longitude", "latitude"}, optionally "n" (default 10)
+    and "max_distance_m". Answers 'nearest_devices_response' with
+    {"longitude", "latitude", "devices"}, nearest first, each device with its
+    "distance_m".
+    """
+    try:
+        try:
+            longitude = float(data['longitude'])
+            latitude = float(data['latitude'])
+        except (KeyError, TypeError, ValueError):
+            emit('nearest_devices_response', {"error": "Missing or invalid 'longitude' or 'latitude' parameter."}, broadcast=False)
+            return
+        n = min(max(int(data.get('n', 10)), 1), MAX_NEAREST_DEVICES)
+        max_distance_m = float(data['max_distance_m']) if data.get('max_distance_m') is not None else None
+
+        current_positions()
+        now = datetime.now(timezone.utc)
+        devices = []
+        for device_id, distance_m in nearest_index.nearest(longitude, latitude, n, max_distance_m):
+            row = positions.get(device_id)
+            if row is not None:
+                devices.append(dict(latest_row(row, status_of(row, now)), distance_m=round(distance_m, 1)))
+        emit('nearest_devices_response', {"longitude": longitude, "latitude": latitude, "devices": devices})
+    except PoolTimeout as e:
+        emit('nearest_devices_response', {"error": str(e)}, broadcast=False)
+    except DB_ERRORS as e:
+        emit('nearest_devices_response', {"error": f"Database error: {e}"}, broadcast=False)
+    except Exception as e:
+        emit('nearest_devices_response', {"error": f"An error occurred: {e}"}, broadcast=False)
+
+
+def query_latest(device_id, all_data):
+    """Latest (device_id, longitude, latitude, elevation, timestamp) rows from the database."""
+    conn = pool.get_connection()
+    cursor = conn.cursor()
+    try:
+        if USE_LATEST_TABLE:
+            if device_id:
+                # Primary key lookup.
+                cursor.execute("""
+                SELECT device_id, longitude, latitude, elevation, timestamp FROM device_latest
+                WHERE device_id = ?;
+                """, (device_id,))
+            elif all_data:
+                # One row per device.
+                cursor.execute("SELECT device_id, longitude, latitude, elevation, timestamp FROM device_latest;")
+            else:
+                cursor.execute("""
+                SELECT device_id, longitude, latitude, elevation, timestamp FROM device_latest
+                ORDER BY timestamp DESC
+                LIMIT 1;
+                """)
+        elif device_id:
             # Query for the latest data for the specified device_id address.
             query = """
-            SELECT * FROM sensor_data
-            WHERE device_id = %s
+            SELECT device_id, longitude, latitude, elevation, timestamp FROM sensor_data
+            WHERE device_id = ?
             ORDER BY timestamp DESC
             LIMIT 1;
             """
@@ -78,7 +367,7 @@ def get_sensordata_live(data):
         elif all_data:
             # Reference: https://stackoverflow.com/questions/10999522/how-to-get-the-latest-record-in-each-group-using-group-by
             query = """
-            SELECT sd.* FROM sensor_data sd
+            SELECT sd.device_id, sd.longitude, sd.latitude, sd.elevation, sd.timestamp FROM sensor_data sd
             INNER JOIN (
                 SELECT device_id, MAX(timestamp) as max_timestamp
                 FROM sensor_data
@@ -89,36 +378,27 @@ def get_sensordata_live(data):
         else:
             # Default behavior: fetch the latest data.
             query = """
-            SELECT * FROM sensor_data
+            SELECT device_id, longitude, latitude, elevation, timestamp FROM sensor_data
             ORDER BY timestamp DESC
             LIMIT 1;
             """
             cursor.execute(query)
-        
-        data = cursor.fetchall()
+        return cursor.fetchall()
+    finally:
         cursor.close()
         conn.close()
-        
-        if data:
-            current_time_utc = datetime.now(timezone.utc)
-            timestamp_utc = data[0][5].replace(tzinfo=timezone.utc)
-            time_diff = (current_time_utc - timestamp_utc).total_seconds()
-            status = 'online' if time_diff <= PENDING_THRESHOLD else 'pending' if time_diff <= OFFLINE_THRESHOLD else 'offline'
-            emit('latest_data_response', [{"id": row[0], "device_id": row[1], "longitude": row[2], "latitude": row[3], "elevation": row[4], "timestamp": row[5].isoformat(), "status": status} for row in data])
-        else:
-            emit('latest_data_response', {"error": "No data found"}, broadcast=False)
-    except mariadb.Error as e:
-        emit('latest_data_response', {"error": f"Couldn't access the database: {e}"}, broadcast=False)
-    except Exception as e:
-        emit('latest_data_response', {"error": f"An error occurred: {e}"}, broadcast=False)
 
 
 @socketio.on('get_history_data')
+@timed('get_history_data')
 def get_history_based_on_days(data):
     try:
         # Get the 'days' and 'device_id' parameters from the request.
         days = data.get('days')
         device_id = data.get('device_id')
+        # Optional simplification: 'tolerance' in metres and/or at most 'max_points' points.
+        tolerance = data.get('tolerance')
+        max_points = data.get('max_points')
     
         # Validate the 'days' parameter.
         if days is not None:
@@ -140,22 +420,354 @@ def get_history_based_on_days(data):
         start_date = past_date.strftime('%Y-%m-%d %H:%M:%S')
         end_date = current_date.strftime('%Y-%m-%d %H:%M:%S')
 
-        # Connect to the database and get all the data based on the timestamp.
-        conn = pool.get_connection()
-        cursor = conn.cursor()
-        cursor.execute(f"SELECT * FROM sensor_data WHERE timestamp >= '{start_date}' AND timestamp <= '{end_date}' AND device_id = '{device_id}'")
-        # cursor.execute(f"SELECT * FROM sensor_data")
-        data = cursor.fetchall()
-        cursor.close()
-        conn.close()
+        # A cached window is trimmed to the current one; on_fanout drops a
+        # device's windows as soon as it reports, so nothing new is missing.
+        key = (str(device_id), days)
+        data = history_cache.get(key)
+        if data is not None:
+            oldest = past_date.replace(tzinfo=None)
+            data = [row for row in data if row[5] >= oldest]
+        else:
+            # Connect to the database and get all the data based on the timestamp.
+            # The connection goes back to the pool even if the query fails.
+            with pool.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT * FROM sensor_data WHERE timestamp >= ? AND timestamp <= ? AND device_id = ?",
+                               (start_date, end_date, device_id))
+                data = cursor.fetchall()
+                cursor.close()
+            history_cache.put(key, data)
+
+        if tolerance is not None or max_points is not None:
+            keep = simplify([row[3] for row in data], [row[2] for row in data],
+                            tolerance=float(tolerance) if tolerance is not None else None,
+                            max_points=int(max_points) if max_points is not None else None)
+            data = [data[i] for i in keep]
                 
         emit('history_data_response', [{"id": row[0], "device_id": row[1], "longitude": row[2], "latitude": row[3], "elevation": row[4], "timestamp": row[5].isoformat()} for row in data])
-    except mariadb.Error as e:
+    except DB_ERRORS as e:
         emit('history_data_response', {"error": f"Database error: {e}"}, broadcast=False)
     except Exception as e:
         emit('history_data_response', {"error": f"An error occurred: {e}"}, broadcast=False)
 
 
+def history_row(row):
+    return {"id": row[0], "device_id": row[1], "longitude": row[2], "latitude": row[3], "elevation": row[4], "timestamp": row[5].isoformat()}
+
+
+def read_archived_chunk(state, chunk_size):
+    """
+    The next chunk_size archived rows of a history stream. The position is the
+    last epoch sent plus how many rows at that epoch were sent, since a device
+    can have several fixes in the same second.
+    """
+    end = int(datetime.fromisoformat(state['end']).replace(tzinfo=timezone.utc).timestamp())
+    epochs, latitudes, longitudes, elevations = archive.read(state['device_id'], state['archive_after'], end,
+                                                             limit=chunk_size + state['archive_skip'])
+    skip = state['archive_skip']
+    epochs, latitudes, longitudes, elevations = (column[skip:skip + chunk_size] for column in (epochs, latitudes, longitudes, elevations))
+    if len(epochs):
+        last = int(epochs[-1])
+        at_last = int((epochs == last).sum())
+        state['archive_skip'] = at_last + (skip if last == state['archive_after'] else 0)
+        state['archive_after'] = last
+    times = epochs.astype('datetime64[s]').tolist()
+    # Archived rows have no id; they left sensor_data when they were archived.
+    return [history_row((None, state['device_id'], longitude, latitude, elevation, time))
+            for longitude, latitude, elevation, time in zip(longitudes.tolist(), latitudes.tolist(), elevations.tolist(), times)]
+
+
+def encode_history_token(state):
+    return base64.urlsafe_b64encode(json.dumps(state).encode('utf-8')).decode('ascii')
+
+
+def decode_history_token(token):
+    """
+    The state in a continuation token. Tokens come back from the client
+    unsigned, so every field is checked and the chunk size clamped again.
+    """
+    try:
+        state = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+        if not (isinstance(state['device_id'], (str, int)) and isinstance(state['after_id'], int)
+                and isinstance(state['archive_after'], int) and isinstance(state['archive_done'], bool)
+                and isinstance(state['archive_skip'], int) and 0 <= state['archive_skip'] <= MAX_HISTORY_CHUNK_SIZE):
+            raise ValueError
+        state['end'] = parse_utc(state['end']).strftime('%Y-%m-%d %H:%M:%S')
+        state['after'] = parse_utc(state['after']).strftime('%Y-%m-%d %H:%M:%S')
+        state['chunk_size'] = clamp_chunk_size(state['chunk_size'])
+    except (ValueError, KeyError, TypeError):
+        raise ValueError("Invalid 'cursor' token.") from None
+    return state
+
+
+def clamp_chunk_size(value):
+    return min(max(int(value), 1), MAX_HISTORY_CHUNK_SIZE)
+
+
+@socketio.on('get_history_chunks')
+@timed('get_history_chunks')
+def get_history_chunks(data):
+    """
+    Stream a device's history as 'history_chunk' events of at most chunk_size
+    rows, oldest first. Rows come off an unbuffered (server-side) cursor one
+    chunk at a time, so memory stays bounded and there is no cap on 'days'.
+    Days that were archived out of sensor_data are streamed first, from the
+    memory-mapped archive.
+
+    Request: {"device_id", "days"} or {"device_id", "start", "end"} (ISO, UTC),
+    optionally "chunk_size"; or just {"cursor": token} to continue.
+    Each chunk is {"rows": [...], "next": token, "done": bool}. After
+    HISTORY_CHUNKS_PER_REQUEST chunks the stream pauses with done=false until
+    the client sends the last chunk's "next" back as "cursor".
+    """
+    try:
+        if data.get('cursor'):
+            state = decode_history_token(data['cursor'])
+        else:
+            device_id = data.get('device_id')
+            if device_id is None:
+                emit('history_chunk', {"error": "Missing 'device_id' parameter."}, broadcast=False)
+                return
+            end_date = parse_utc(data['end']) if data.get('end') else datetime.now(timezone.utc).replace(tzinfo=None)
+            if data.get('start'):
+                start_date = parse_utc(data['start'])
+            elif data.get('days') is not None and int(data['days']) >= 0:
+                start_date = end_date - timedelta(days=int(data['days']))
+            else:
+                emit('history_chunk', {"error": "Missing 'days' or 'start' parameter."}, broadcast=False)
+                return
+            state = {
+                "device_id": device_id,
+                "end": end_date.strftime('%Y-%m-%d %H:%M:%S'),
+                # Keyset position: the last (timestamp, id) already sent.
+                "after": start_date.strftime('%Y-%m-%d %H:%M:%S'),
+                "after_id": -1,
+                "chunk_size": clamp_chunk_size(data.get('chunk_size', HISTORY_CHUNK_SIZE)),
+            }
+            archived_days = archive.days()
+            state['archive_done'] = not archived_days or archived_days[0] > state['end'][:10] \
+                or archived_days[-1] < state['after'][:10]
+            state['archive_after'] = int(start_date.replace(tzinfo=timezone.utc).timestamp())
+            state['archive_skip'] = 0
+        chunk_size = state['chunk_size']
+
+        chunks_left = HISTORY_CHUNKS_PER_REQUEST
+        while not state.get('archive_done', True) and chunks_left:
+            rows = read_archived_chunk(state, chunk_size)
+            state['archive_done'] = len(rows) < chunk_size
+            # An empty read sends nothing, so it leaves the slot to the sensor_data chunk that answers.
+            if rows:
+                chunks_left -= 1
+                emit('history_chunk', {"rows": rows, "next": encode_history_token(state), "done": False})
+                socketio.sleep(0)
+        if not chunks_left:
+            return
+
+        conn = pool.get_connection()
+        cursor = conn.cursor(buffered=False)
+        try:
+            # (device_id, timestamp) index order, with id breaking ties between equal timestamps.
+            cursor.execute("""
+            SELECT id, device_id, longitude, latitude, elevation, timestamp FROM sensor_data
+            WHERE device_id = ? AND timestamp <= ?
+              AND (timestamp > ? OR (timestamp = ? AND id > ?))
+            ORDER BY timestamp, id
+            LIMIT ?
+            """, (state['device_id'], state['end'], state['after'], state['after'], state['after_id'],
+                  chunk_size * chunks_left))
+            for chunk_number in range(chunks_left):
+                rows = cursor.fetchmany(chunk_size)
+                done = len(rows) < chunk_size
+                if rows:
+                    state['after'] = rows[-1][5].strftime('%Y-%m-%d %H:%M:%S')
+                    state['after_id'] = rows[-1][0]
+                emit('history_chunk', {
+                    "rows": [history_row(row) for row in rows],
+                    "next": None if done else encode_history_token(state),
+                    "done": done,
+                })
+                if done:
+                    break
+                # Let the chunk go out before reading the next one.
+                socketio.sleep(0)
+        finally:
+            cursor.close()
+            conn.close()
+    except DB_ERRORS as e:
+        emit('history_chunk', {"error": f"Database error: {e}"}, broadcast=False)
+    except Exception as e:
+        emit('history_chunk', {"error": f"An error occurred: {e}"}, broadcast=False)
+
+
+def device_room(device_id):
+    return f'device:{device_id}'
+
+
+@socketio.on('subscribe')
+def subscribe(data):
+    """
+    Join the live feed for one device ({"device_id": ...}) or for every device.
+    New fixes then arrive as 'live_data' without polling get_latest_data, and
+    geofence enter/exit events as 'geofence_event'.
+    """
+    device_id = (data or {}).get('device_id')
+    room = device_room(device_id) if device_id else ALL_DEVICES_ROOM
+    join_room(room)
+    emit('subscribed', {"room": room})
+
+
+@socketio.on('unsubscribe')
+def unsubscribe(data):
+    device_id = (data or {}).get('device_id')
+    room = device_room(device_id) if device_id else ALL_DEVICES_ROOM
+    leave_room(room)
+    emit('unsubscribed', {"room": room})
+
+
+def newer(cached, row):
+    return row if row[4] >= cached[4] else cached
+
+
+def refresh_caches(items):
+    """
+    Bring the read caches up to date with fixes the ingest server just committed.
+    Cached latest rows only move forward, since a drained offline backlog can
+    arrive after newer fixes. Returns the rows that moved a device forward.
+    """
+    newest = {}
+    for item in items:
+        row = (item['device_id'], item['longitude'], item['latitude'], item['elevation'],
+               datetime.fromisoformat(item['timestamp']))
+        newest[row[0]] = newer(newest[row[0]], row) if row[0] in newest else row
+    if not newest:
+        return []
+    applied = positions.update(newest.values())
+    nearest_index.update(applied)
+    for device_id, row in newest.items():
+        known_devices.put(device_id, True)
+        latest_cache.update(device_id, lambda cached: newer(cached, row))
+
+    def merge(cached):
+        merged = dict(cached)
+        for device_id, row in newest.items():
+            merged[device_id] = newer(merged[device_id], row) if device_id in merged else row
+        return merged
+
+    latest_cache.update(LATEST_ALL, merge)
+    newest_overall = max(newest.values(), key=lambda row: row[4])
+    latest_cache.update(LATEST_NEWEST, lambda cached: newer(cached, newest_overall))
+    history_cache.invalidate_where(lambda key: key[0] in newest)
+    return applied
+
+
+@app.route('/api/cache_stats', methods=['GET'])
+def cache_stats():
+    """Hit/miss counters of the read caches, for sizing them."""
+    return jsonify({cache.name: cache.stats() for cache in CACHES}), 200
+
+
+@app.route('/api/pool_stats', methods=['GET'])
+def pool_stats():
+    """Connections in use, requests waiting for one and how long they waited."""
+    return jsonify(pool.stats()), 200
+
+
+def on_fanout(event, items):
+    """Push fixes committed by the ingest server, and geofence events, to the rooms that want them."""
+    if event == 'geofence':
+        push_geofence_events(items)
+        return
+    if event != 'fixes':
+        return
+    changes = track(refresh_caches(items))
+    # A drained offline backlog is committed now but can be hours old. Push only
+    # each device's newest fix, and only if nothing newer is known, so markers
+    # never jump back along the track.
+    newest = {}
+    for item in items:
+        timestamp = datetime.fromisoformat(item['timestamp'])
+        device_id = str(item['device_id'])
+        if device_id not in newest or timestamp >= newest[device_id][0]:
+            newest[device_id] = (timestamp, item)
+    fresh = []
+    for device_id, (timestamp, item) in newest.items():
+        current = positions.get(device_id)
+        if current is not None and timestamp < current[4]:
+            continue
+        item['status'] = statuses.status(device_id) or 'online'
+        fresh.append(item)
+    if fresh:
+        FIXES_PUSHED.inc(len(fresh))
+        socketio.emit('live_data', fresh, to=ALL_DEVICES_ROOM)
+        for item in fresh:
+            socketio.emit('live_data', [item], to=device_room(item['device_id']))
+    push_status_changes(changes)
+
+
+def track(rows):
+    """Feed latest rows to the status tracker. Returns the status changes they caused."""
+    now = time.time()
+    changes = []
+    for row in rows:
+        change = statuses.seen(row[0], epoch(row[4]), now)
+        if change is not None:
+            changes.append(change)
+    return changes
+
+
+def push_status_changes(changes):
+    """Send each transition as 'status_change' to the all-devices room and the device's own room."""
+    if not changes:
+        return
+    for change in changes:
+        change['last_seen'] = datetime.fromtimestamp(change['last_seen'], timezone.utc).replace(tzinfo=None).isoformat()
+        STATUS_CHANGES.labels(change['status']).inc()
+    socketio.emit('status_change', changes, to=ALL_DEVICES_ROOM)
+    for change in changes:
+        socketio.emit('status_change', [change], to=device_room(change['device_id']))
+
+
+def track_statuses():
+    """
+    Background task: load every device's status, then push the transitions
+    that come due as devices go quiet. Also reloads the latest positions when
+    they are stale, so missed notifications are caught without waiting for a
+    request.
+    """
+    while True:
+        try:
+            if positions.stale():
+                current_positions()
+            push_status_changes(statuses.advance(time.time()))
+        except (PoolTimeout, *DB_ERRORS) as e:
+            log.warning("Could not load latest positions: %s", e)
+        except Exception:
+            # Like the Socket.IO handlers: report it and carry on, or status pushes stop for good.
+            log.exception("Error tracking device statuses")
+        socketio.sleep(STATUS_TICK)
+
+
+def push_geofence_events(items):
+    """Enter/exit events from the ingest server's geofence check, as 'geofence_event'."""
+    GEOFENCE_EVENTS_PUSHED.inc(len(items))
+    socketio.emit('geofence_event', items, to=ALL_DEVICES_ROOM)
+    by_device = {}
+    for item in items:
+        by_device.setdefault(item['device_id'], []).append(item)
+    for device_id, device_items in by_device.items():
+        socketio.emit('geofence_event', device_items, to=device_room(device_id))
+
+
+def start_fanout_listener():
+    subscriber = FanoutSubscriber(on_fanout, FANOUT_PATH)
+    subscriber.bind()
+    socketio.start_background_task(subscriber.serve_forever)
+
+
+def start_status_tracker():
+    socketio.start_background_task(track_statuses)
+
+
 @socketio.on('disconnect')
 def on_disconnect():
     socketio.emit('server_status', {"message": "Server is offline."})
@@ -165,4 +777,10 @@ def on_connect():
     socketio.emit('server_status', {"message": "Server is running."})
 
 if __name__ == '__main__':
-    socketio.run(app, debug=True)
+    debug = True
+    setup_logging('INFO')
+    # The debug reloader runs this twice; only the serving child should bind the channel.
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_fanout_listener()
+        start_status_tracker()
+    socketio.run(app, debug=debug)
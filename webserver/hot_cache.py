@@ -0,0 +1,130 @@
+"""
+Small in-process cache for the API's read paths.
+
+A TTLCache is a bounded LRU map whose entries also expire after ttl seconds,
+so a missed invalidation can only ever serve data that old. flask_api keeps
+one per read path and updates or drops entries when the ingest server
+announces new fixes on the fan-out channel. Each cache counts hits, misses,
+expiries and evictions so it can be sized from real traffic.
+
+Entries can differ wildly in size (one history window can be a multi-day
+track), so a cache can also be bounded by the total weight of its values:
+with max_weight, weigh(value) (len by default) is summed over the entries,
+least recently used ones are evicted to stay under it, and a value heavier
+than max_weight / 4 is not cached at all.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    def __init__(self, name, max_entries, ttl, max_weight=None, weigh=len):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_weight = max_weight
+        self.weigh = weigh
+        self.entries = OrderedDict()  # key -> (expires_at, value, weight), least recently used first
+        self.weight = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.too_large = 0
+
+    def weight_of(self, value):
+        return self.weigh(value) if self.max_weight is not None else 0
+
+    def remove(self, key):
+        """Drop an entry and its weight. Called with the lock held."""
+        entry = self.entries.pop(key)
+        self.weight -= entry[2]
+        return entry
+
+    def evict(self):
+        """Drop least recently used entries until both bounds hold. Called with the lock held."""
+        while self.entries and (len(self.entries) > self.max_entries
+                                or (self.max_weight is not None and self.weight > self.max_weight)):
+            self.remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] <= now:
+                self.remove(key)
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        weight = self.weight_of(value)
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            if self.max_weight is not None and weight > self.max_weight // 4:
+                self.too_large += 1
+                return
+            self.entries[key] = (time.monotonic() + self.ttl, value, weight)
+            self.weight += weight
+            self.evict()
+
+    def update(self, key, fn):
+        """
+        Replace a live entry's value with fn(value), keeping its expiry. Does
+        nothing for a missing key, so writes never create entries by themselves.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value = fn(entry[1])
+                weight = self.weight_of(value)
+                self.entries[key] = (entry[0], value, weight)
+                self.weight += weight - entry[2]
+                self.evict()
+
+    def invalidate(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+                self.invalidations += 1
+
+    def invalidate_where(self, predicate):
+        """Drop every entry whose key matches predicate(key)."""
+        with self.lock:
+            for key in [key for key in self.entries if predicate(key)]:
+                self.remove(key)
+                self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+            self.weight = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "weight": self.weight,
+                "max_weight": self.max_weight,
+                "too_large": self.too_large,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+                "expired": self.expired,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
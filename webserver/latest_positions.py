@@ -0,0 +1,113 @@
+"""
+Every device's latest position, held in memory for spatial queries.
+
+LatestPositions keeps one (device_id, longitude, latitude, elevation,
+timestamp) row per device, the same shape as the latest_cache rows, and files
+each device under a cell of a uniform cell_deg grid. A bounding-box query
+only visits the cells the box overlaps, or, for a box wider than the occupied
+part of the grid, only the occupied cells, so a zoomed-in map view costs
+about the same with 100 devices as with 100,000.
+
+flask_api loads it once from the database and then keeps it current from the
+fan-out channel; like the caches, positions only ever move forward in time.
+A periodic reload (see stale()) catches fixes whose notification was lost.
+"""
+import math
+import threading
+import time
+
+DEFAULT_CELL_DEG = 0.05
+
+
+class LatestPositions:
+    def __init__(self, cell_deg=DEFAULT_CELL_DEG, reload_interval=300.0):
+        self.cell_deg = cell_deg
+        self.reload_interval = reload_interval
+        self.rows = {}
+        # (x, y) cell -> ids of the devices whose latest fix is in it
+        self.cells = {}
+        self.cell_of = {}
+        self.loaded_at = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def cell(self, longitude, latitude):
+        return math.floor(longitude / self.cell_deg), math.floor(latitude / self.cell_deg)
+
+    def stale(self):
+        """True before the first load and once reload_interval has passed since the last."""
+        return self.loaded_at is None or time.monotonic() - self.loaded_at >= self.reload_interval
+
+    def load(self, rows):
+        """Merge a full read of the latest rows, e.g. query_latest(None, True)."""
+        applied = self.update(rows)
+        self.loaded_at = time.monotonic()
+        return applied
+
+    def update(self, rows):
+        """
+        Apply (device_id, longitude, latitude, elevation, timestamp) rows; older
+        ones are ignored. Returns the rows that were applied.
+        """
+        applied = []
+        with self.lock:
+            for row in rows:
+                row = (str(row[0]),) + tuple(row[1:])
+                device_id = row[0]
+                current = self.rows.get(device_id)
+                # A reload repeats rows that are already current; they are not news.
+                if current is not None and (row[4] < current[4] or row == current):
+                    continue
+                self.rows[device_id] = row
+                applied.append(row)
+                cell = self.cell(row[1], row[2])
+                previous = self.cell_of.get(device_id)
+                if previous == cell:
+                    continue
+                if previous is not None:
+                    members = self.cells[previous]
+                    members.discard(device_id)
+                    if not members:
+                        del self.cells[previous]
+                self.cells.setdefault(cell, set()).add(device_id)
+                self.cell_of[device_id] = cell
+        return applied
+
+    def get(self, device_id):
+        return self.rows.get(str(device_id))
+
+    def in_bbox(self, west, south, east, north, since=None, until=None, limit=None):
+        """
+        Latest rows inside the box, optionally only those timestamped within
+        [since, until]. A box with west > east crosses the antimeridian.
+        Returns (rows, truncated), with at most limit rows.
+        """
+        if west > east:
+            rows, truncated = self.in_bbox(west, south, 180.0, north, since, until, limit)
+            if truncated:
+                return rows, True
+            more, truncated = self.in_bbox(-180.0, south, east, north, since, until,
+                                           None if limit is None else limit - len(rows))
+            return rows + more, truncated
+        x0, y0 = self.cell(west, south)
+        x1, y1 = self.cell(east, north)
+        found = []
+        with self.lock:
+            if (x1 - x0 + 1) * (y1 - y0 + 1) > len(self.cells):
+                keys = [key for key in self.cells if x0 <= key[0] <= x1 and y0 <= key[1] <= y1]
+            else:
+                keys = [(x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+            rows = self.rows
+            for key in keys:
+                for device_id in self.cells.get(key, ()):
+                    row = rows[device_id]
+                    if not (west <= row[1] <= east and south <= row[2] <= north):
+                        continue
+                    if (since is not None and row[4] < since) or (until is not None and row[4] > until):
+                        continue
+                    if limit is not None and len(found) >= limit:
+                        return found, True
+                    found.append(row)
+        return found, False
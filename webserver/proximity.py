@@ -0,0 +1,213 @@
+"""
+Nearest-device search over the latest positions.
+
+Positions are kept as unit vectors on the sphere. The straight-line (chord)
+distance between two of them grows with the great-circle distance, so the
+nearest points in 3D are exactly the nearest along the Earth's surface: no
+planar projection, and nothing goes wrong near the poles or the antimeridian.
+Chords convert to metres with 2R asin(c / 2).
+
+KDTree is a static tree built with NumPy and searched best-first; leaves are
+scanned with one vectorized distance computation each. NearestIndex keeps it
+up to date incrementally: a device that moves is marked dead in the tree and
+its new position goes into a small delta array, which queries scan in full
+alongside the tree. Once the delta outgrows a fraction of the tree, the next
+query rebuilds the tree from both.
+"""
+import heapq
+import math
+import threading
+
+import numpy as np
+
+EARTH_RADIUS_M = 6371008.8
+LEAF_SIZE = 32
+
+
+def unit_vectors(longitudes, latitudes):
+    """(n, 3) points on the unit sphere for arrays of degrees."""
+    lon = np.radians(np.asarray(longitudes, dtype=np.float64))
+    lat = np.radians(np.asarray(latitudes, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return np.column_stack((cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)))
+
+
+def chord_to_metres(chords):
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.minimum(np.asarray(chords) / 2, 1.0))
+
+
+def metres_to_chord(metres):
+    return 2 * math.sin(min(metres / (2 * EARTH_RADIUS_M), math.pi / 2))
+
+
+def haversine_m(lon1, lat1, lon2, lat2):
+    """Great-circle distance in metres; any argument may be an array."""
+    lon1, lat1, lon2, lat2 = (np.radians(np.asarray(value, dtype=np.float64)) for value in (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class KDTree:
+    """
+    Points split on their widest dimension at the median until a node holds
+    at most leaf_size of them. Points are stored in leaf order, so a leaf is
+    a contiguous slice; slots maps them back to their original positions.
+    """
+    def __init__(self, points, leaf_size=LEAF_SIZE):
+        self.leaf_size = leaf_size
+        self.slots = np.arange(len(points))
+        self.boxes = []  # per node: (lo, hi) corners as tuples of floats
+        self.ranges = []  # per node: (start, end) into the leaf-ordered points
+        self.children = []  # per node: (left, right), or None for a leaf
+        if len(points):
+            self.build(np.asarray(points, dtype=np.float64), 0, len(points))
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 3)[self.slots]
+
+    def __len__(self):
+        return len(self.slots)
+
+    def build(self, points, start, end):
+        node = len(self.ranges)
+        subset = points[self.slots[start:end]]
+        lo = subset.min(axis=0)
+        hi = subset.max(axis=0)
+        self.boxes.append((tuple(lo.tolist()), tuple(hi.tolist())))
+        self.ranges.append((start, end))
+        self.children.append(None)
+        if end - start > self.leaf_size:
+            dim = int(np.argmax(hi - lo))
+            mid = (start + end) // 2
+            order = np.argpartition(subset[:, dim], mid - start)
+            self.slots[start:end] = self.slots[start:end][order]
+            left = self.build(points, start, mid)
+            right = self.build(points, mid, end)
+            self.children[node] = (left, right)
+        return node
+
+    def box_distance2(self, node, point):
+        lo, hi = self.boxes[node]
+        total = 0.0
+        for p, l, h in zip(point, lo, hi):
+            if p < l:
+                total += (l - p) ** 2
+            elif p > h:
+                total += (p - h) ** 2
+        return total
+
+    def query(self, point, k, max_distance2=math.inf, alive=None):
+        """
+        (squared chord distances, slots) of the k points nearest to point,
+        nearest first, leaving out slots where alive is False and anything
+        farther than max_distance2.
+        """
+        best_d = np.empty(0)
+        best_slots = np.empty(0, dtype=np.int64)
+        if not len(self.slots) or k <= 0:
+            return best_d, best_slots
+        bound = max_distance2
+        coords = tuple(float(value) for value in point)
+        heap = [(self.box_distance2(0, coords), 0)]
+        while heap:
+            distance2, node = heapq.heappop(heap)
+            if distance2 > bound:
+                break
+            children = self.children[node]
+            if children is not None:
+                for child in children:
+                    child_distance2 = self.box_distance2(child, coords)
+                    if child_distance2 <= bound:
+                        heapq.heappush(heap, (child_distance2, child))
+                continue
+            start, end = self.ranges[node]
+            d = ((self.points[start:end] - point) ** 2).sum(axis=1)
+            slots = self.slots[start:end]
+            keep = d <= bound
+            if alive is not None:
+                keep &= alive[slots]
+            best_d = np.concatenate((best_d, d[keep]))
+            best_slots = np.concatenate((best_slots, slots[keep]))
+            if len(best_d) > k:
+                part = np.argpartition(best_d, k - 1)[:k]
+                best_d, best_slots = best_d[part], best_slots[part]
+            if len(best_d) == k:
+                bound = min(bound, float(best_d.max()))
+        order = np.argsort(best_d, kind='stable')
+        return best_d[order], best_slots[order]
+
+
+class NearestIndex:
+    """Latest position per device for k-nearest queries, updated as fixes arrive."""
+    def __init__(self, rebuild_fraction=0.1, min_rebuild=1024, leaf_size=LEAF_SIZE):
+        self.rebuild_fraction = rebuild_fraction
+        self.min_rebuild = min_rebuild
+        self.leaf_size = leaf_size
+        self.lock = threading.Lock()
+        self.tree = KDTree(np.empty((0, 3)), leaf_size)
+        self.tree_ids = []
+        self.tree_slot = {}
+        self.alive = np.zeros(0, dtype=bool)
+        self.delta_ids = []
+        self.delta_slot = {}
+        self.delta_points = np.empty((256, 3))
+        self.rebuilds = 0
+
+    def __len__(self):
+        with self.lock:
+            return int(self.alive.sum()) + len(self.delta_ids)
+
+    def update(self, rows):
+        """Move devices to the positions in (device_id, longitude, latitude, ...) rows."""
+        rows = list(rows)
+        if not rows:
+            return
+        points = unit_vectors([row[1] for row in rows], [row[2] for row in rows])
+        with self.lock:
+            for row, point in zip(rows, points):
+                device_id = str(row[0])
+                slot = self.delta_slot.get(device_id)
+                if slot is None:
+                    tree_slot = self.tree_slot.get(device_id)
+                    if tree_slot is not None:
+                        self.alive[tree_slot] = False
+                    slot = self.delta_slot[device_id] = len(self.delta_ids)
+                    self.delta_ids.append(device_id)
+                    if slot == len(self.delta_points):
+                        self.delta_points = np.concatenate((self.delta_points, np.empty_like(self.delta_points)))
+                self.delta_points[slot] = point
+
+    def rebuild(self):
+        """Fold the delta into a new tree. Called with the lock held."""
+        live = np.flatnonzero(self.alive)
+        # The tree stores points in leaf order; tree.slots says which slot each one is.
+        by_slot = np.empty_like(self.tree.points)
+        by_slot[self.tree.slots] = self.tree.points
+        ids = [self.tree_ids[slot] for slot in live.tolist()] + self.delta_ids
+        points = np.concatenate((by_slot[live], self.delta_points[:len(self.delta_ids)]))
+        self.tree = KDTree(points, self.leaf_size)
+        self.tree_ids = ids
+        self.tree_slot = {device_id: slot for slot, device_id in enumerate(ids)}
+        self.alive = np.ones(len(ids), dtype=bool)
+        self.delta_ids = []
+        self.delta_slot = {}
+        self.rebuilds += 1
+
+    def nearest(self, longitude, latitude, k, max_distance_m=None):
+        """[(device_id, metres)] of the k devices nearest to the point, nearest first."""
+        point = unit_vectors([longitude], [latitude])[0]
+        max_distance2 = math.inf if max_distance_m is None else metres_to_chord(max_distance_m) ** 2
+        with self.lock:
+            if len(self.delta_ids) > max(self.min_rebuild, self.rebuild_fraction * len(self.tree_ids)):
+                self.rebuild()
+            tree_d, tree_slots = self.tree.query(point, k, max_distance2, self.alive)
+            ids = [self.tree_ids[slot] for slot in tree_slots.tolist()]
+            count = len(self.delta_ids)
+            if count:
+                delta_d = ((self.delta_points[:count] - point) ** 2).sum(axis=1)
+                keep = np.flatnonzero(delta_d <= max_distance2)
+                distances = np.concatenate((tree_d, delta_d[keep]))
+                ids += [self.delta_ids[slot] for slot in keep.tolist()]
+            else:
+                distances = tree_d
+        order = np.argsort(distances, kind='stable')[:k]
+        metres = chord_to_metres(np.sqrt(distances[order]))
+        return [(ids[i], float(m)) for i, m in zip(order.tolist(), metres.tolist())]
@@ -0,0 +1,106 @@
+"""
+Online/pending/offline status per device, tracked as events happen.
+
+A device is online until pending_after seconds pass without a fix, then
+pending until offline_after, then offline. StatusTracker keeps each device's
+last-seen time and current status in a dict, so looking a status up is O(1),
+and schedules the next transition on a min-heap keyed by when it is due.
+
+A fix normally only updates the last-seen time and leaves the heap alone.
+When an entry comes due, advance() recomputes the status from the last-seen
+time and either reports the transition or, if the device has been heard from
+in the meantime, pushes the entry back to the new due time. So the heap stays
+about the size of the fleet and a fix costs a dict update however often
+devices report. Only a fix that brings the next transition forward (a fresh
+fix after an old one from a drained backlog) pushes an extra entry; the one
+it supersedes is skipped when it comes out.
+"""
+import heapq
+import threading
+
+ONLINE = 'online'
+PENDING = 'pending'
+OFFLINE = 'offline'
+STATUSES = (ONLINE, PENDING, OFFLINE)
+
+
+class StatusTracker:
+    def __init__(self, pending_after, offline_after):
+        self.pending_after = pending_after
+        self.offline_after = offline_after
+        # device_id -> [last seen (epoch seconds), status, due time of its heap entry or None]
+        self.devices = {}
+        self.heap = []
+        self.counts = dict.fromkeys(STATUSES, 0)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.devices)
+
+    def status_at(self, age):
+        return ONLINE if age <= self.pending_after else PENDING if age <= self.offline_after else OFFLINE
+
+    def status(self, device_id):
+        entry = self.devices.get(str(device_id))
+        return entry[1] if entry else None
+
+    def next_due(self, entry):
+        if entry[1] == OFFLINE:
+            return None
+        return entry[0] + (self.pending_after if entry[1] == ONLINE else self.offline_after)
+
+    def schedule(self, device_id, entry):
+        """Queue the device's next transition unless an earlier entry will catch it. Called with the lock held."""
+        due = self.next_due(entry)
+        if due is not None and (entry[2] is None or due < entry[2]):
+            heapq.heappush(self.heap, (due, device_id))
+            entry[2] = due
+
+    def set_status(self, entry, status):
+        self.counts[entry[1]] -= 1
+        self.counts[status] += 1
+        entry[1] = status
+
+    def seen(self, device_id, last_seen, now):
+        """
+        Record a fix timestamped last_seen (epoch seconds). Returns a change
+        dict if the device's status changed (or it is new), else None. Fixes
+        older than the last one seen are ignored.
+        """
+        device_id = str(device_id)
+        status = self.status_at(now - last_seen)
+        with self.lock:
+            entry = self.devices.get(device_id)
+            if entry is None:
+                entry = self.devices[device_id] = [last_seen, status, None]
+                self.counts[status] += 1
+                self.schedule(device_id, entry)
+                return {"device_id": device_id, "status": status, "previous": None, "last_seen": last_seen}
+            if last_seen <= entry[0]:
+                return None
+            entry[0] = last_seen
+            previous = entry[1]
+            if status == previous:
+                return None
+            self.set_status(entry, status)
+            self.schedule(device_id, entry)
+            return {"device_id": device_id, "status": status, "previous": previous, "last_seen": last_seen}
+
+    def advance(self, now):
+        """Apply every transition due before now. Returns the changes, oldest first."""
+        changes = []
+        with self.lock:
+            heap = self.heap
+            while heap and heap[0][0] < now:
+                due, device_id = heapq.heappop(heap)
+                entry = self.devices[device_id]
+                if due != entry[2]:
+                    continue
+                entry[2] = None
+                status = self.status_at(now - entry[0])
+                if status != entry[1]:
+                    changes.append({"device_id": device_id, "status": status, "previous": entry[1],
+                                    "last_seen": entry[0]})
+                    self.set_status(entry, status)
+                self.schedule(device_id, entry)
+        return changes
@@ -0,0 +1,171 @@
+"""
+Track simplification for history replay.
+
+A zoomed-out map cannot show most of the points in a few days of history, so
+the API can thin a track before sending it, using Douglas-Peucker with a
+tolerance in metres, or a max_points budget. Distances are point-to-segment,
+in metres, on a local equirectangular projection.
+
+simplify() splits every segment at once per NumPy pass and is what requests
+use. rank_points() splits one segment at a time from a max-heap, largest
+deviation first, so a single full ranking contains every resolution; it is
+slower and meant for precomputing levels, sliced with select_level().
+"""
+import heapq
+import math
+
+import numpy as np
+
+METRES_PER_DEGREE_LAT = 110540.0
+METRES_PER_DEGREE_LON = 111320.0
+
+
+def project(latitudes, longitudes):
+    """Project to metres around the track's mean latitude. Good enough for anything city-sized."""
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    scale = math.cos(math.radians(float(latitudes.mean()))) if len(latitudes) else 1.0
+    return longitudes * (METRES_PER_DEGREE_LON * scale), latitudes * METRES_PER_DEGREE_LAT
+
+
+def farthest_point(x, y, start, end):
+    """Index and distance of the interior point of start..end farthest from that segment."""
+    px = x[start + 1:end] - x[start]
+    py = y[start + 1:end] - y[start]
+    dx = x[end] - x[start]
+    dy = y[end] - y[start]
+    length2 = dx * dx + dy * dy
+    if length2 > 0:
+        t = np.clip((px * dx + py * dy) / length2, 0.0, 1.0)
+        px = px - t * dx
+        py = py - t * dy
+    distances = np.hypot(px, py)
+    i = int(distances.argmax())
+    return start + 1 + i, float(distances[i])
+
+
+def rank_points(x, y, tolerance=None, max_points=None):
+    """
+    Split segments largest deviation first. Returns the indices in the order they
+    were kept and the deviation each one was kept at; the first k indices are
+    the k-point simplification. Without a tolerance or max_points every point
+    is ranked, which is what a precomputed multi-resolution level needs.
+    """
+    n = len(x)
+    if n <= 2:
+        return list(range(n)), [math.inf] * n
+    order = [0, n - 1]
+    deviations = [math.inf, math.inf]
+    heap = []
+
+    def push(start, end):
+        if end - start > 1:
+            index, distance = farthest_point(x, y, start, end)
+            heapq.heappush(heap, (-distance, start, end, index))
+
+    push(0, n - 1)
+    while heap:
+        if max_points is not None and len(order) >= max_points:
+            break
+        distance, start, end, index = heapq.heappop(heap)
+        if tolerance is not None and -distance <= tolerance:
+            break
+        order.append(index)
+        deviations.append(-distance)
+        push(start, index)
+        push(index, end)
+    return order, deviations
+
+
+def select_level(order, deviations, tolerance=None, max_points=None):
+    """Indices (sorted) of a level taken from a full ranking."""
+    count = len(order)
+    if tolerance is not None:
+        count = next((i for i, d in enumerate(deviations) if d <= tolerance), count)
+    if max_points is not None:
+        count = min(count, max(max_points, 2))
+    return np.sort(np.asarray(order[:count], dtype=np.intp))
+
+
+def segment_deviations(x, y, keep, points=None):
+    """
+    Distance of each point from the segment between the kept points around it,
+    for all segments in one vectorised pass. points restricts the pass to those
+    indices (default: all). Kept points get -1. Also returns each point's
+    segment number.
+    """
+    kept = np.flatnonzero(keep)
+    segment = np.minimum(np.cumsum(keep) - 1, len(kept) - 2)
+    if points is not None:
+        segment = segment[points]
+        x_points, y_points = x[points], y[points]
+        is_kept = keep[points]
+    else:
+        x_points, y_points, is_kept = x, y, keep
+    start = kept[segment]
+    end = kept[segment + 1]
+    px = x_points - x[start]
+    py = y_points - y[start]
+    dx = x[end] - x[start]
+    dy = y[end] - y[start]
+    length2 = dx * dx + dy * dy
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = np.where(length2 > 0, np.clip((px * dx + py * dy) / length2, 0.0, 1.0), 0.0)
+    distances = np.hypot(px - t * dx, py - t * dy)
+    distances[is_kept] = -1.0
+    return distances, segment
+
+
+def simplify(latitudes, longitudes, tolerance=None, max_points=None):
+    """
+    Indices (sorted) of the points to keep. tolerance is in metres; max_points
+    caps the result. With neither, every point is kept.
+
+    Every open segment is split in the same NumPy pass, so the number of passes
+    is the depth of the Douglas-Peucker tree rather than the number of points
+    kept, and segments already within tolerance drop out of later passes. With
+    max_points, each pass only splits the segments close to the largest
+    deviation, so the budget is spent on the worst segments first.
+    """
+    n = len(latitudes)
+    if tolerance is None and max_points is None:
+        return np.arange(n)
+    if max_points is not None:
+        max_points = max(int(max_points), 2)
+        if tolerance is None and n <= max_points:
+            return np.arange(n)
+    if n <= 2:
+        return np.arange(n)
+    x, y = project(latitudes, longitudes)
+    threshold = tolerance if tolerance is not None else 0.0
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    kept_count = 2
+    # Points in segments that may still need splitting.
+    points = np.arange(n)
+    while len(points) and (max_points is None or kept_count < max_points):
+        distances, segment = segment_deviations(x, y, keep, points)
+        # Runs of equal segment numbers in points, and the farthest point of each.
+        run_starts = np.concatenate(([0], np.flatnonzero(np.diff(segment)) + 1))
+        farthest = np.maximum.reduceat(distances, run_starts)
+        open_runs = farthest > threshold
+        split = np.flatnonzero(open_runs)
+        if not len(split):
+            break
+        if max_points is not None:
+            # Approximate the largest-deviation-first order of rank_points: only
+            # split segments within a factor of two of the worst one this pass.
+            split = split[farthest[split] >= farthest[split].max() * 0.5]
+            if kept_count + len(split) > max_points:
+                split = split[np.argsort(farthest[split])[::-1][:max_points - kept_count]]
+        run = np.repeat(np.arange(len(run_starts)), np.diff(np.append(run_starts, len(points))))
+        chosen = np.zeros(len(run_starts), dtype=bool)
+        chosen[split] = True
+        candidates = np.flatnonzero(chosen[run] & (distances == farthest[run]))
+        # Ties: keep the first farthest point of each run.
+        _, first = np.unique(run[candidates], return_index=True)
+        keep[points[candidates[first]]] = True
+        kept_count += len(first)
+        # Segments within tolerance are final; drop their points from the next pass.
+        points = points[open_runs[run]]
+    return np.flatnonzero(keep)